@@ -3,14 +3,14 @@ load_dotenv()
 
 import os
 
-from flask import Flask, request, jsonify, Response, stream_with_context
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
 import requests
 import logging
 
-from lib import load_tracks, load_genres, add_genre_information_to_tracks, get_audio_features_for_tracks, \
-    create_shuffled_list_of_genres, get_categories, format_categories, categorize_tracks, generate_spotify_playlists, \
-    stream_categorization, get_total_tracks
+from lib import generate_spotify_playlists, stream_categorization, get_total_tracks, CATEGORIZE_MODE, CATEGORIZE_MODES, \
+    job_queue, stream_job, playlist_categories, stream_generation, STREAM_FORMATS, create_library, playlist_preview
+import metrics
 
 # Set up logging
 logging.basicConfig(filename='logs/app.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -24,6 +24,29 @@ client_secret = os.environ.get('CLIENT_SECRET')
 redirect_uri = os.environ.get('REDIRECT_URI', 'http://localhost:3000')
 
 
+@app.before_request
+def start_trace():
+    g.trace = metrics.start_trace(f'{request.method} {request.path}')
+
+@app.teardown_request
+def finish_trace(exception=None):
+    trace = g.pop('trace', None)
+    if trace is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.request_seconds.observe(trace.finish(), endpoint=endpoint)
+
+def requested_playlist_id(token):
+    # playlist_ids, comma-separated and with 'saved' for the saved tracks, categorizes their union
+    playlist_ids = request.args.get('playlist_ids')
+    if playlist_ids:
+        return create_library(token, playlist_ids.split(','))
+    return request.args.get('playlist_id')
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/exchange-code', methods=['GET'])
 def exchange_code():
     code = request.args.get('code')
@@ -54,62 +77,127 @@ def exchange_code():
 def create_categories():
     logging.info('Creating categories')
     token = request.args.get('token')
-    playlist_id = request.args.get('playlist_id')
+    playlist_id = requested_playlist_id(token)
     num_categories = request.args.get('num_categories')
 
-    logging.info('Loading tracks')
-    load_tracks(token, playlist_id)
-    logging.info('Tracks loaded')
-
-    logging.info('Loading genres')
-    load_genres(token, playlist_id)
-    logging.info('Genres loaded')
-
-    logging.info('Adding genre information to tracks')
-    add_genre_information_to_tracks(token, playlist_id)
-    logging.info('added Genre information to tracks')
-
-    logging.info('Getting audio features for tracks')
-    get_audio_features_for_tracks(token, playlist_id)
-    logging.info('Got Audio features for tracks')
-
-    logging.info('Shuffling list of genres created')
-    genres_text = create_shuffled_list_of_genres(playlist_id)
-    logging.info('Shuffled list of genres created') 
-
-    logging.info('Getting Categories')
-    categories = get_categories(num_categories, genres_text)
+    # Identical requests arriving together, e.g. from two tabs, share one ingestion and LLM call
+    categories = playlist_categories(token, playlist_id, num_categories)
     logging.info('Got Categories')
 
     return jsonify(categories)
 
+@app.route('/preview', methods=['GET'])
+def preview_playlist():
+    logging.info('Previewing playlist')
+    token = request.args.get('token')
+    if not token:
+        return jsonify({"error": "A Spotify token is required"}), 400
+    try:
+        return jsonify(playlist_preview(token, requested_playlist_id(token)))
+    except PermissionError as e:
+        return jsonify({"error": str(e)}), 403
+
 @app.route('/total-tracks', methods=['GET'])
 def total_tracks():
     logging.info('Getting total tracks')
-    playlist_id = request.args.get('playlist_id')
+    playlist_id = requested_playlist_id(request.args.get('token'))
     return jsonify({"total_tracks":  get_total_tracks(playlist_id)})
 
 @app.route('/generate', methods=['POST'])
 def generate_playlists():
     logging.info('Generating playlists')
     token = request.args.get('token')
-    playlist_id = request.args.get('playlist_id')
+    playlist_id = requested_playlist_id(token)
     # get category data from POST request body
     categories = request.json['categories']
+    concurrency = request.args.get('concurrency', type=int)
+    batch_size = request.args.get('batch_size', type=int)
+    mode = request.args.get('mode', CATEGORIZE_MODE)
+    if mode not in CATEGORIZE_MODES:
+        return jsonify({"error": f"Unknown mode '{mode}', expected one of {', '.join(CATEGORIZE_MODES)}"}), 400
+    # json streams one array once the playlists exist, ndjson and sse stream events from the first byte
+    fmt = request.args.get('format', 'json')
+    if fmt != 'json' and fmt not in STREAM_FORMATS:
+        return jsonify({"error": f"Unknown format '{fmt}', expected one of json, {', '.join(STREAM_FORMATS)}"}), 400
     total_tracks = get_total_tracks(playlist_id)
     logging.info('Total tracks: %s', total_tracks)
 
+    if fmt in STREAM_FORMATS:
+        response = Response(
+            stream_with_context(stream_generation(token, playlist_id, categories, concurrency, batch_size, mode, fmt)),
+            mimetype=STREAM_FORMATS[fmt][1]
+        )
+        response.headers['X-Total-Tracks'] = str(total_tracks)
+        response.headers['Cache-Control'] = 'no-cache'
+        # Keeps proxies such as nginx from buffering the events
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
     generate_spotify_playlists(token, playlist_id, categories)
     logging.info('Playlists generated')
     logging.info('Streaming categorization started')
     response = Response(
-        stream_with_context(stream_categorization(token, playlist_id, categories)),
+        stream_with_context(stream_categorization(token, playlist_id, categories, concurrency, batch_size, mode)),
         mimetype='application/json'
     )
     logging.info('Streaming categorization finished')
     response.headers['X-Total-Tracks'] = str(total_tracks)
     return response
 
+@app.route('/jobs/categories', methods=['POST'])
+def submit_categories_job():
+    logging.info('Submitting categories job')
+    token = request.args.get('token')
+    job_id = job_queue.submit('categories',
+                              token=token,
+                              playlist_id=requested_playlist_id(token),
+                              num_categories=request.args.get('num_categories'))
+    return jsonify({"job_id": job_id}), 202
+
+@app.route('/jobs/generate', methods=['POST'])
+def submit_generate_job():
+    logging.info('Submitting generate job')
+    mode = request.args.get('mode', CATEGORIZE_MODE)
+    if mode not in CATEGORIZE_MODES:
+        return jsonify({"error": f"Unknown mode '{mode}', expected one of {', '.join(CATEGORIZE_MODES)}"}), 400
+    token = request.args.get('token')
+    job_id = job_queue.submit('generate',
+                              token=token,
+                              playlist_id=requested_playlist_id(token),
+                              categories=request.json['categories'],
+                              max_workers=request.args.get('concurrency', type=int),
+                              batch_size=request.args.get('batch_size', type=int),
+                              mode=mode)
+    return jsonify({"job_id": job_id}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    # params hold the Spotify token, so they are never sent back
+    job.pop('params')
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    try:
+        resumed = job_queue.resume(job_id, token=request.args.get('token'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not resumed:
+        return jsonify({"error": "Job not found or not failed"}), 409
+    return jsonify({"job_id": job_id}), 202
+
+@app.route('/jobs/<job_id>/stream', methods=['GET'])
+def stream_job_results(job_id):
+    job = job_queue.store.get(job_id)
+    if job is None or job['kind'] != 'generate':
+        return jsonify({"error": "Generate job not found"}), 404
+    response = Response(stream_with_context(stream_job(job_id)), mimetype='application/json')
+    if job['total'] is not None:
+        response.headers['X-Total-Tracks'] = str(job['total'])
+    return response
 
 
 if __name__ == '__main__':
@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Lookups note which artists they used and write that to the artists table once this many are pending,
+# or before the next eviction
+TOUCH_BATCH = 1000
+
+artist_lookups = registry.counter('playlistgenius_artist_cache_lookups_total',
+                                  'Artist cache lookups by the tier that answered them.')
+artist_refreshes = registry.counter('playlistgenius_artist_cache_refreshes_total',
+                                    'Stale artists refetched in the background, by outcome.')
+
+
+class ArtistCache:
+    """Artist genres and popularity shared by every user and playlist.
+
+    An in-memory LRU of up to hot_size artists sits in front of the TrackStore's artists table, which
+    holds up to max_entries artists and evicts the least recently used beyond that. Artists fetched
+    more than ttl seconds ago are still served, and refresh() refetches them on a background thread.
+    Lookups only write which artists they used to the table in batches of TOUCH_BATCH.
+    """
+
+    def __init__(self, store, ttl=7 * 24 * 3600, max_entries=200000, hot_size=20000):
+        self.store = store
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hot_size = hot_size
+        self._hot = OrderedDict()
+        self._refreshing = set()
+        self._touched = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='artist-refresh')
+
+    def get_many(self, artist_ids):
+        """Returns {artist id: {'genres', 'popularity', 'fetched_at'}} for the cached ones of artist_ids."""
+        artist_ids = set(artist_ids)
+        found = {}
+        with self._lock:
+            for artist_id in artist_ids:
+                artist = self._hot.get(artist_id)
+                if artist is not None:
+                    self._hot.move_to_end(artist_id)
+                    found[artist_id] = artist
+        artist_lookups.inc(len(found), tier='hot')
+
+        cold = artist_ids - found.keys()
+        if cold:
+            loaded = self.store.artists_by_id(cold)
+            artist_lookups.inc(len(loaded), tier='disk')
+            artist_lookups.inc(len(cold) - len(loaded), tier='miss')
+            self._remember(loaded)
+            found.update(loaded)
+
+        if found:
+            now = time.time()
+            with self._lock:
+                self._touched.update(dict.fromkeys(found, now))
+                flush = len(self._touched) >= TOUCH_BATCH
+            if flush:
+                self.flush()
+        return found
+
+    def flush(self):
+        """Writes when the artists looked up since the last flush were used."""
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if touched:
+            self.store.touch_artists(touched)
+
+    def missing(self, artist_ids):
+        """Returns the ids of artist_ids that are not cached at all."""
+        artist_ids = set(artist_ids)
+        return artist_ids - self.get_many(artist_ids).keys()
+
+    def frame(self, artist_ids):
+        """The cached artists of artist_ids as a frame of genres and popularity indexed by id."""
+        import pandas as pd
+        artists = self.get_many(artist_ids)
+        return pd.DataFrame({'genres': [list(a['genres']) for a in artists.values()],
+                             'popularity': [a['popularity'] for a in artists.values()]},
+                            index=pd.Index(list(artists), name='id'))
+
+    def put_many(self, artists):
+        """Stores freshly fetched artists, each a dict with id, genres and popularity."""
+        if not artists:
+            return
+        now = time.time()
+        self.store.upsert_artists(artists, fetched_at=now)
+        self._remember({a['id']: {'genres': tuple(a['genres']), 'popularity': a['popularity'], 'fetched_at': now}
+                        for a in artists})
+        self.flush()
+        evicted = self.store.evict_artists(self.max_entries)
+        if evicted:
+            logger.info(f'Evicted {evicted} least recently used artists')
+
+    def stale(self, artist_ids, now=None):
+        now = time.time() if now is None else now
+        return [artist_id for artist_id, artist in self.get_many(artist_ids).items()
+                if artist['fetched_at'] is None or artist['fetched_at'] < now - self.ttl]
+
+    def refresh(self, artist_ids, fetch, batch_size=50):
+        """Refetches the stale ones of artist_ids in the background with fetch(batch of ids), which returns
+        artist dicts. Tracks of artists whose genres changed have their genres reset so they are
+        recomputed. Returns the Future, or None when nothing needed refreshing."""
+        stale = self.stale(artist_ids)
+        with self._lock:
+            stale = [artist_id for artist_id in stale if artist_id not in self._refreshing]
+            self._refreshing.update(stale)
+        if not stale:
+            return None
+        return self._pool.submit(self._refresh, stale, fetch, batch_size)
+
+    def _refresh(self, artist_ids, fetch, batch_size):
+        try:
+            for offset in range(0, len(artist_ids), batch_size):
+                batch = artist_ids[offset:offset + batch_size]
+                try:
+                    artists = fetch(batch)
+                except Exception as e:
+                    logger.error(f'Error refreshing artists: {e}')
+                    artist_refreshes.inc(len(batch), outcome='failed')
+                    continue
+                previous = self.get_many(a['id'] for a in artists)
+                self.put_many(artists)
+                changed = [a['id'] for a in artists
+                           if a['id'] in previous and tuple(a['genres']) != tuple(previous[a['id']]['genres'])]
+                if changed:
+                    self.store.reset_track_genres(changed)
+                artist_refreshes.inc(len(artists) - len(changed), outcome='unchanged')
+                artist_refreshes.inc(len(changed), outcome='changed')
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(artist_ids)
+
+    def _remember(self, artists):
+        with self._lock:
+            for artist_id, artist in artists.items():
+                self._hot[artist_id] = artist
+                self._hot.move_to_end(artist_id)
+            while len(self._hot) > self.hot_size:
+                self._hot.popitem(last=False)
+
+    def clear(self):
+        """Drops the hot tier, leaving the artists table as it is."""
+        with self._lock:
+            self._hot.clear()
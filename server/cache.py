@@ -0,0 +1,133 @@
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Cache hits mark their answers as recently used in one write once this many have piled up
+TOUCH_BATCH = 256
+
+
+@lru_cache(maxsize=32)
+def normalize_categories(categories_output):
+    # Formatting-only edits to the categories (emphasis, whitespace) map to the same key
+    return re.sub(r'\s+', ' ', categories_output.replace('*', '')).strip()
+
+
+def categorization_key(categories_output, track_payload, model=''):
+    digest = hashlib.sha256()
+    for part in (model, normalize_categories(categories_output), track_payload):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class CategorizationCache:
+    """Persistent, size-bounded LRU cache of categorization answers stored in SQLite.
+
+    Lookups read through a connection per thread without taking a lock. The recency of a hit is
+    written with the next put, or together with the others once TOUCH_BATCH hits have piled up.
+    """
+
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._conn = None
+        self._local = threading.local()
+        self._readers = []
+        self._touched = {}
+        self._size = 0
+
+    def _connection(self):
+        # The writing connection, used under self._lock
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS categorizations ('
+                               'key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS categorizations_last_used '
+                               'ON categorizations (last_used)')
+            self._conn.commit()
+            self._size = self._conn.execute('SELECT COUNT(*) FROM categorizations').fetchone()[0]
+        return self._conn
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            with self._lock:
+                self._connection()
+                conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+                self._readers.append(conn)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._reader().execute('SELECT value FROM categorizations WHERE key = ?', (key,)).fetchone()
+        with self._stats_lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[key] = time.time()
+            flush = len(self._touched) >= TOUCH_BATCH
+        if flush:
+            with self._lock:
+                self._flush_touched(self._connection())
+                self._conn.commit()
+        return tuple(json.loads(row[0]))
+
+    def _flush_touched(self, conn):
+        with self._stats_lock:
+            touched, self._touched = self._touched, {}
+        conn.executemany('UPDATE categorizations SET last_used = MAX(last_used, ?) WHERE key = ?',
+                         [(used, key) for key, used in touched.items()])
+
+    def put(self, key, value):
+        with self._lock:
+            conn = self._connection()
+            self._flush_touched(conn)
+            exists = conn.execute('SELECT 1 FROM categorizations WHERE key = ?', (key,)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO categorizations (key, value, last_used) VALUES (?, ?, ?)',
+                         (key, json.dumps(list(value)), time.time()))
+            if not exists:
+                self._size += 1
+            if self._size > self.max_entries:
+                evict = self._size - self.max_entries
+                conn.execute('DELETE FROM categorizations WHERE key IN ('
+                             'SELECT key FROM categorizations ORDER BY last_used LIMIT ?)', (evict,))
+                self._size -= evict
+                logger.info(f'Evicted {evict} cached categorizations')
+            conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            self._connection()
+            return self._size
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self)}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._flush_touched(self._conn)
+                self._conn.commit()
+                self._conn.close()
+                self._conn = None
+            for conn in self._readers:
+                conn.close()
+            self._readers = []
+            self._local = threading.local()
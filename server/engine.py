@@ -0,0 +1,194 @@
+import contextvars
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+coalesced_calls = registry.counter('playlistgenius_coalesced_calls_total',
+                                   'Calls answered by another caller\'s run, by kind and how.')
+
+
+class CallTimeout(Exception):
+    pass
+
+
+def is_rate_limit_error(e):
+    # openai<1 raises openai.error.RateLimitError, newer clients and spotipy expose a status code
+    if type(e).__name__ == 'RateLimitError':
+        return True
+    for attr in ('http_status', 'status_code', 'http_status_code'):
+        if getattr(e, attr, None) == 429:
+            return True
+    return False
+
+
+def retry_after_seconds(e):
+    headers = getattr(e, 'headers', None) or getattr(e, 'headers_', None) or {}
+    try:
+        value = headers.get('Retry-After') or headers.get('retry-after')
+    except AttributeError:
+        return None
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def call_with_backoff(fn, *args, max_retries=3, backoff=1.0, max_backoff=30.0, on_retry=None, **kwargs):
+    attempt = 0
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt >= max_retries:
+                raise
+            delay = retry_after_seconds(e)
+            if delay is None:
+                delay = min(max_backoff, backoff * (2 ** attempt)) * (0.5 + random.random() / 2)
+            logger.warning(f'Rate limited, retrying in {delay:.2f}s ({attempt + 1}/{max_retries})')
+            if on_retry is not None:
+                on_retry(e, delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+def run_concurrently(fn, items, max_workers=8, timeout=None):
+    """Calls fn(item) for each item on a bounded thread pool.
+
+    Yields (item, result, error) tuples in completion order. At most max_workers calls are in
+    flight at once, so items is consumed lazily. Calls running longer than timeout seconds, counted
+    from when they start, are abandoned and reported with a CallTimeout error. A thread cannot be
+    stopped, so an abandoned call keeps its worker until it returns and no other item is started in
+    its place meanwhile; fn should bound its own calls, e.g. with a request timeout. Nothing is
+    retried here, fn's upstream calls retry their rate limits themselves.
+    """
+    items = iter(items)
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {}
+    abandoned = set()
+    exhausted = False
+
+    def submit_next():
+        nonlocal exhausted
+        for item in items:
+            call = {'item': item, 'started': None}
+
+            def run(call=call):
+                call['started'] = time.monotonic()
+                return fn(call['item'])
+
+            # Run in a copy of the caller's context so the request's trace sees the calls' stages
+            pending[pool.submit(contextvars.copy_context().run, run)] = call
+            return True
+        exhausted = True
+        return False
+
+    try:
+        for _ in range(max_workers):
+            if not submit_next():
+                break
+
+        # Items left behind abandoned calls are started as their workers free up
+        while pending or (abandoned and not exhausted):
+            wait_for = None
+            if timeout is not None:
+                now = time.monotonic()
+                # A call that has not started yet cannot time out sooner than timeout from now
+                if pending:
+                    wait_for = max(0, min((call['started'] or now) + timeout - now for call in pending.values()))
+            done, _ = wait([*pending, *abandoned], timeout=wait_for, return_when=FIRST_COMPLETED)
+
+            for future in done & abandoned:
+                abandoned.discard(future)
+                submit_next()
+
+            if timeout is not None:
+                now = time.monotonic()
+                for future, call in list(pending.items()):
+                    if future not in done and call['started'] is not None and now - call['started'] >= timeout:
+                        del pending[future]
+                        abandoned.add(future)
+                        yield call['item'], None, CallTimeout(f'Call exceeded {timeout}s')
+
+            for future in done:
+                if future not in pending:
+                    continue
+                item = pending.pop(future)['item']
+                submit_next()
+                try:
+                    yield item, future.result(), None
+                except Exception as e:
+                    yield item, None, e
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def chunked(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time.
+
+    Callers arriving while a call for their key is running wait for it and get its result, or its
+    exception. Results are kept for ttl seconds after the call returns, so repeats shortly after are
+    answered without running again. Keys are tuples whose first item names the kind of call.
+    """
+
+    def __init__(self, ttl=0.0):
+        self.ttl = ttl
+        self._calls = {}
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            now = time.monotonic()
+            memoized = self._results.get(key)
+            if memoized is not None and memoized[0] > now:
+                coalesced_calls.inc(kind=key[0], how='memoized')
+                return memoized[1]
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            coalesced_calls.inc(kind=key[0], how='shared')
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            with self._lock:
+                del self._calls[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._calls[key]
+            if self.ttl > 0:
+                now = time.monotonic()
+                for expired in [k for k, (expires, _) in self._results.items() if expires <= now]:
+                    del self._results[expired]
+                self._results[key] = (now + self.ttl, result)
+        future.set_result(result)
+        return result
+
+    def forget(self, key):
+        """Drops the memoized result for key, so the next call runs again."""
+        with self._lock:
+            self._results.pop(key, None)
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+from store import AUDIO_FEATURES
+
+
+def encode_ragged(lists, index=None):
+    """Int-codes a sequence of lists as flat (codes, offsets), where list i is codes[offsets[i]:offsets[i + 1]].
+
+    Values are coded by their position in index when given, -1 when missing from it, and by order of
+    first appearance otherwise. Returns (codes, offsets, index).
+    """
+    lengths = np.fromiter((len(values) if isinstance(values, (list, tuple)) else 0 for values in lists),
+                          dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    flat = pd.Series([value for values in lists if isinstance(values, (list, tuple)) for value in values],
+                     dtype=object)
+    if index is None:
+        codes, index = pd.factorize(flat)
+    else:
+        codes = pd.Index(index).get_indexer(flat) if len(flat) else np.zeros(0, dtype=np.int64)
+        codes = np.where(flat.isna().to_numpy(), -2, codes) if len(flat) else codes
+    return codes.astype(np.int32), offsets, index
+
+
+def ragged_positions(starts, lengths):
+    """Flat positions covering [starts[i], starts[i] + lengths[i]) for every i, in order."""
+    total = int(lengths.sum())
+    if not total:
+        return np.zeros(0, dtype=np.int64)
+    run_starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + np.arange(total) - run_starts
+
+
+def track_genres(df_tracks, df_artists):
+    """Returns a Series of genre tuples indexed by track id.
+
+    Artists and genres are int-coded into flat code arrays with offsets rather than exploded into
+    frames, so the join costs a few integer arrays per track-artist pair. Genres keep the order of
+    the track's artists and of each artist's genres, without duplicates. Tracks referencing an
+    artist missing from df_artists are left out so they can be retried later.
+    """
+    artist_codes, artist_offsets, _ = encode_ragged(df_tracks['artists_id'].tolist(), df_artists.index)
+    genre_codes, genre_offsets, genres = encode_ragged(df_artists['genres'].tolist())
+
+    track_of_pair = np.repeat(np.arange(len(df_tracks)), np.diff(artist_offsets))
+    unknown = np.unique(track_of_pair[artist_codes == -1])
+    known = artist_codes >= 0
+    track_of_pair, artist_codes = track_of_pair[known], artist_codes[known]
+
+    # Gather each pair's artist genres, then drop repeats within a track keeping first occurrences
+    lengths = np.diff(genre_offsets)[artist_codes]
+    pair_genres = genre_codes[ragged_positions(genre_offsets[artist_codes], lengths)]
+    pair_tracks = np.repeat(track_of_pair, lengths)
+    keys = pair_tracks.astype(np.int64) * max(1, len(genres)) + pair_genres
+    _, first = np.unique(keys, return_index=True)
+    first.sort()
+    pair_tracks, pair_genres = pair_tracks[first], pair_genres[first]
+
+    offsets = np.searchsorted(pair_tracks, np.arange(len(df_tracks) + 1))
+    names = np.asarray(genres, dtype=object)[pair_genres]
+    values = [tuple(names[offsets[i]:offsets[i + 1]]) for i in range(len(df_tracks))]
+
+    complete = np.ones(len(df_tracks), dtype=bool)
+    complete[unknown] = False
+    return pd.Series(values, index=df_tracks.index, dtype=object)[complete]
+
+
+def audio_features_frame(audio_features):
+    """Builds a frame of audio features indexed by track id from Spotify's audio_features response,
+    skipping the nulls Spotify returns for tracks without an analysis."""
+    records = [f for f in audio_features if f is not None]
+    return pd.DataFrame.from_records(records, columns=['id'] + AUDIO_FEATURES).set_index('id')
+
@@ -0,0 +1,217 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from store import AUDIO_FEATURES
+
+logger = logging.getLogger(__name__)
+
+# Most distinct genre clusters a preview suggests, and the fewest tracks a suggested category should hold
+MAX_SUGGESTED_CATEGORIES = 12
+MIN_TRACKS_PER_CATEGORY = 5
+
+
+class PlaylistFeatures:
+    """Numeric view of a playlist: float32 audio features and a sparse track-by-genre incidence matrix.
+
+    audio has one row of AUDIO_FEATURES per track, NaN where a feature is missing. The genres of track i
+    are genres[indices[indptr[i]:indptr[i + 1]]], the CSR layout of the incidence matrix, so the whole
+    playlist takes a few bytes per genre tag however many genres there are. version is the
+    TrackStore.playlist_version the matrix was built at.
+    """
+
+    def __init__(self, track_ids, audio, genres, indptr, indices, tagged, version):
+        self.track_ids = track_ids
+        self.audio = audio
+        self.genres = genres
+        self.indptr = indptr
+        self.indices = indices
+        self.tagged = tagged
+        self.version = version
+
+    @classmethod
+    def build(cls, track_ids, track_genres, feature_rows, version):
+        import numpy as np
+        vocabulary = {}
+        indptr = np.zeros(len(track_ids) + 1, dtype=np.int32)
+        indices = []
+        for i, genres in enumerate(track_genres):
+            for genre in dict.fromkeys(genres or ()):
+                indices.append(vocabulary.setdefault(genre, len(vocabulary)))
+            indptr[i + 1] = len(indices)
+        audio = np.array([[np.nan if value is None else value for value in row] for row in feature_rows],
+                         dtype=np.float32).reshape(len(track_ids), len(AUDIO_FEATURES))
+        tagged = np.array([genres is not None for genres in track_genres], dtype=bool)
+        return cls(list(track_ids), audio, list(vocabulary), indptr, np.array(indices, dtype=np.int32), tagged,
+                   version)
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def genre_lists(self):
+        """Returns each track's genre tuple, None for tracks whose genres are not known yet."""
+        return [tuple(self.genres[j] for j in self.indices[start:end]) if tagged else None
+                for start, end, tagged in zip(self.indptr[:-1], self.indptr[1:], self.tagged)]
+
+    def genre_counts(self):
+        import numpy as np
+        return np.bincount(self.indices, minlength=len(self.genres))
+
+    def genre_histogram(self, top=30):
+        """Returns the top genres with the number of tracks tagged with each, most frequent first."""
+        counts = self.genre_counts()
+        order = sorted(range(len(self.genres)), key=lambda j: (-counts[j], self.genres[j]))[:top]
+        return [{'genre': self.genres[j], 'tracks': int(counts[j])} for j in order]
+
+    def feature_distributions(self, bins=10):
+        """Returns each audio feature's count, mean, quartiles and a histogram over bins equal-width bins."""
+        import numpy as np
+        distributions = {}
+        for j, feature in enumerate(AUDIO_FEATURES):
+            values = self.audio[:, j]
+            values = values[~np.isnan(values)]
+            if not len(values):
+                distributions[feature] = {'count': 0}
+                continue
+            counts, edges = np.histogram(values, bins=bins)
+            p25, p50, p75 = np.percentile(values, [25, 50, 75])
+            distributions[feature] = {'count': int(len(values)), 'mean': float(values.mean()),
+                                      'min': float(values.min()), 'p25': float(p25), 'median': float(p50),
+                                      'p75': float(p75), 'max': float(values.max()),
+                                      'histogram': {'counts': counts.tolist(), 'edges': edges.tolist()}}
+        return distributions
+
+    def suggested_categories(self, coverage=0.8):
+        """Suggests how many categories to ask for from how the genres spread over the tracks.
+
+        'max' is the number of most common genres it takes to cover coverage of the tagged tracks, 'min'
+        the effective number of genres (the exponential of the genre distribution's entropy) halved, and
+        'suggested' their geometric mean. Each is capped so a category holds at least
+        MIN_TRACKS_PER_CATEGORY tracks on average.
+        """
+        import numpy as np
+        cap = int(np.clip(len(self) // MIN_TRACKS_PER_CATEGORY, 1, MAX_SUGGESTED_CATEGORIES))
+        tagged = int(np.count_nonzero(np.diff(self.indptr)))
+        if not tagged:
+            return {'suggested': min(2, cap), 'min': 1, 'max': cap}
+
+        counts = self.genre_counts()
+        shares = counts[counts > 0] / counts.sum()
+        effective = float(np.exp(-(shares * np.log(shares)).sum()))
+
+        # Tracks of each genre, by sorting the CSR entries on genre
+        rows = np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.indptr))
+        order = np.argsort(self.indices, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)])
+        covered = np.zeros(len(self), dtype=bool)
+        needed = 0
+        for j in np.lexsort((np.arange(len(counts)), -counts)):
+            if covered.sum() >= coverage * tagged or needed >= MAX_SUGGESTED_CATEGORIES:
+                break
+            covered[rows[order[starts[j]:starts[j + 1]]]] = True
+            needed += 1
+
+        high = int(np.clip(needed, 1, cap))
+        low = int(np.clip(round(effective / 2), 1, high))
+        return {'suggested': int(np.clip(round(np.sqrt(low * high)), low, high)), 'min': low, 'max': high,
+                'effective_genres': round(effective, 1)}
+
+    def preview(self, top_genres=30, bins=10):
+        import numpy as np
+        tagged = int(self.tagged.sum())
+        return {'total_tracks': len(self),
+                'tracks_with_genres': int(np.count_nonzero(np.diff(self.indptr))),
+                'tracks_without_genres': tagged - int(np.count_nonzero(np.diff(self.indptr))),
+                'tracks_pending_genres': len(self) - tagged,
+                'distinct_genres': len(self.genres),
+                'genres': self.genre_histogram(top_genres),
+                'audio_features': self.feature_distributions(bins),
+                'categories': self.suggested_categories()}
+
+    def save(self, path):
+        import numpy as np
+        np.savez(path, track_ids=np.array(self.track_ids, dtype=str), audio=self.audio,
+                 genres=np.array(self.genres, dtype=str), indptr=self.indptr, indices=self.indices,
+                 tagged=self.tagged, version=np.array(self.version))
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+        with np.load(path) as data:
+            return cls(data['track_ids'].tolist(), data['audio'], data['genres'].tolist(), data['indptr'],
+                       data['indices'], data['tagged'], int(data['version']))
+
+
+class FeatureCache:
+    """Builds each playlist's PlaylistFeatures once and keeps it until the playlist's version changes.
+
+    The max_entries most recently used are kept in memory. With directory, they are also saved there as
+    .npz files, so other processes and restarts reuse them.
+    """
+
+    def __init__(self, store, max_entries=64, directory=None):
+        self.store = store
+        self.max_entries = max_entries
+        self.directory = directory
+        self.builds = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._building = {}
+
+    def _path(self, playlist_id):
+        name = hashlib.sha1(playlist_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f'{name}.npz')
+
+    def get(self, playlist_id):
+        version = self.store.playlist_version(playlist_id)
+        with self._lock:
+            features = self._entries.get(playlist_id)
+            if features is not None and features.version == version:
+                self._entries.move_to_end(playlist_id)
+                return features
+            # One build per playlist at a time, concurrent callers wait for it
+            lock = self._building.setdefault(playlist_id, threading.Lock())
+
+        with lock:
+            with self._lock:
+                features = self._entries.get(playlist_id)
+            if features is None or features.version != version:
+                features = self._load(playlist_id, version) or self._build(playlist_id, version)
+            with self._lock:
+                self._entries[playlist_id] = features
+                self._entries.move_to_end(playlist_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                # Callers already waiting hold the lock, later ones find the entry or start a new one
+                if self._building.get(playlist_id) is lock:
+                    del self._building[playlist_id]
+        return features
+
+    def _load(self, playlist_id, version):
+        if self.directory is None or not os.path.exists(self._path(playlist_id)):
+            return None
+        try:
+            features = PlaylistFeatures.load(self._path(playlist_id))
+        except Exception as e:
+            logger.warning(f'Could not read the feature matrix of {playlist_id}: {e}')
+            return None
+        return features if features.version == version else None
+
+    def _build(self, playlist_id, version):
+        features = PlaylistFeatures.build(*self.store.playlist_feature_rows(playlist_id), version)
+        self.builds += 1
+        logger.info(f'Built the feature matrix of {playlist_id}: {len(features)} tracks, '
+                    f'{len(features.genres)} genres, {len(features.indices)} genre tags')
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(playlist_id)
+            # Written aside and renamed, so a reader never sees half a file
+            features.save(path + '.tmp.npz')
+            os.replace(path + '.tmp.npz', path)
+        return features
+
+    def invalidate(self, playlist_id):
+        with self._lock:
+            self._entries.pop(playlist_id, None)
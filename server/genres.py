@@ -0,0 +1,83 @@
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from itertools import combinations
+
+from tokenizer import count_tokens
+
+_summaries = OrderedDict()
+_summaries_lock = threading.Lock()
+MAX_CACHED_SUMMARIES = 256
+
+
+def genre_summary(genres, token_budget=2000, model='gpt-3.5-turbo'):
+    """Summarizes the genres of a list of tracks within token_budget tokens.
+
+    genres holds one iterable of genre names per track. The summary lists genres by the number of
+    tracks they appear on, then the most common exact genre combinations and genre pairs, each most
+    frequent first with ties broken alphabetically, so the same tracks always give the same text.
+    The size of the summary depends on the budget, not on the number of tracks.
+    """
+    genre_counts = Counter()
+    combination_counts = Counter()
+    pair_counts = Counter()
+    untagged = 0
+    for track_genres in genres:
+        track_genres = sorted(set(track_genres or ()))
+        if not track_genres:
+            untagged += 1
+            continue
+        genre_counts.update(track_genres)
+        combination_counts[tuple(track_genres)] += 1
+        pair_counts.update(combinations(track_genres, 2))
+
+    def ranked(counts, min_count=1):
+        return [(key, n) for key, n in sorted(counts.items(), key=lambda item: (-item[1], item[0])) if n >= min_count]
+
+    header = (f"{sum(combination_counts.values())} songs with genres ({untagged} without), "
+              f"{len(genre_counts)} distinct genres.")
+    sections = [
+        ("Genres (number of songs):", [f"{genre} ({n})" for genre, n in ranked(genre_counts)], ', ', 0.5),
+        ("Most common genre combinations (number of songs):",
+         [f"{n} x {', '.join(combination)}" for combination, n in ranked(combination_counts, 2)], '\n', 0.3),
+        ("Genres that most often appear together (number of songs):",
+         [f"{a} + {b} ({n})" for (a, b), n in ranked(pair_counts, 2)], '\n', 0.2),
+    ]
+
+    remaining = token_budget - count_tokens(header, model)
+    parts = [header]
+    # Each section gets its share of the budget, and whatever a section leaves unused goes to the next ones
+    shares = [share for *_, share in sections]
+    for i, (title, entries, separator, share) in enumerate(sections):
+        section_budget = remaining * share / sum(shares[i:])
+        used = count_tokens(title, model) + 2
+        kept = []
+        for entry in entries:
+            cost = count_tokens(entry + separator, model)
+            if used + cost > section_budget:
+                break
+            kept.append(entry)
+            used += cost
+        if kept:
+            parts.append(f"{title}\n{separator.join(kept)}")
+            remaining -= used
+
+    return '\n\n'.join(parts)
+
+
+def cached_genre_summary(key, genres, token_budget=2000, model='gpt-3.5-turbo'):
+    """genre_summary memoized on key, the budget and a fingerprint of the genres."""
+    genres = [tuple(sorted(set(g or ()))) for g in genres]
+    fingerprint = hashlib.sha256(repr(sorted(genres)).encode('utf-8')).hexdigest()
+    cache_key = (key, fingerprint, token_budget, model)
+    with _summaries_lock:
+        if cache_key in _summaries:
+            _summaries.move_to_end(cache_key)
+            return _summaries[cache_key]
+
+    summary = genre_summary(genres, token_budget, model)
+    with _summaries_lock:
+        _summaries[cache_key] = summary
+        if len(_summaries) > MAX_CACHED_SUMMARIES:
+            _summaries.popitem(last=False)
+    return summary
@@ -0,0 +1,195 @@
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from engine import is_rate_limit_error, retry_after_seconds
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+rate_limit_waits = registry.histogram('playlistgenius_rate_limit_wait_seconds',
+                                      'Time requests waited for their upstream\'s rate limit budget.')
+rate_limit_throttles = registry.counter('playlistgenius_rate_limit_throttles_total',
+                                        '429 responses that slowed an upstream\'s rate down, by upstream.')
+registry.gauge('playlistgenius_rate_limit_budget', 'Requests per second each upstream is currently allowed.',
+               lambda: {name: governor.stats()['rate'] for name, governor in list(_governors.items())},
+               label='upstream')
+registry.gauge('playlistgenius_rate_limit_queue_depth', 'Requests waiting for their upstream\'s budget.',
+               lambda: {name: governor.queue_depth for name, governor in list(_governors.items())},
+               label='upstream')
+
+
+class RateGovernor:
+    """Paces the requests to one upstream with a token bucket whose rate adapts to its rate limits.
+
+    Until the first 429, every success raises the rate by increase, doubling it about every second, so a
+    fresh process quickly finds the upstream's limit. After that the rate is raised additively, by about
+    increase requests per second for each second spent at the current rate, up to max_rate. A 429
+    multiplies it by decrease at most once per cooldown seconds, down to min_rate, and pauses every caller
+    until its Retry-After has passed. Throughput so settles just under the upstream's limit instead of
+    bursting into it.
+
+    Callers are served first come, first served, so a caller sending many requests cannot starve the others.
+    With path, the bucket is kept in SQLite and shared by every process using that file.
+    """
+
+    def __init__(self, name, rate=10.0, min_rate=0.5, max_rate=100.0, burst=5, increase=1.0, decrease=0.5,
+                 cooldown=1.0, path=None):
+        self.name = name
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.path = path
+        self.queue_depth = 0
+        self.throttles = 0
+        self._initial_rate = min(max(rate, min_rate), max_rate)
+        self._state = self._new_state()
+        self._condition = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self._conn = None
+
+    def _new_state(self):
+        return {'rate': self._initial_rate, 'tokens': float(self.burst), 'updated': time.time(),
+                'paused_until': 0.0, 'last_decrease': 0.0}
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS governors (name TEXT PRIMARY KEY, rate REAL, tokens REAL, '
+                               'updated REAL, paused_until REAL, last_decrease REAL)')
+        return self._conn
+
+    def _update(self, fn):
+        """Calls fn(state, now) on the bucket, refilled up to now, and saves the state it leaves."""
+        with self._condition:
+            if self.path is None:
+                return fn(self._refill(self._state), time.time())
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT rate, tokens, updated, paused_until, last_decrease FROM governors '
+                                   'WHERE name = ?', (self.name,)).fetchone()
+                state = dict(zip(('rate', 'tokens', 'updated', 'paused_until', 'last_decrease'), row)) \
+                    if row else self._new_state()
+                result = fn(self._refill(state), time.time())
+                conn.execute('INSERT OR REPLACE INTO governors VALUES (?, ?, ?, ?, ?, ?)',
+                             (self.name, state['rate'], state['tokens'], state['updated'], state['paused_until'],
+                              state['last_decrease']))
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+            return result
+
+    def _refill(self, state):
+        now = time.time()
+        state['tokens'] = min(self.burst, state['tokens'] + max(0.0, now - state['updated']) * state['rate'])
+        state['updated'] = now
+        return state
+
+    @staticmethod
+    def _take(state, now):
+        # Returns how long to wait before trying again, 0 once a token was taken
+        if state['paused_until'] > now:
+            return state['paused_until'] - now
+        if state['tokens'] >= 1:
+            state['tokens'] -= 1
+            return 0
+        return (1 - state['tokens']) / state['rate']
+
+    def acquire(self):
+        """Blocks until a request may be sent and returns how many seconds that took."""
+        start = time.monotonic()
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self.queue_depth += 1
+            try:
+                while True:
+                    delay = None
+                    if ticket == self._serving:
+                        try:
+                            delay = self._update(self._take)
+                        except BaseException:
+                            self._serving += 1
+                            self._condition.notify_all()
+                            raise
+                        if delay <= 0:
+                            self._serving += 1
+                            self._condition.notify_all()
+                            break
+                    self._condition.wait(delay)
+            finally:
+                self.queue_depth -= 1
+        waited = time.monotonic() - start
+        rate_limit_waits.observe(waited, upstream=self.name)
+        return waited
+
+    def succeeded(self):
+        def increase(state, now):
+            step = self.increase if state['last_decrease'] == 0 else self.increase / state['rate']
+            state['rate'] = min(self.max_rate, state['rate'] + step)
+        self._update(increase)
+
+    def throttled(self, retry_after=None):
+        """Slows down after a 429, pausing every caller for retry_after seconds when given."""
+        def decrease(state, now):
+            state['tokens'] = 0.0
+            state['paused_until'] = max(state['paused_until'], now + (retry_after or 0))
+            # Requests already in flight get their 429s too, only the first of them slows the rate down
+            if now - state['last_decrease'] >= self.cooldown:
+                state['rate'] = max(self.min_rate, state['rate'] * self.decrease)
+                state['last_decrease'] = now
+                return True
+            return False
+        if self._update(decrease):
+            self.throttles += 1
+            rate_limit_throttles.inc(upstream=self.name)
+            logger.warning(f'Rate limited by {self.name}, slowing down to {self.stats()["rate"]:.2f} requests/s')
+
+    @contextmanager
+    def request(self):
+        """Waits for the budget to send one request and learns from how it went."""
+        self.acquire()
+        try:
+            yield
+        except Exception as e:
+            if is_rate_limit_error(e):
+                self.throttled(retry_after_seconds(e))
+            raise
+        self.succeeded()
+
+    def wrap(self, fn):
+        """Returns fn paced and observed by this governor."""
+        def governed(*args, **kwargs):
+            with self.request():
+                return fn(*args, **kwargs)
+        return governed
+
+    def stats(self):
+        def read(state, now):
+            return {'rate': state['rate'], 'tokens': state['tokens'],
+                    'paused_for': max(0.0, state['paused_until'] - now)}
+        return dict(self._update(read), queue_depth=self.queue_depth, throttles=self.throttles)
+
+
+def governor(name, **options):
+    """Returns the process-wide governor of upstream name, created with options on first use."""
+    with _governors_lock:
+        if name not in _governors:
+            _governors[name] = RateGovernor(name, **options)
+        return _governors[name]
+
+
+def governor_stats():
+    return {name: governor.stats() for name, governor in list(_governors.items())}
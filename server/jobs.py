@@ -0,0 +1,275 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import trace
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+FINISHED = (DONE, FAILED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    total INTEGER,
+    result TEXT,
+    error TEXT,
+    owner TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_checkpoints (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    committed INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (job_id, key)
+);
+CREATE TABLE IF NOT EXISTS job_workers (
+    id TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);
+"""
+
+
+class JobStore:
+    """SQLite persistence for jobs and their per-item checkpoints."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            with self._init_lock:
+                if not self._initialized:
+                    conn.executescript(SCHEMA)
+                    self._initialized = True
+            self._local.conn = conn
+        return conn
+
+    def execute(self, sql, params=()):
+        return self._connection().execute(sql, params)
+
+    def create(self, kind, params, owner=None):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self.execute('INSERT INTO jobs (id, kind, params, status, owner, created_at, updated_at) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)', (job_id, kind, json.dumps(params), QUEUED, owner, now, now))
+        return job_id
+
+    def get(self, job_id):
+        row = self.execute('SELECT id, kind, params, status, done, total, result, error, created_at, updated_at '
+                           'FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {'id': row[0], 'kind': row[1], 'params': json.loads(row[2]), 'status': row[3], 'done': row[4],
+                'total': row[5], 'result': json.loads(row[6]) if row[6] is not None else None, 'error': row[7],
+                'created_at': row[8], 'updated_at': row[9]}
+
+    def update(self, job_id, **fields):
+        if 'params' in fields:
+            fields['params'] = json.dumps(fields['params'])
+        if 'result' in fields:
+            fields['result'] = json.dumps(fields['result'])
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        self.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+
+    def transition(self, job_id, statuses, status, **fields):
+        """Sets job_id's status, and fields, only if it is one of statuses. Returns whether it was."""
+        fields = {'status': status, **fields, 'updated_at': time.time()}
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        cursor = self.execute(f'UPDATE jobs SET {assignments} WHERE id = ? AND status IN '
+                              f'({", ".join("?" for _ in statuses)})', (*fields.values(), job_id, *statuses))
+        return cursor.rowcount == 1
+
+    def drop_params(self, names, finished_before):
+        """Removes the params names from the finished jobs last updated before finished_before."""
+        for name in names:
+            self.execute(f'UPDATE jobs SET params = json_remove(params, ?) WHERE status IN '
+                         f'({", ".join("?" for _ in FINISHED)}) AND updated_at < ?',
+                         (f'$.{name}', *FINISHED, finished_before))
+
+    def heartbeat(self, worker_id):
+        self.execute('INSERT OR REPLACE INTO job_workers (id, heartbeat) VALUES (?, ?)', (worker_id, time.time()))
+
+    def claim_orphans(self, worker_id, alive_after):
+        """Makes worker_id the owner of the queued and running jobs whose owner's last heartbeat was before
+        alive_after, and returns their ids. Concurrent claims never return the same job."""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM job_workers WHERE heartbeat < ?', (alive_after,))
+            rows = conn.execute('SELECT id FROM jobs WHERE status IN (?, ?) AND (owner IS NULL OR owner NOT IN '
+                                '(SELECT id FROM job_workers)) ORDER BY created_at', (QUEUED, RUNNING)).fetchall()
+            job_ids = [row[0] for row in rows]
+            conn.executemany('UPDATE jobs SET owner = ? WHERE id = ?', [(worker_id, job_id) for job_id in job_ids])
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        return job_ids
+
+    def checkpoint(self, job_id, key, value):
+        self.execute('INSERT OR REPLACE INTO job_checkpoints (job_id, key, value) VALUES (?, ?, ?)',
+                     (job_id, key, json.dumps(value)))
+
+    def commit_checkpoints(self, job_id, keys):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('UPDATE job_checkpoints SET committed = 1 WHERE job_id = ? AND key = ?',
+                             [(job_id, key) for key in keys])
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def checkpoints(self, job_id, after=0):
+        """Returns [(seq, key, value, committed)] in the order they were recorded, after seq."""
+        rows = self.execute('SELECT seq, key, value, committed FROM job_checkpoints WHERE job_id = ? AND seq > ? '
+                            'ORDER BY seq', (job_id, after)).fetchall()
+        return [(seq, key, json.loads(value), bool(committed)) for seq, key, value, committed in rows]
+
+
+class Job:
+    """Handle passed to job handlers for reading parameters and recording progress and checkpoints."""
+
+    def __init__(self, store, job_id):
+        self.store = store
+        self.id = job_id
+        self.params = store.get(job_id)['params']
+
+    def update_params(self, **params):
+        self.params.update(params)
+        self.store.update(self.id, params=self.params)
+
+    def progress(self, done, total=None):
+        if total is None:
+            self.store.update(self.id, done=done)
+        else:
+            self.store.update(self.id, done=done, total=total)
+
+    def checkpoint(self, key, value):
+        self.store.checkpoint(self.id, key, value)
+
+    def commit_checkpoints(self, keys):
+        self.store.commit_checkpoints(self.id, keys)
+
+    def checkpoints(self):
+        """Returns {key: (value, committed)} for everything checkpointed so far, including earlier runs."""
+        return {key: (value, committed) for _, key, value, committed in self.store.checkpoints(self.id)}
+
+
+class JobQueue:
+    """Runs registered job handlers on a local worker pool, persisting their state in a JobStore.
+
+    Handlers are called with a Job and return the job's result. A job whose handler raises is marked
+    failed and can be resumed, in which case the handler runs again and can skip checkpointed work.
+
+    The secret_params, like the Spotify access token, are removed from a job's params once it is done,
+    and from failed jobs once they are secret_ttl seconds old, when the token has expired anyway.
+
+    Each queue owns the jobs it runs and records a heartbeat in the store every heartbeat_interval
+    seconds, so the processes sharing a store can tell which jobs were left behind by one that stopped.
+    """
+
+    def __init__(self, store, max_workers=4, secret_params=('token',), secret_ttl=3600, heartbeat_interval=10):
+        self.store = store
+        self.handlers = {}
+        self.secret_params = secret_params
+        self.secret_ttl = secret_ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_id = uuid.uuid4().hex
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._recovering = False
+        self.store.heartbeat(self.worker_id)
+        threading.Thread(target=self._beat, name='job-heartbeat', daemon=True).start()
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def submit(self, kind, **params):
+        if kind not in self.handlers:
+            raise ValueError(f'Unknown job kind: {kind}')
+        self.store.drop_params(self.secret_params, time.time() - self.secret_ttl)
+        job_id = self.store.create(kind, params, owner=self.worker_id)
+        self._pool.submit(self._run, job_id)
+        return job_id
+
+    def resume(self, job_id, **params):
+        """Queues a failed job again, with params updated, e.g. with a fresh token. Returns False when the
+        job does not exist or has not failed: queued and running jobs are already being run, and jobs
+        interrupted by a restart are requeued by recover. Raises ValueError when a secret param the job
+        needs has been dropped and is not given again."""
+        job = self.store.get(job_id)
+        if job is None:
+            return False
+        params = {**job['params'], **{name: value for name, value in params.items() if value is not None}}
+        missing = [name for name in self.secret_params if name not in params]
+        if job['status'] == FAILED and missing:
+            raise ValueError(f'Job {job_id} needs {", ".join(missing)} again to resume')
+        if not self.store.transition(job_id, (FAILED,), QUEUED, error=None, params=json.dumps(params),
+                                     owner=self.worker_id):
+            return False
+        self._pool.submit(self._run, job_id)
+        return True
+
+    def recover(self):
+        """Requeues the jobs that were queued or running in a process that stopped, and keeps doing so with
+        every heartbeat from then on. Each job is taken over by one queue, however many processes share
+        the store. Call it once the handlers are registered."""
+        self._recovering = True
+        job_ids = self.store.claim_orphans(self.worker_id, time.time() - 3 * self.heartbeat_interval)
+        for job_id in job_ids:
+            logger.info(f'Resuming job {job_id}')
+            self._pool.submit(self._run, job_id)
+        return job_ids
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                self.store.heartbeat(self.worker_id)
+                if self._recovering:
+                    self.recover()
+            except Exception:
+                logger.exception('Job heartbeat failed')
+
+    def _run(self, job_id):
+        job = self.store.get(job_id)
+        self.store.update(job_id, status=RUNNING)
+        try:
+            with trace(f"job {job['kind']} {job_id}"):
+                result = self.handlers[job['kind']](Job(self.store, job_id))
+        except Exception as e:
+            logger.exception(f'Job {job_id} failed')
+            self.store.update(job_id, status=FAILED, error=str(e))
+        else:
+            params = {name: value for name, value in self.store.get(job_id)['params'].items()
+                      if name not in self.secret_params}
+            self.store.update(job_id, status=DONE, result=result, params=params)
+
+    def wait(self, job_id, timeout=None, interval=0.05):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.store.get(job_id)
+            if job['status'] in FINISHED or (deadline is not None and time.monotonic() >= deadline):
+                return job
+            time.sleep(interval)
@@ -1,236 +1,507 @@
+import hashlib
 import json
+import os
 from datetime import datetime
-import random
+from functools import lru_cache
 import re
-from pathlib import Path
-
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
-import pandas as pd
-import spotipy
-from tqdm import tqdm
-import logging
-
-logger = logging.getLogger(__name__)
-
-def load_tracks(token, playlist_id):
-    sp = spotipy.Spotify(auth=token)
-
-    if Path(f'playlist-{playlist_id}.pkl').exists():
-        df = pd.read_pickle(f'playlist-{playlist_id}.pkl')
-    else:
-        df = pd.DataFrame()
-
-    items = []
-    offset = 0
-    page = 100
+import time
+import contextvars
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-    results = sp.playlist_tracks(playlist_id=playlist_id)
-    total = results['total']
-
-    for i in tqdm(range(0, total)):
-        if i != 0 and i % page == 0:
-            offset += page
-            results = sp.playlist_tracks(playlist_id=playlist_id, offset=offset)
-
-        item = results['items'][i % page]
-        track = item['track']
-
-        if track['id'] in df.index:
-            continue
-
-        album_images = track['album'].get('images', [])
-        thumbnail_url = album_images[0]['url'] if album_images else None
-
-        d = {'id': track['id'],
-             'uri': track['uri'],
-             'popularity': track['popularity'],
-             'album': track['album']['name'],
-             'artists': [artist['name'] for artist in track['artists']],
-             'artists_id': [artist['id'] for artist in track['artists']],
-             'name': track['name'],
-             'release_date': track['album']['release_date'],
-             'thumbnail_url': thumbnail_url}
-        items.append(d)
-
-    if len(items) > 0:
-        print(f'Adding {len(items)} new tracks')
-        df_new_tracks = pd.DataFrame(items)
-        df_new_tracks.set_index('id', inplace=True)
-        df = pd.concat([df, df_new_tracks])
-
-        df.to_pickle(f'playlist-{playlist_id}.pkl')
-    else:
-        logger.info('No new tracks found')
-        print('No new tracks')
-
-def load_genres(token, playlist_id):
-    sp = spotipy.Spotify(auth=token)
-
-    df = pd.read_pickle(f'playlist-{playlist_id}.pkl')
-    all_artists = df['artists_id'].explode().unique().tolist()
-
-    if Path('artists.pkl').exists():
-        df_artists = pd.read_pickle(f'artists.pkl')
-        existing_artists = set(df_artists.index)
-        all_artists = [artist for artist in all_artists if artist not in existing_artists]
-    else:
-        df_artists = pd.DataFrame()
-
-    total = len(all_artists)
+import logging
 
-    items = []
-    offset = 0
-    page = 50
+from cache import CategorizationCache, categorization_key
+from engine import run_concurrently, chunked, SingleFlight
+from spotify_api import spotify_client, call_spotify, PlaylistWriter
+from store import TrackStore
+from artists import ArtistCache
+from features import FeatureCache
+from genres import cached_genre_summary
+from tokenizer import truncate_to_tokens
+from jobs import JobStore, JobQueue, FINISHED
+from metrics import registry, timed
+from governor import governor
+from parsing import ParseError, find_json, parse_answer, parse_categories
+from llms import LLMRegistry, Prompt
 
-    for i in tqdm(range(0, total)):
-        if i % page == 0:
-            try:
-                results = sp.artists(all_artists[offset:offset+page])
-            except Exception as e:
-                # print(f'Error: {e}')
-                logger.error(f'Error: {e}')
-                break
-            offset += page
-
-        artist = results['artists'][i % page]
-        d = {'id': artist['id'], 'genres': artist['genres'], 'popularity': artist['popularity']}
-        items.append(d)
-
-    if len(items) > 0:
-        print(f'Adding {len(items)} new artists')
-        df_new_artists = pd.DataFrame(items)
-        df_new_artists.set_index('id', inplace=True)
-        df_artists = pd.concat([df_artists, df_new_artists])
-
-        df_artists.to_pickle(f'artists.pkl')
-    else:
-        logger.info('No new artists found')
-        print('No new artists')
+logger = logging.getLogger(__name__)
 
+CATEGORIZE_CONCURRENCY = int(os.environ.get('CATEGORIZE_CONCURRENCY', 8))
+CATEGORIZE_TIMEOUT = float(os.environ.get('CATEGORIZE_TIMEOUT', 120))
+LLM_PROVIDER = os.environ.get('LLM_PROVIDER', 'openai')
+LLM_MODEL = os.environ.get('LLM_MODEL', 'gpt-3.5-turbo')
+CATEGORIZE_MAX_RETRIES = int(os.environ.get('CATEGORIZE_MAX_RETRIES', 5))
+CATEGORIZE_BATCH_SIZE = int(os.environ.get('CATEGORIZE_BATCH_SIZE', 1))
+CATEGORIZE_MODES = ('llm', 'local', 'offline', 'tiered')
+CATEGORIZE_MODE = os.environ.get('CATEGORIZE_MODE', 'llm')
+CATEGORIZE_PROMPTS = ('full', 'compact')
+CATEGORIZE_PROMPT = os.environ.get('CATEGORIZE_PROMPT', 'full')
+COMPACT_REASONING = os.environ.get('COMPACT_REASONING', 'false').lower() == 'true'
+STRUCTURED_OUTPUT = os.environ.get('STRUCTURED_OUTPUT', 'false').lower() == 'true'
+PARSE_MAX_REPROMPTS = int(os.environ.get('PARSE_MAX_REPROMPTS', 1))
+LOCAL_CONFIDENCE_MARGIN = float(os.environ.get('LOCAL_CONFIDENCE_MARGIN', 0.05))
+TIER_OVERLAP_MIN_SCORE = float(os.environ.get('TIER_OVERLAP_MIN_SCORE', 0.5))
+TIER_OVERLAP_MARGIN = float(os.environ.get('TIER_OVERLAP_MARGIN', 0.25))
+TIER_SMALL_MODEL = os.environ.get('TIER_SMALL_MODEL', '')
+TIER_SMALL_MIN_CONFIDENCE = float(os.environ.get('TIER_SMALL_MIN_CONFIDENCE', 0.8))
+GENRE_SUMMARY_TOKENS = int(os.environ.get('GENRE_SUMMARY_TOKENS', 2000))
+INGEST_CONCURRENCY = int(os.environ.get('INGEST_CONCURRENCY', 8))
+INGEST_CHUNK_SIZE = int(os.environ.get('INGEST_CHUNK_SIZE', 1000))
+ARTIST_TTL = float(os.environ.get('ARTIST_TTL', 7 * 24 * 3600))
+ARTIST_CACHE_SIZE = int(os.environ.get('ARTIST_CACHE_SIZE', 200000))
+ARTIST_HOT_CACHE_SIZE = int(os.environ.get('ARTIST_HOT_CACHE_SIZE', 20000))
+PLAYLIST_WRITE_INTERVAL = float(os.environ.get('PLAYLIST_WRITE_INTERVAL', 5))
+PLAYLIST_CREATE_CONCURRENCY = int(os.environ.get('PLAYLIST_CREATE_CONCURRENCY', 8))
+STREAM_HEARTBEAT_INTERVAL = float(os.environ.get('STREAM_HEARTBEAT_INTERVAL', 5))
+STREAM_PROGRESS_INTERVAL = float(os.environ.get('STREAM_PROGRESS_INTERVAL', 1))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 0.5))
+COALESCE_TTL = float(os.environ.get('COALESCE_TTL', 10))
+LLM_RATE = float(os.environ.get('LLM_RATE', 5))
+LLM_MAX_RATE = float(os.environ.get('LLM_MAX_RATE', 50))
+PLAYLIST_TRACK_FIELDS = ('total,items(track(id,uri,name,popularity,album(name,release_date,images),'
+                         'artists(id,name)))')
+# Stands for the user's saved tracks in a list of playlist ids, stored as playlist 'saved:<user id>'
+SAVED_TRACKS = 'saved'
+
+track_store = TrackStore(os.environ.get('TRACK_STORE_PATH', 'tracks.sqlite'))
+
+artist_cache = ArtistCache(track_store, ttl=ARTIST_TTL, max_entries=ARTIST_CACHE_SIZE, hot_size=ARTIST_HOT_CACHE_SIZE)
+
+# Per-playlist feature matrices, rebuilt only when the playlist's tracks, genres or audio features change
+feature_cache = FeatureCache(track_store, max_entries=int(os.environ.get('FEATURE_CACHE_SIZE', 64)),
+                             directory=os.environ.get('FEATURE_CACHE_DIR'))
+
+categorization_cache = CategorizationCache(os.environ.get('CATEGORIZATION_CACHE_PATH', 'categorizations.sqlite'),
+                                           max_entries=int(os.environ.get('CATEGORIZATION_CACHE_SIZE', 100000)))
+
+registry.gauge('playlistgenius_categorization_cache_hit_ratio', 'Share of categorization cache lookups that hit.',
+               lambda: categorization_cache.stats()['hit_rate'])
+registry.gauge('playlistgenius_categorization_cache_lookups', 'Categorization cache lookups by result.',
+               lambda: {'hit': categorization_cache.stats()['hits'], 'miss': categorization_cache.stats()['misses']},
+               label='result')
+registry.gauge('playlistgenius_categorization_cache_entries', 'Entries in the categorization cache.',
+               lambda: len(categorization_cache))
+llm_tokens = registry.counter('playlistgenius_llm_tokens_total', 'LLM tokens used, by kind.')
+llm_calls = registry.counter('playlistgenius_llm_calls_total', 'LLM completions, by model.')
+categorizations = registry.counter('playlistgenius_categorizations_total',
+                                   'Categorized tracks, by the tier that decided them.')
+parse_failures = registry.counter('playlistgenius_llm_parse_failures_total',
+                                  'LLM answers that could not be read as asked, by prompt and cause.')
+reprompts = registry.counter('playlistgenius_llm_reprompts_total',
+                             'Repair prompts sent for unreadable LLM answers, by prompt and result.')
+
+# Concurrent requests for the same playlist share one run, whose result is reused for COALESCE_TTL seconds
+single_flight = SingleFlight(ttl=COALESCE_TTL)
+
+job_queue = JobQueue(JobStore(os.environ.get('JOB_STORE_PATH', 'jobs.sqlite')), max_workers=JOB_WORKERS)
+
+def track_from_item(item):
+    track = item['track']
+
+    # Local files and unavailable tracks have no Spotify id
+    if track is None or track['id'] is None:
+        return None
+
+    album_images = track['album'].get('images', [])
+    thumbnail_url = album_images[0]['url'] if album_images else None
+
+    return {'id': track['id'],
+            'uri': track['uri'],
+            'popularity': track['popularity'],
+            'album': track['album']['name'],
+            'artists': [artist['name'] for artist in track['artists']],
+            'artists_id': [artist['id'] for artist in track['artists']],
+            'name': track['name'],
+            'release_date': track['album']['release_date'],
+            'thumbnail_url': thumbnail_url}
+
+def tracks_from_page(results, offset):
+    tracks = []
+    for i, item in enumerate(results['items']):
+        track = track_from_item(item)
+        if track is not None:
+            track['position'] = offset + i
+            tracks.append(track)
+    return tracks
+
+def fetch_artists(sp, artist_ids):
+    results = call_spotify(sp.artists, artist_ids)
+    return [{'id': artist['id'], 'genres': artist['genres'], 'popularity': artist['popularity']}
+            for artist in results['artists'] if artist is not None]
+
+def fetch_audio_features(sp, track_ids):
+    from enrich import audio_features_frame
+    return audio_features_frame(call_spotify(sp.audio_features, track_ids))
+
+@timed('add_genre_information_to_tracks')
 def add_genre_information_to_tracks(token, playlist_id):
-    sp = spotipy.Spotify(auth=token)
-
-    df = pd.read_pickle(f'playlist-{playlist_id}.pkl')
-    df_artists = pd.read_pickle(f'artists.pkl')
-
-    items = []
-
-    for i, x in tqdm(df.iterrows(), total=len(df)):
-        if 'genres' in x and pd.notna(x['genres']):
-            continue
-
-        genres = set()
-        for artist_id in x['artists_id']:
-            artist = df_artists.loc[artist_id]
-            for genre in artist['genres']:
-                if genre not in genres:
-                    genres.add(genre)
-        items.append({'id': i, 'genres': tuple(genres)})
-
-
-    if len(items) > 0:
-        df_genres = pd.DataFrame(items)
-        df_genres.set_index('id', inplace=True)
-        df = pd.concat([df, df_genres], axis=1)
-
-        df.to_pickle(f'playlist-{playlist_id}.pkl')
-        print(f'Added genre information to {len(items)} tracks')
-        logger.info(f'Added genre information to {len(items)} tracks')
+    from enrich import track_genres
+    track_ids = track_store.tracks_missing_genres(playlist_id)
+    added = 0
+
+    # Chunks bound memory to INGEST_CHUNK_SIZE tracks and their artists, however long the playlist
+    for offset in range(0, len(track_ids), INGEST_CHUNK_SIZE):
+        df = track_store.load_track_artists(track_ids[offset:offset + INGEST_CHUNK_SIZE])
+        artist_ids = {artist_id for artists_id in df['artists_id'] for artist_id in artists_id if artist_id}
+        # Tracks with unfetched artists are left out and retried on the next run
+        genres = track_genres(df, artist_cache.frame(artist_ids))
+        track_store.set_track_genres(genres.to_dict())
+        added += len(genres)
+
+    if added > 0:
+        print(f'Added genre information to {added} tracks')
+        logger.info(f'Added genre information to {added} tracks')
     else:
         logger.info('No genre information added')
         print('No genre information added.')
 
-def get_audio_features_for_tracks(token, playlist_id):
-    sp = spotipy.Spotify(auth=token)
-
-    df = pd.read_pickle(f'playlist-{playlist_id}.pkl')
-    track_ids = df.index.tolist()
-    if 'acousticness' in df.columns:
-        track_ids_with_audio_features = set(df[df['acousticness'].notna()].index)
-        track_ids = [track_id for track_id in track_ids if track_id not in track_ids_with_audio_features]
-
-    total = len(track_ids)
-    offset = 0
-    page = 100
-
-    seen = 0
-    for i in tqdm(range(0, total)):
-        seen = i
-        if i % page == 0:
-            try:
-                results = sp.audio_features(track_ids[offset:offset+page])
-            except Exception as e:
-                # print(f'Error: {e}')
-                logger.error(f'Error: {e}')
-                break
-            offset += page
-
-        audio_features = results[i % page]
-        for feature in ['acousticness',
-                        'danceability',
-                        'duration_ms',
-                        'energy',
-                        'instrumentalness',
-                        'key',
-                        'liveness',
-                        'loudness',
-                        'mode',
-                        'speechiness',
-                        'tempo',
-                        'time_signature',
-                        'valence']:
-            df.loc[audio_features['id'], feature] = audio_features[feature]
-
-    if seen > 0:
-        print(f'Adding {i} new audio features')
-        df.to_pickle(f'playlist-{playlist_id}.pkl')
+@timed('ingest_playlist')
+def ingest_playlist(token, playlist_id, max_workers=None, incremental=True):
+    """Fetches a playlist with its artists and audio features in one pipelined pass.
+
+    Playlist pages are fetched concurrently once the total is known, with at most twice max_workers
+    requests in flight so fetched pages never pile up in memory. As each page arrives its tracks are stored,
+    and artist ids and track ids not in the store yet are queued into 50-id artist and
+    100-id audio-feature batches fetched on the same pool and Spotify client.
+
+    With incremental set, the playlist's snapshot_id is compared with the one recorded by the last
+    complete sync and the pages are not fetched at all when it has not changed. After a complete
+    sync, tracks that are no longer in the playlist are removed from it in the store.
+
+    A playlist id of 'saved:<user id>' ingests the user's saved tracks, which have no snapshot_id and
+    are always fetched.
+    """
+    from tqdm import tqdm
+    sp = spotify_client(token)
+    saved = playlist_id.startswith(f'{SAVED_TRACKS}:')
+    page = 50 if saved else 100
+    max_workers = max_workers or INGEST_CONCURRENCY
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {}
+    page_offsets = deque()
+    pending_artists, pending_tracks = [], []
+    queued_artists = set()
+    seen_tracks = set()
+    failed_pages = 0
+    counts = {'tracks': 0, 'artists': 0, 'audio_features': 0, 'removed': 0}
+
+    def submit(kind, fn, batch):
+        futures[pool.submit(fn, sp, batch)] = (kind, batch)
+
+    def queue_batches(flush=False):
+        while len(pending_artists) >= 50 or (flush and pending_artists):
+            batch = pending_artists[:50]
+            del pending_artists[:50]
+            submit('artists', fetch_artists, batch)
+        while len(pending_tracks) >= 100 or (flush and pending_tracks):
+            batch = pending_tracks[:100]
+            del pending_tracks[:100]
+            submit('audio_features', fetch_audio_features, batch)
+
+    def queue_pages():
+        # New pages wait for the pool to drain, so neither pages nor the artist and audio-feature
+        # batches they queue pile up in memory faster than they are stored
+        while page_offsets and len(futures) < 2 * max_workers:
+            offset = page_offsets.popleft()
+            futures[pool.submit(fetch_page, offset)] = ('page', offset)
+        return bool(page_offsets) or any(kind == 'page' for kind, _ in futures.values())
+
+    def fetch_page(offset):
+        if saved:
+            return call_spotify(sp.current_user_saved_tracks, offset=offset, limit=page)
+        return call_spotify(sp.playlist_tracks, playlist_id=playlist_id, fields=PLAYLIST_TRACK_FIELDS,
+                            offset=offset, limit=page)
+
+    def handle_page(results, offset):
+        tracks = tracks_from_page(results, offset)
+        track_store.upsert_tracks(playlist_id, tracks)
+        counts['tracks'] += len(tracks)
+
+        artist_ids = {artist_id for track in tracks for artist_id in track['artists_id']} - queued_artists
+        queued_artists.update(artist_ids)
+        pending_artists.extend(artist_cache.missing(artist_ids))
+
+        track_ids = [track['id'] for track in tracks]
+        seen_tracks.update(track_ids)
+        existing = track_store.existing_audio_feature_ids(track_ids)
+        pending_tracks.extend(track_id for track_id in track_ids if track_id not in existing)
+        queue_batches()
+
+    if saved:
+        snapshot_id, name = None, 'Saved tracks'
     else:
-        print('No new audio features')
-        logger.info('No new audio features')
-
-def create_shuffled_list_of_genres(playlist_id):
-    df = pd.read_pickle(f'playlist-{playlist_id}.pkl')
-    genres_list = (df[df['genres'].apply(lambda x: len(x) > 0)]['genres']).apply(lambda x: ", ".join(x)).tolist()
-    random.seed(0)
-    random.shuffle(genres_list)
-    genres_text = "\n".join(genres_list)
-    return genres_text
-
-prompt_categories = PromptTemplate.from_template(
+        playlist = call_spotify(sp.playlist, playlist_id, fields='name,snapshot_id')
+        snapshot_id, name = playlist['snapshot_id'], playlist.get('name')
+    if name != track_store.playlist_name(playlist_id):
+        track_store.set_playlist_name(playlist_id, name)
+    unchanged = incremental and snapshot_id is not None and snapshot_id == track_store.snapshot_id(playlist_id)
+
+    try:
+        if unchanged:
+            logger.info(f'Playlist {playlist_id} unchanged since snapshot {snapshot_id}')
+            # Still fill in what an interrupted sync left without artists or audio features
+            pending_artists.extend(track_store.missing_artist_ids(playlist_id))
+            pending_tracks.extend(track_store.tracks_missing_audio_features(playlist_id))
+            total = 0
+        else:
+            first = fetch_page(0)
+            total = first['total']
+            page_offsets.extend(range(page, total, page))
+            handle_page(first, 0)
+
+        with tqdm(total=total) as progress:
+            progress.update(min(page, total))
+            while True:
+                # Once every page is in, flush the partial batches
+                if not queue_pages():
+                    queue_batches(flush=True)
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, args = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # Rate limits were already retried, a failed page leaves tracks for the next sync
+                        logger.error(f'Error fetching {kind}: {e}')
+                        failed_pages += kind == 'page'
+                        continue
+                    if kind == 'page':
+                        handle_page(result, args)
+                        progress.update(len(result['items']))
+                    elif kind == 'artists':
+                        artist_cache.put_many(result)
+                        counts['artists'] += len(result)
+                    else:
+                        track_store.upsert_audio_features(result)
+                        counts['audio_features'] += len(result)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    # Only a complete listing tells which tracks were removed and makes the snapshot safe to skip
+    if not unchanged and not failed_pages:
+        counts['removed'] = track_store.prune_playlist(playlist_id, seen_tracks)
+        track_store.set_snapshot_id(playlist_id, snapshot_id)
+    single_flight.forget(('total_tracks', playlist_id))
+
+    # Artists fetched longer than ARTIST_TTL ago are served as they are and refetched in the background.
+    # An unchanged playlist is not even read for them, so its sync stays a single Spotify call
+    if not unchanged:
+        artist_cache.refresh(track_store.artist_ids(playlist_id), lambda batch: fetch_artists(sp, batch))
+
+    logger.info(f'Ingested playlist {playlist_id}: {counts}')
+    return counts
+
+def sync_playlist(token, playlist_id):
+    """Ingests the playlist and adds genre information to its tracks.
+
+    A library made by create_library is synced by syncing each of its playlists and merging their tracks,
+    so a track in several of them is stored, enriched and categorized once.
+
+    Concurrent syncs of the same playlist share one run, and a sync that finished less than
+    COALESCE_TTL seconds ago is not repeated.
+    """
+    def sync():
+        sources = track_store.library_sources(playlist_id)
+        if sources is not None:
+            return sync_library(token, playlist_id, sources)
+        counts = ingest_playlist(token, playlist_id)
+        add_genre_information_to_tracks(token, playlist_id)
+        return counts
+    return single_flight.do(('sync', playlist_id), sync)
+
+def sync_library(token, library_id, sources):
+    for source in sources:
+        sync_playlist(token, source)
+    unique, total = track_store.merge_playlists(library_id, sources)
+    names = [track_store.playlist_name(source) or source for source in sources]
+    track_store.set_playlist_name(library_id, ' + '.join(names[:2]) +
+                                  (f' + {len(names) - 2} more' if len(names) > 2 else ''))
+    single_flight.forget(('total_tracks', library_id))
+    logger.info(f'Synced library {library_id}: {unique} unique tracks of {total} in {len(sources)} playlists')
+    return {'tracks': unique, 'duplicates': total - unique, 'playlists': len(sources)}
+
+def create_library(token, playlist_ids):
+    """Returns the id to categorize the union of playlist_ids under, where SAVED_TRACKS stands for the
+    user's saved tracks. Several playlists are recorded as a library in the track store, which
+    sync_playlist fills with their tracks, de-duplicated."""
+    sources = list(dict.fromkeys(playlist_id.strip() for playlist_id in playlist_ids if playlist_id.strip()))
+    if SAVED_TRACKS in sources:
+        user_id = call_spotify(spotify_client(token).current_user)['id']
+        sources[sources.index(SAVED_TRACKS)] = f'{SAVED_TRACKS}:{user_id}'
+    if len(sources) == 1:
+        return sources[0]
+    library_id = 'library:' + hashlib.sha1(','.join(sorted(sources)).encode('utf-8')).hexdigest()[:16]
+    if track_store.library_sources(library_id) is None:
+        track_store.set_library(library_id, sources, f'{len(sources)} playlists')
+    return library_id
+
+def playlist_categories(token, playlist_id, num_categories):
+    """Syncs the playlist and asks for num_categories categories of it, sharing the run with concurrent
+    requests for the same playlist and number of categories."""
+    def categories():
+        sync_playlist(token, playlist_id)
+        return get_categories(num_categories, summarize_genres(playlist_id))
+    return single_flight.do(('categories', playlist_id, str(num_categories)), categories)
+
+def playlist_is_stale(token, playlist_id):
+    """Tells whether playlist_id changed on Spotify since its last complete sync, with one Spotify call per
+    playlist, and raises PermissionError when token cannot read it.
+
+    Saved tracks have no snapshot_id, so they are only checked to belong to the token's user and are
+    stale until first synced. A library is stale when any of its playlists is.
+    """
+    sources = track_store.library_sources(playlist_id)
+    if sources is not None:
+        # Every source is checked, so a library never shows a playlist the token cannot read
+        stale = [playlist_is_stale(token, source) for source in sources]
+        return any(stale) or track_store.count_tracks(playlist_id) == 0
+    sp = spotify_client(token)
+    if playlist_id.startswith(f'{SAVED_TRACKS}:'):
+        if call_spotify(sp.current_user)['id'] != playlist_id[len(SAVED_TRACKS) + 1:]:
+            raise PermissionError(f'The token cannot read the saved tracks of {playlist_id}')
+        return track_store.count_tracks(playlist_id) == 0
+    try:
+        snapshot_id = call_spotify(sp.playlist, playlist_id, fields='snapshot_id')['snapshot_id']
+    except Exception as e:
+        # Spotify answers 404 for a private playlist the token cannot read
+        if getattr(e, 'http_status', None) in (401, 403, 404):
+            raise PermissionError(f'The token cannot read playlist {playlist_id}') from e
+        raise
+    return snapshot_id != track_store.snapshot_id(playlist_id)
+
+@timed('playlist_preview')
+def playlist_preview(token, playlist_id):
+    """Returns the playlist's genre histogram, audio feature distributions and suggested numbers of
+    categories, read from its feature matrix without any LLM call. The playlist is synced first only when
+    playlist_is_stale, which also raises PermissionError when token cannot read it."""
+    if playlist_is_stale(token, playlist_id):
+        sync_playlist(token, playlist_id)
+    preview = feature_cache.get(playlist_id).preview()
+    preview['playlist_name'] = track_store.playlist_name(playlist_id)
+    return preview
+
+@timed('summarize_genres')
+def summarize_genres(playlist_id, token_budget=None):
+    genres = feature_cache.get(playlist_id).genre_lists()
+    return cached_genre_summary(playlist_id, genres, token_budget or GENRE_SUMMARY_TOKENS, LLM_MODEL)
+
+prompt_categories = Prompt(
     "I have a list of songs, each with one or more genres associated with it. Based on these genres, I would like you "
     "to analyze the list and create {num_categories} distinct categories that these songs could be grouped into. Each "
     "category should represent a unique theme or commonality found within the genres. Please provide a brief "
     "description for each category to explain the common theme or elements that define it.\nPlease output each "
-    "category using the following format:\n[[NUMBER]]. **[[TITLE]]**: [[DESCRIPTION]]\n\nHere is the list of songs and "
-    "their associated genres:\n\n{genres_text}\n\n"
+    "category using the following format:\n[[NUMBER]]. **[[TITLE]]**: [[DESCRIPTION]]\n\nHere are the songs' genres, "
+    "with the number of songs for each genre and genre combination:\n\n{genres_text}\n\n"
     "Remember, the categories must be exactly {num_categories}."
 )
-llm = ChatOpenAI(model_name='gpt-3.5-turbo', temperature=0)
-chain_categories = LLMChain(llm=llm, prompt=prompt_categories, verbose=True)
+class TokenUsageHandler:
+    """Counts the prompt and completion tokens OpenAI reports for each completion."""
+
+    def on_llm_end(self, response, **kwargs):
+        llm_output = response.llm_output or {}
+        usage = llm_output.get('token_usage') or {}
+        llm_calls.inc(model=llm_output.get('model_name', ''))
+        llm_tokens.inc(usage.get('prompt_tokens', 0), kind='prompt')
+        llm_tokens.inc(usage.get('completion_tokens', 0), kind='completion')
+
+# Clients and chains are only built when first run, LLM_PROVIDER can name a provider registered in llms.py
+# The client leaves rate limits to the governor, which paces every chain in the process and retries their 429s
+llm_governor = governor('llm', rate=LLM_RATE, max_rate=LLM_MAX_RATE, path=os.environ.get('RATE_LIMIT_STATE_PATH'))
+llms = LLMRegistry(LLM_PROVIDER, LLM_MODEL, on_llm_end=TokenUsageHandler().on_llm_end, governor=llm_governor,
+                   rate_limit_retries=CATEGORIZE_MAX_RETRIES, request_timeout=CATEGORIZE_TIMEOUT, max_retries=0)
+# With STRUCTURED_OUTPUT, the prompts ask for JSON answers, which are read without guessing at their layout
+prompt_categories_json = Prompt(prompt_categories.template.replace(
+    "Please output each category using the following format:\n[[NUMBER]]. **[[TITLE]]**: [[DESCRIPTION]]",
+    "Please output the categories as a JSON array and nothing else, with one object per category that has the "
+    "keys \"category_number\", \"category_name\" and \"description\".", 1))
+
+chain_categories = llms.chain(prompt_categories)
+chain_categories_json = llms.chain(prompt_categories_json)
+
+# Unreadable answers are sent back with a request for only what could not be read, instead of asking again
+prompt_repair = Prompt("This answer could not be read:\n\n{output}\n\n{request} Reply with JSON only, like this: {schema}")
+
+chain_repair = llms.chain(prompt_repair)
+
+CATEGORIES_SCHEMA = '[{"category_number": <number>, "category_name": "<name>", "description": "<description>"}]'
+
+def with_repairs(prompt, output, read, request):
+    """Returns read(output), re-prompting up to PARSE_MAX_REPROMPTS times while it raises ParseError.
+    request(error) returns the repair prompt's request and schema. Failures are counted by cause."""
+    for attempt in range(PARSE_MAX_REPROMPTS + 1):
+        try:
+            result = read(output)
+        except ParseError as e:
+            parse_failures.inc(prompt=prompt, cause=e.cause)
+            if attempt == PARSE_MAX_REPROMPTS:
+                if attempt:
+                    reprompts.inc(prompt=prompt, result='failed')
+                logger.error(f"ParseError ({e.cause}): {e}")
+                raise
+            request_text, schema = request(e)
+            logger.warning(f'Unreadable {prompt} answer ({e.cause}), asking for {", ".join(e.missing) or "it"} again')
+            output = chain_repair.run(output=output, request=request_text, schema=schema)
+            continue
+        if attempt:
+            reprompts.inc(prompt=prompt, result='recovered')
+        return result
+
+def read_categories(output):
+    """Reads the categories in output, re-prompting for the whole list when none can be read and for the
+    names and descriptions that are missing."""
+    categories = with_repairs('categories', output, parse_categories,
+                              lambda e: ('Rewrite it as the list of categories it describes.', CATEGORIES_SCHEMA))
+
+    incomplete = [category['category_number'] for category in categories
+                  if category['category_name'] is None or category['description'] is None]
+    if incomplete:
+        parse_failures.inc(prompt='categories', cause='missing_field')
+    if incomplete and PARSE_MAX_REPROMPTS:
+        numbers = ', '.join(str(number) for number in incomplete)
+        try:
+            repaired = parse_categories(chain_repair.run(
+                output=output, request=f'Give the name and a one-sentence description of categories {numbers}.',
+                schema=CATEGORIES_SCHEMA))
+        except ParseError as e:
+            parse_failures.inc(prompt='categories', cause=e.cause)
+            repaired = []
+        filled = {category['category_number']: category for category in repaired}
+        for category in categories:
+            for field in ('category_name', 'description'):
+                if category[field] is None:
+                    category[field] = filled.get(category['category_number'], {}).get(field)
+        complete = all(category['category_name'] is not None and category['description'] is not None
+                       for category in categories)
+        reprompts.inc(prompt='categories', result='recovered' if complete else 'failed')
+    for category in categories:
+        category['category_name'] = category['category_name'] or f"Category {category['category_number']}"
+        category['description'] = category['description'] or ''
+    return categories
 
+@timed('get_categories')
 def get_categories(num_categories, genres_text):
     # print(f'length of genres_text: {len(genres_text)}')
     # print(f'Genres text: {genres_text}')
-    categories_output = chain_categories.run(num_categories=num_categories, genres_text=genres_text[:50000])
+    genres_text = truncate_to_tokens(genres_text, GENRE_SUMMARY_TOKENS, LLM_MODEL)
+    chain = chain_categories_json if STRUCTURED_OUTPUT else chain_categories
+    categories_output = chain.run(num_categories=num_categories, genres_text=genres_text)
 
     print(categories_output)
 
-    # Updated regex pattern to ensure entire descriptions are captured
-    pattern = r"(\d+)\.\s*([^:]+):\s*((?:.(?!\n\s*\d+\.))+.)"
-    matches = re.findall(pattern, categories_output, re.DOTALL)
-
-    categories = {int(num): (name.strip(), desc.strip()) for num, name, desc in matches}
-
-    data = [{'category_number': category_number,
-             'category_name': category_name,
-             'description': description
-             } for category_number, (category_name, description) in categories.items()]
+    data = read_categories(categories_output)
+    if str(len(data)) != str(num_categories):
+        parse_failures.inc(prompt='categories', cause='count_mismatch')
+        logger.warning(f'Asked for {num_categories} categories, got {len(data)}')
 
     return data
 
-prompt_categorize = PromptTemplate.from_template(
+prompt_categorize = Prompt(
     """Given a list of categories and their descriptions, please determine which category the following song fits best into. Use the song's genres, along with any other relevant information provided, to make your decision. After making your decision, structure your response as follows: Start with "Category number:" followed by the number of the category. Then, on a new line, write "Category name:" followed by the name of the category. Then, on a new line, write "Reasoning:" followed by a brief explanation of why the song fits best in the chosen category. Here are the categories:
 
 {categories_output}
@@ -260,152 +531,774 @@ Song Information:
 Based on the genres listed and any other information you deem relevant from the song information provided, which of the categories does "{name}" by {artists} fit best into? Please explain your reasoning.""",
 )
 
+prompt_categorize_json = Prompt(prompt_categorize.template.replace(
+    'structure your response as follows: Start with "Category number:" followed by the number of the category. '
+    'Then, on a new line, write "Category name:" followed by the name of the category. Then, on a new line, write '
+    '"Reasoning:" followed by a brief explanation of why the song fits best in the chosen category.',
+    'respond with JSON only, in this form: {{"category_number": <number>, "category_name": "<name>", '
+    '"reasoning": "<a brief explanation of why the song fits best in the chosen category>"}}.', 1))
+
 def format_categories(categories):
     categories_output = "\n\n".join([f"{category['category_number']}. {category['category_name']}: {category['description']}" for category in categories])
     return categories_output
 
-chain_categorize = LLMChain(llm=llm, prompt=prompt_categorize, verbose=True)
+chain_categorize = llms.chain(prompt_categorize)
+chain_categorize_json = llms.chain(prompt_categorize_json)
+@timed('categorize_track')
 def categorize_track(categories_output, track):
-    output = chain_categorize.run(categories_output=categories_output,
-                       name=track['name'],
-                       artists=", ".join(track['artists']),
-                       album=track['album'],
-                       release_date=track['release_date'],
-                       genres=track['genres'],
-                       popularity=track['popularity'],
-                       danceability=track['danceability'],
-                       energy=track['energy'],
-                       key=track['key'],
-                       loudness=track['loudness'],
-                       mode=track['mode'],
-                       speechiness=track['speechiness'],
-                       acousticness=track['acousticness'],
-                       instrumentalness=track['instrumentalness'],
-                       liveness=track['liveness'],
-                       valence=track['valence'],
-                       tempo=track['tempo'],
-                       duration_ms=track['duration_ms'],
-                       time_signature=track['time_signature'])
-
-    pattern = r"Category number: (\d+)\s+Category name: ([\w\s]+)\s+Reasoning: (.+)"
-    # Search for the pattern in the LLM output
-    match = re.search(pattern, output, re.DOTALL)
-
-    if match:
-        # Extract the category number, name, and reasoning from the match
-        category_number = int(match.group(1))
-        category_name = match.group(2).strip()
-        reasoning = match.group(3).strip()
-
-        return category_number, category_name, reasoning
+    key = track_cache_key(categories_output, track)
+    answer = categorization_cache.get(key)
+    if answer is None:
+        answer = ask_categorize_track(categories_output, track)
+        categorization_cache.put(key, answer)
+    return answer
+
+def track_cache_key(categories_output, track):
+    payload = format_track_compact(track) if CATEGORIZE_PROMPT == 'compact' else format_track(track)
+    return categorization_key(categories_output, payload, LLM_MODEL)
+
+def track_prompt_values(track):
+    return dict(name=track['name'],
+                artists=", ".join(track['artists']),
+                album=track['album'],
+                release_date=track['release_date'],
+                genres=track['genres'],
+                popularity=track['popularity'],
+                danceability=track['danceability'],
+                energy=track['energy'],
+                key=track['key'],
+                loudness=track['loudness'],
+                mode=track['mode'],
+                speechiness=track['speechiness'],
+                acousticness=track['acousticness'],
+                instrumentalness=track['instrumentalness'],
+                liveness=track['liveness'],
+                valence=track['valence'],
+                tempo=track['tempo'],
+                duration_ms=track['duration_ms'],
+                time_signature=track['time_signature'])
+
+@timed('llm_categorize_track')
+def ask_categorize_track(categories_output, track):
+    if CATEGORIZE_PROMPT == 'compact':
+        output = chain_categorize_compact.run(header=compact_header(categories_output, COMPACT_REASONING),
+                                              song=format_track_compact(track))
+        return read_category_answer('categorize_compact', output, categories_output,
+                                    lambda output: parse_compact_answer(output, categories_output))
+
+    chain = chain_categorize_json if STRUCTURED_OUTPUT else chain_categorize
+    output = chain.run(categories_output=categories_output, **track_prompt_values(track))
+
+    return read_category_answer('categorize', output, categories_output)
+
+def parse_category_answer(output):
+    # Reads JSON answers as well as "Category number:" lines, tolerating markdown emphasis, punctuation in
+    # category names and a missing reasoning line
+    answer = parse_answer(output)
+    return answer['category_number'], answer['category_name'] or '', answer['reasoning'] or ''
+
+def read_category_answer(prompt, output, categories_output, parse=parse_category_answer):
+    """Reads a categorization answer with parse, checking its category number against categories_output and
+    filling a missing category name in from them. A missing or unknown category number is asked for with a
+    repair prompt that sends the answer back, rather than by categorizing the track again."""
+    names = category_names(categories_output)
+    repaired = {}
+
+    def read(output):
+        category_number, category_name, reasoning = parse(output)
+        if names and category_number not in names:
+            raise ParseError(f'Unknown category number {category_number} in LLM output', 'unknown_category',
+                             missing=['category_number'], partial={'reasoning': reasoning})
+        if repaired:
+            # A repaired answer only has the number, the name comes from the categories
+            category_name, reasoning = '', reasoning or repaired['reasoning']
+        return category_number, category_name or names.get(category_number, ''), reasoning
+
+    def request(error):
+        repaired.setdefault('reasoning', error.partial.get('reasoning') or '')
+        choices = ', '.join(f'{number}. {name}' for number, name in names.items())
+        return (f'Which category number does it choose? The categories are: {choices}.' if names else
+                'Which category number does it choose?'), '{"category_number": <number>}'
+
+    return with_repairs(prompt, output, read, request)
+
+# The cheap model of the tiered mode answers like chain_categorize and also rates how sure it is
+prompt_categorize_small = Prompt(prompt_categorize.template.replace(
+    " Here are the categories:",
+    " Finally, on a new line, write \"Confidence:\" followed by a number between 0 and 1 saying how sure you are "
+    "of the category. Here are the categories:", 1))
+
+chain_categorize_small = llms.chain(prompt_categorize_small, TIER_SMALL_MODEL) if TIER_SMALL_MODEL else None
+
+@timed('small_categorize_track')
+def ask_small_model(categories_output, track):
+    """Categorizes the track with the cheap model. Returns (category_number, category_name, reasoning,
+    confidence), where a missing or unreadable confidence counts as 0."""
+    key = categorization_key(categories_output, format_track(track), TIER_SMALL_MODEL)
+    answer = categorization_cache.get(key)
+    if answer is None:
+        output = chain_categorize_small.run(categories_output=categories_output, **track_prompt_values(track))
+        try:
+            fields = parse_answer(output)
+        except ParseError as e:
+            # Not repaired, the track is escalated to the full model instead
+            parse_failures.inc(prompt='categorize_small', cause=e.cause)
+            raise
+        answer = (fields['category_number'], fields['category_name'] or '', fields['reasoning'] or '',
+                  fields['confidence'] or 0.0)
+        categorization_cache.put(key, answer)
+    return answer
+
+prompt_categorize_batch = Prompt(
+    """Given a list of categories and their descriptions, please determine which category each of the following songs fits best into. Use each song's genres, along with any other relevant information provided, to make your decision. Here are the categories:
+
+{categories_output}
+
+Songs:
+
+{songs}
+
+Respond with a JSON array containing exactly one object per song, in the same order, and nothing else. Each object must have the keys "song" (the song number), "category_number", "category_name" and "reasoning" (a brief explanation of why the song fits best in the chosen category). For example:
+[{{"song": 1, "category_number": 2, "category_name": "Example", "reasoning": "..."}}]""",
+)
+
+chain_categorize_batch = llms.chain(prompt_categorize_batch)
+
+def format_track(track):
+    return (f"    Name: {track['name']}\n"
+            f"    Artists: {', '.join(track['artists'])}\n"
+            f"    Album: {track['album']}\n"
+            f"    Release Date: {track['release_date']}\n"
+            f"    Genres: {track['genres']}\n"
+            f"    Popularity: {track['popularity']}\n"
+            f"    Danceability: {track['danceability']}\n"
+            f"    Energy: {track['energy']}\n"
+            f"    Key: {track['key']}\n"
+            f"    Loudness: {track['loudness']}\n"
+            f"    Mode: {track['mode']}\n"
+            f"    Speechiness: {track['speechiness']}\n"
+            f"    Acousticness: {track['acousticness']}\n"
+            f"    Instrumentalness: {track['instrumentalness']}\n"
+            f"    Liveness: {track['liveness']}\n"
+            f"    Valence: {track['valence']}\n"
+            f"    Tempo: {track['tempo']}\n"
+            f"    Duration MS: {track['duration_ms']}\n"
+            f"    Time Signature: {track['time_signature']}")
+
+# The compact prompt starts with a header that only depends on the categories, so it is rendered once per
+# categorization and every track's prompt shares it as a prefix the API can cache
+prompt_categorize_compact = Prompt("{header}\nSong: {song}")
+
+chain_categorize_compact = llms.chain(prompt_categorize_compact)
+
+@lru_cache(maxsize=32)
+def compact_header(categories_output, reasoning=False):
+    answer = '{"category": <number>, "reason": "<a few words>"}' if reasoning else '{"category": <number>}'
+    return (f"Pick the category the song fits best, mostly by its genres. Reply with JSON only: {answer}\n\n"
+            f"Categories:\n{categories_output.replace('*', '')}\n")
+
+def bucket(value, cuts=(0.33, 0.67), labels=('low', 'mid', 'high')):
+    for cut, label in zip(cuts, labels):
+        if value < cut:
+            return label
+    return labels[-1]
+
+def format_track_compact(track):
+    """One line per song: name, artists, year and genres, with the audio features that tell genres apart
+    bucketed into words. Key, mode, loudness, liveness, duration and time signature are left out."""
+    import pandas as pd
+    year = str(track['release_date'] or '')[:4]
+    genres = ', '.join(track['genres']) if track['genres'] is not None and len(track['genres']) else 'unknown'
+    features = []
+    for feature in ('energy', 'danceability', 'valence', 'acousticness', 'instrumentalness', 'speechiness'):
+        value = track.get(feature)
+        if value is not None and not pd.isna(value):
+            features.append(f'{feature} {bucket(float(value))}')
+    tempo = track.get('tempo')
+    if tempo is not None and not pd.isna(tempo):
+        features.append(f"tempo {bucket(float(tempo), (90, 130), ('slow', 'medium', 'fast'))}")
+    line = f"{track['name']} by {', '.join(track['artists'])}" + (f' ({year})' if year else '')
+    return f"{line} | genres: {genres}" + (f" | {', '.join(features)}" if features else '')
+
+def category_names(categories_output):
+    return {int(number): name.strip(' *') for number, name in
+            re.findall(r"^\s*(\d+)\.\s*([^:\n]+):", categories_output, re.MULTILINE)}
+
+def parse_compact_answer(output, categories_output):
+    """Reads {"category": N} answers, falling back to the full prompt's format or a bare number."""
+    bare = re.fullmatch(r"\W*(\d+)\W*", output)
+    if bare:
+        category_number, reasoning = int(bare.group(1)), ''
     else:
-        logger.error("ValueError : Failed to extract category information from LLM output")
-        raise ValueError("Failed to extract category information from LLM output")
+        answer = parse_answer(output)
+        category_number, reasoning = answer['category_number'], answer['reasoning'] or ''
+    return category_number, category_names(categories_output).get(category_number, ''), reasoning
+
+def parse_batch_answer(output, size, numbers=None):
+    """Returns {song number: (category_number, category_name, reasoning)} for every song in the
+    batch answer that could be parsed. Songs that are missing or malformed are left out, and so are
+    songs whose category number is not one of numbers, when given."""
+    answers = {}
+
+    try:
+        items = find_json(output, '[')
+    except ParseError as e:
+        parse_failures.inc(prompt='categorize_batch', cause=e.cause)
+        items = []
+    if not isinstance(items, list):
+        items = []
+
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            song = int(item['song'])
+            category_number = int(item['category_number'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 1 <= song <= size:
+            answers[song] = (category_number,
+                             str(item.get('category_name') or '').strip(' *'),
+                             str(item.get('reasoning') or '').strip())
+
+    if not answers:
+        # Fall back to "Song N ... Category number: ..." blocks when the model ignored the JSON format
+        blocks = re.split(r"^\W*Song\s+(\d+)\W*$", output, flags=re.MULTILINE | re.IGNORECASE)
+        for song, block in zip(blocks[1::2], blocks[2::2]):
+            try:
+                answer = parse_category_answer(block)
+            except ValueError:
+                continue
+            if 1 <= int(song) <= size:
+                answers[int(song)] = answer
+
+    if numbers:
+        for song, answer in list(answers.items()):
+            if answer[0] not in numbers:
+                parse_failures.inc(prompt='categorize_batch', cause='unknown_category')
+                del answers[song]
+
+    return answers
+
+@timed('categorize_batch')
+def categorize_batch(categories_output, tracks):
+    """Categorizes several tracks with a single LLM call. Returns a list of (track, result, error) in the
+    order of tracks. Cached tracks are not sent, and tracks missing from or malformed in the batch answer,
+    including answers naming a category that does not exist, are re-asked one at a time."""
+    names = category_names(categories_output)
+    keys = [track_cache_key(categories_output, track) for track in tracks]
+    answers = {i: categorization_cache.get(key) for i, key in enumerate(keys, start=1)}
+    uncached = [i for i, answer in answers.items() if answer is None]
+
+    if uncached:
+        songs = "\n\n".join(f"Song {n}:\n{format_track(tracks[i - 1])}" for n, i in enumerate(uncached, start=1))
+        output = chain_categorize_batch.run(categories_output=categories_output, songs=songs)
+        batch_answers = parse_batch_answer(output, len(uncached), names)
+        for n, i in enumerate(uncached, start=1):
+            if n in batch_answers:
+                answers[i] = batch_answers[n]
+                categorization_cache.put(keys[i - 1], batch_answers[n])
+
+    results = []
+    for i, track in enumerate(tracks, start=1):
+        if answers[i] is not None:
+            results.append((track, answers[i], None))
+            continue
+        logger.warning(f'Batch answer missing song {i}, re-asking')
+        parse_failures.inc(prompt='categorize_batch', cause='missing_song')
+        try:
+            answer = ask_categorize_track(categories_output, track)
+            categorization_cache.put(keys[i - 1], answer)
+            results.append((track, answer, None))
+        except Exception as e:
+            results.append((track, None, e))
 
+    return results
+
+@timed('generate_spotify_playlists')
 def generate_spotify_playlists(token, playlist_id, categories):
-    sp = spotipy.Spotify(auth=token)
+    sp = spotify_client(token)
 
     print('Creating playlists')
-    user_id = sp.current_user()['id']
-    playlist_nane = sp.playlist(playlist_id)['name']
-    for category in categories:
+    user_id = call_spotify(sp.current_user)['id']
+    # Names are recorded when a playlist is synced, a library has no Spotify playlist to ask
+    playlist_nane = track_store.playlist_name(playlist_id) or call_spotify(sp.playlist, playlist_id)['name']
+
+    def create_playlist(category):
         category_name = category['category_name'].replace('*', '')
         description = re.sub(r'\n+', ' ', category['description'])[:512]
         category['category_number'] = str(category['category_number'])
 
         timestamp = datetime.now().isoformat()[:16].replace(':', '')
         playlist_name = f"{playlist_nane} - {category_name.replace('*', '')}_{timestamp}"
-        result = sp.user_playlist_create(user=user_id,
-                                         name=playlist_name,
-                                         public=False,
-                                         description=description)
+        result = call_spotify(sp.user_playlist_create, user=user_id,
+                              name=playlist_name,
+                              public=False,
+                              description=description)
         created_playlist_id = result['id']
         category['playlist_id'] = created_playlist_id
 
-    return categories
-
-def categorize_tracks(token, playlist_id, categories):
-    sp = spotipy.Spotify(auth=token)
+    # The playlists are created concurrently, each category dict is filled in by its own call
+    for _, _, error in run_concurrently(create_playlist, categories, max_workers=PLAYLIST_CREATE_CONCURRENCY):
+        if error is not None:
+            raise error
 
-    categories_output = format_categories(categories)
-    df = pd.read_pickle(f'playlist-{playlist_id}.pkl')
-    categorized_tracks = []
+    return categories
 
-    for i, track in tqdm(df.iterrows(), total=len(df)):
-        try:
-            category_number, category_name, reasoning = categorize_track(categories_output, track)
-        except ValueError as e:
-            logger.error(f'Error: {e}')
-            print(f'Error: {e}')
+def categorize_dataframe(categories_output, df, max_workers=None, timeout=None, batch_size=None, on_error=None):
+    """Categorizes every track in df concurrently, yielding (track, category_number, category_name, reasoning,
+    tier) as results complete, where tier is 'llm'. With batch_size > 1, each LLM call classifies batch_size
+    tracks at once. Tracks whose categorization fails are logged, passed to on_error(track, error) and skipped."""
+    from tqdm import tqdm
+    max_workers = max_workers or CATEGORIZE_CONCURRENCY
+    timeout = timeout or CATEGORIZE_TIMEOUT
+    batch_size = batch_size or CATEGORIZE_BATCH_SIZE
+    tracks = (track for _, track in df.iterrows())
+
+    if batch_size > 1:
+        fn = lambda batch: categorize_batch(categories_output, batch)
+        items = chunked(tracks, batch_size)
+    else:
+        fn = lambda track: [(track, categorize_track(categories_output, track), None)]
+        items = tracks
+
+    results = run_concurrently(fn, items, max_workers=max_workers, timeout=timeout)
+    with tqdm(total=len(df)) as progress:
+        for item, batch_results, error in results:
+            if error is not None:
+                batch_results = [(track, None, error) for track in (item if batch_size > 1 else [item])]
+            for track, result, error in batch_results:
+                progress.update()
+                if error is not None:
+                    logger.error(f'Error: {error}')
+                    print(f'Error: {error}')
+                    if on_error is not None:
+                        on_error(track, error)
+                    continue
+                category_number, category_name, reasoning = result
+                yield track, category_number, category_name, reasoning, 'llm'
+
+    logger.info(f'Categorization cache: {categorization_cache.stats()}')
+
+def categorize_dataframe_local(categories_output, categories, df, max_workers=None, batch_size=None, use_llm=True,
+                               margin=None, seed_size=None, on_error=None):
+    """Categorizes tracks by nearest centroid over genre TF-IDF and audio-feature vectors, yielding the
+    same tuples as categorize_dataframe, with tier 'centroid' for the tracks assigned locally.
+
+    With use_llm, a k-means-selected seed sample is labelled by the LLM to place the centroids, and
+    only tracks whose margin between the two closest centroids is below margin go to the LLM. Without
+    it, seeds are labelled by genre overlap with the category descriptions and no LLM call is made.
+    While fewer than two categories have seeds, the tracks that are not seeds go to the LLM, or offline
+    are passed to on_error, since the categories without seeds could never draw a track.
+    """
+    import numpy as np
+    from local import track_vectors, select_seeds, genre_overlap_scores, overlap_seeds, NearestCentroid
+    margin = LOCAL_CONFIDENCE_MARGIN if margin is None else margin
+    numbers = [int(category['category_number']) for category in categories]
+    index_of = {number: j for j, number in enumerate(numbers)}
+    X = track_vectors(df)
+    labels = {}
+
+    if use_llm:
+        positions = {track_id: i for i, track_id in enumerate(df.index)}
+        seeds = select_seeds(X, seed_size or max(4 * len(categories), 24))
+        results = categorize_dataframe(categories_output, df.iloc[seeds], max_workers, batch_size=batch_size,
+                                       on_error=on_error)
+        for track, category_number, category_name, reasoning, tier in results:
+            if category_number in index_of:
+                labels[positions[track.name]] = index_of[category_number]
+            yield track, category_number, category_name, reasoning, tier
+    else:
+        labels = overlap_seeds(genre_overlap_scores(df['genres'].tolist(), categories))
+        if not labels:
+            logger.warning('Offline categorization: no track\'s genres match any category description, so there '
+                           'is no category to assign tracks to without the LLM')
+
+    centroids = NearestCentroid(len(categories)).fit(X, labels)
+    best, similarities, margins = centroids.predict(X)
+    placed = int(centroids.fitted.sum())
+    if placed < 2:
+        logger.warning(f'Local categorization: seed tracks place {placed} of {len(categories)} categories, '
+                       f'too few to tell tracks apart without the LLM')
+
+    ambiguous = []
+    for i, (_, track) in enumerate(df.iterrows()):
+        if use_llm and i in labels:
             continue
-        categorized_tracks.append({'track_name': track['name'],
-                                                      'artists': track['artists'],
-                                                      'album': track['album'],
-                                                      'release_date': track['release_date'],
-                                                      # 'genres': track['genres'],
-                                                      # 'popularity': track['popularity'],
-                                                      # 'danceability': track['danceability'],
-                                                      # 'energy': track['energy'],
-                                                      # 'key': track['key'],
-                                                      # 'loudness': track['loudness'],
-                                                      # 'mode': track['mode'],
-                                                      # 'speechiness': track['speechiness'],
-                                                      # 'acousticness': track['acousticness'],
-                                                      # 'instrumentalness': track['instrumentalness'],
-                                                      # 'liveness': track['liveness'],
-                                                      # 'valence': track['valence'],
-                                                      # 'tempo': track['tempo'],
-                                                      # 'duration_ms': track['duration_ms'],
-                                                      # 'time_signature': track['time_signature'],
-                                                      'category_name': category_name,
-                                                    'category_number': category_number,
-                                                      'reasoning': reasoning})
-        new_playlist_id = categories[category_number-1]['playlist_id']
-        sp.playlist_add_items(playlist_id=new_playlist_id, items=[track['uri']])
-
-    return categorized_tracks
+        if not use_llm and placed < 2 and i in labels:
+            # The seed's genres matched the category, which is all there is to go on
+            category = categories[labels[i]]
+            yield (track, numbers[labels[i]], category['category_name'],
+                   "Assigned locally by genre overlap with the category description.", 'centroid')
+        elif margins[i] >= margin or (not use_llm and placed > 1 and np.isfinite(similarities[i])):
+            category = categories[best[i]]
+            yield (track, numbers[best[i]], category['category_name'],
+                   f"Assigned locally to the closest category by genres and audio features "
+                   f"(similarity {similarities[i]:.2f}, margin {margins[i]:.2f}).", 'centroid')
+        else:
+            ambiguous.append(i)
+
+    logger.info(f'Local categorization: {len(labels)} seeds, {len(df) - len(labels) - len(ambiguous)} assigned '
+                f'locally, {len(ambiguous)} ambiguous')
+    if use_llm and ambiguous:
+        yield from categorize_dataframe(categories_output, df.iloc[ambiguous], max_workers, batch_size=batch_size,
+                                        on_error=on_error)
+    elif ambiguous:
+        # Offline, a track is only left over when fewer than two categories could be placed
+        error = ValueError('No category could be placed without the LLM: no track\'s genres match any '
+                           'category description') if not placed else \
+            ValueError('Only one category could be placed without the LLM: no other category description '
+                       'matches any track\'s genres')
+        logger.error(f'Error: {error} ({len(ambiguous)} tracks not categorized)')
+        if on_error is not None:
+            for i in ambiguous:
+                on_error(df.iloc[i], error)
+
+def categorize_dataframe_tiered(categories_output, categories, df, max_workers=None, batch_size=None,
+                                min_score=None, min_margin=None, min_confidence=None, on_error=None):
+    """Categorizes tracks with the cheapest tier that is confident enough, yielding the same tuples as
+    categorize_dataframe with the tier that decided each track.
+
+    'overlap' assigns the tracks whose genre words clearly match one category: an overlap score of at
+    least min_score, ahead of the next category by min_margin. With TIER_SMALL_MODEL set, 'small' asks
+    the cheap model about the rest and keeps the answers it is at least min_confidence sure of. Only
+    the remaining tracks go to the full model as 'llm'. df is categorized a chunk at a time.
+    """
+    import pandas as pd
+    from local import genre_overlap_scores, overlap_margins
+    min_score = TIER_OVERLAP_MIN_SCORE if min_score is None else min_score
+    min_margin = TIER_OVERLAP_MARGIN if min_margin is None else min_margin
+    min_confidence = TIER_SMALL_MIN_CONFIDENCE if min_confidence is None else min_confidence
+    max_workers = max_workers or CATEGORIZE_CONCURRENCY
+    numbers = [int(category['category_number']) for category in categories]
+    counts = {'overlap': 0, 'small': 0, 'llm': 0}
+
+    for chunk in [df] if isinstance(df, pd.DataFrame) else df.chunks():
+        best, scores, margins = overlap_margins(genre_overlap_scores(chunk['genres'].tolist(), categories))
+        escalated = []
+        for i, (_, track) in enumerate(chunk.iterrows()):
+            if scores[i] >= min_score and margins[i] >= min_margin:
+                counts['overlap'] += 1
+                yield (track, numbers[best[i]], categories[best[i]]['category_name'],
+                       f"Its genres match the category's description (overlap {scores[i]:.2f}, "
+                       f"margin {margins[i]:.2f}).", 'overlap')
+            else:
+                escalated.append(i)
+
+        if escalated and chain_categorize_small is not None:
+            unsure = []
+            results = run_concurrently(lambda i: ask_small_model(categories_output, chunk.iloc[i]), escalated,
+                                       max_workers=max_workers, timeout=CATEGORIZE_TIMEOUT)
+            for i, answer, error in results:
+                if error is not None:
+                    logger.error(f'Error: {error}')
+                if error is None and answer[0] in numbers and answer[3] >= min_confidence:
+                    counts['small'] += 1
+                    yield chunk.iloc[i], answer[0], answer[1], answer[2], 'small'
+                else:
+                    unsure.append(i)
+            escalated = sorted(unsure)
+
+        if escalated:
+            counts['llm'] += len(escalated)
+            yield from categorize_dataframe(categories_output, chunk.iloc[escalated], max_workers,
+                                            batch_size=batch_size, on_error=on_error)
+
+    logger.info(f'Tiered categorization: {counts}')
+
+def categorize(categories_output, categories, df, mode=None, max_workers=None, batch_size=None, on_error=None):
+    import pandas as pd
+    mode = mode or CATEGORIZE_MODE
+    if mode == 'llm':
+        results = categorize_dataframe(categories_output, df, max_workers, batch_size=batch_size, on_error=on_error)
+    elif mode in ('local', 'offline'):
+        # Nearest-centroid assignment needs every track's vector at once
+        if not isinstance(df, pd.DataFrame):
+            df = df.load()
+        results = categorize_dataframe_local(categories_output, categories, df, max_workers, batch_size,
+                                             use_llm=mode == 'local', on_error=on_error)
+    elif mode == 'tiered':
+        results = categorize_dataframe_tiered(categories_output, categories, df, max_workers, batch_size,
+                                              on_error=on_error)
+    else:
+        raise ValueError(f'Unknown categorization mode: {mode}')
+    return count_tiers(results)
 
+def count_tiers(results):
+    for result in results:
+        categorizations.inc(tier=result[-1])
+        yield result
 
 def get_total_tracks(playlist_id):
-    return pd.read_pickle(f'playlist-{playlist_id}.pkl').shape[0]
+    return single_flight.do(('total_tracks', playlist_id), track_store.count_tracks, playlist_id)
 
 
-def stream_categorization(token, playlist_id, categories):
-    sp = spotipy.Spotify(auth=token)
+def stream_categorization(token, playlist_id, categories, max_workers=None, batch_size=None, mode=None):
+    sp = spotify_client(token)
     categories_output = format_categories(categories)
-    df = pd.read_pickle(f'playlist-{playlist_id}.pkl')
-    categorized_tracks = []
+    # Tracks are read from the store a chunk at a time as categorization consumes them
+    df = track_store.playlist(playlist_id, INGEST_CHUNK_SIZE)
+
+    # Playlist writes are batched on a background thread so they never hold up the stream
+    writer = PlaylistWriter(sp, flush_interval=PLAYLIST_WRITE_INTERVAL)
 
     yield '[\n'
 
     first = True
-    for i, track in tqdm(df.iterrows(), total=len(df)):
+    try:
+        for item in stream_categorized_tracks(categories_output, df, categories, writer, max_workers, batch_size, mode):
+            if not first:
+                yield ',\n'
+            else:
+                first = False
+
+            yield json.dumps(item)
+    finally:
+        written = writer.close()
+        logger.info(f'Tracks added per playlist: {written}')
+
+    yield '\n]'
+
+
+def stream_categorized_tracks(categories_output, df, categories, writer, max_workers=None, batch_size=None, mode=None):
+    results = categorize(categories_output, categories, df, mode, max_workers, batch_size)
+    for track, category_number, category_name, reasoning, tier in results:
+        writer.add(categories[category_number - 1]['playlist_id'], track['uri'])
+
+        yield track_info(track, category_number, category_name, reasoning, tier)
+
+
+def track_info(track, category_number, category_name, reasoning, tier):
+    return {
+        'thumbnail_url': track['thumbnail_url'],
+        'track_name': track['name'],
+        'artists': track['artists'],
+        'album': track['album'],
+        'release_date': track['release_date'],
+        'category_name': category_name,
+        'category_number': category_number,
+        'reasoning': reasoning,
+        'tier': tier
+    }
+
+
+def ndjson_event(event, data):
+    return json.dumps({'event': event, **data}) + '\n'
+
+
+def sse_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+STREAM_FORMATS = {'ndjson': (ndjson_event, 'application/x-ndjson'),
+                  'sse': (sse_event, 'text/event-stream')}
+
+
+def stream_generation(token, playlist_id, categories, max_workers=None, batch_size=None, mode=None, fmt='ndjson'):
+    """Creates the category playlists and categorizes the playlist's tracks into them, as a stream of
+    NDJSON lines or server-sent events.
+
+    A 'start' event with the total is sent before any Spotify or LLM call. Playlists are created while
+    the first tracks are categorized, and results are held back from the playlist writer until they
+    exist, then announced with a 'playlists' event. Each categorized track is a 'track' event carrying
+    its track_info, and each failed one an 'error' event. 'progress' events with done, total, errors and
+    the ETA come at most every STREAM_PROGRESS_INTERVAL seconds, and a 'heartbeat' every
+    STREAM_HEARTBEAT_INTERVAL seconds without other events. The stream ends with a 'done' event, or an
+    'error' event without a track when the playlists could not be created.
+    """
+    encode = STREAM_FORMATS[fmt][0]
+    start = time.monotonic()
+    total = get_total_tracks(playlist_id)
+    yield encode('start', {'total_tracks': total,
+                           'categories': [{'category_number': int(category['category_number']),
+                                           'category_name': category['category_name']}
+                                          for category in categories]})
+
+    sp = spotify_client(token)
+    categories_output = format_categories(categories)
+    df = track_store.playlist(playlist_id, INGEST_CHUNK_SIZE)
+    events = queue.Queue()
+    stop = threading.Event()
+
+    def categorize_tracks_into_queue():
         try:
-            category_number, category_name, reasoning = categorize_track(categories_output, track)
-        except ValueError as e:
+            results = categorize(categories_output, categories, df, mode, max_workers, batch_size,
+                                 on_error=lambda track, error: events.put(('error', (track, error))))
+            for result in results:
+                if stop.is_set():
+                    break
+                events.put(('track', result))
+        except Exception as e:
             logger.error(f'Error: {e}')
-            print(f'Error: {e}')
-            continue
-        track_info = {
-            'thumbnail_url': track['thumbnail_url'],
-            'track_name': track['name'],
-            'artists': track['artists'],
-            'album': track['album'],
-            'release_date': track['release_date'],
-            'category_name': category_name,
-            'category_number': category_number,
-            'reasoning': reasoning
-        }
-        categorized_tracks.append(track_info)
-
-        new_playlist_id = categories[category_number - 1]['playlist_id']
-        sp.playlist_add_items(playlist_id=new_playlist_id, items=[track['uri']])
-
-        if not first:
-            yield ',\n'
-        else:
-            first = False
+            events.put(('failed', e))
+        finally:
+            events.put(('end', None))
+
+    # generate_spotify_playlists fills in the copies, categorization reads the originals meanwhile
+    pool = ThreadPoolExecutor(max_workers=2)
+    playlists = pool.submit(contextvars.copy_context().run, generate_spotify_playlists, token, playlist_id,
+                            [dict(category) for category in categories])
+    playlists.add_done_callback(lambda _: events.put(('playlists', None)))
+    pool.submit(contextvars.copy_context().run, categorize_tracks_into_queue)
+
+    writer = PlaylistWriter(sp, flush_interval=PLAYLIST_WRITE_INTERVAL)
+    targets = None
+    waiting = []
+    done = errors = 0
+    finished = closed = False
+    last_progress = start
+
+    def progress():
+        elapsed = time.monotonic() - start
+        eta = elapsed / done * max(total - done - errors, 0) if done else None
+        return encode('progress', {'done': done, 'total': total, 'errors': errors,
+                                   'elapsed_seconds': round(elapsed, 3),
+                                   'eta_seconds': round(eta, 3) if eta is not None else None})
+
+    try:
+        while not (finished and targets is not None):
+            try:
+                kind, value = events.get(timeout=STREAM_HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                yield encode('heartbeat', {'elapsed_seconds': round(time.monotonic() - start, 3)})
+                continue
+
+            if kind == 'playlists':
+                try:
+                    created = playlists.result()
+                except Exception as e:
+                    logger.error(f'Error: {e}')
+                    yield encode('error', {'message': f'Could not create the playlists: {e}'})
+                    return
+                targets = [category['playlist_id'] for category in created]
+                for category_number, uri in waiting:
+                    writer.add(targets[category_number - 1], uri)
+                waiting = []
+                yield encode('playlists', {'playlists': [{'category_number': int(category['category_number']),
+                                                          'playlist_id': category['playlist_id']}
+                                                         for category in created]})
+            elif kind == 'track':
+                track, category_number, category_name, reasoning, tier = value
+                if targets is None:
+                    waiting.append((category_number, track['uri']))
+                else:
+                    writer.add(targets[category_number - 1], track['uri'])
+                done += 1
+                yield encode('track', track_info(track, category_number, category_name, reasoning, tier))
+            elif kind == 'error':
+                track, error = value
+                errors += 1
+                yield encode('error', {'track_name': track['name'], 'message': str(error)})
+            elif kind == 'failed':
+                yield encode('error', {'message': f'Categorization failed: {value}'})
+            else:
+                finished = True
+
+            if time.monotonic() - last_progress >= STREAM_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                yield progress()
+
+        written, closed = writer.close(), True
+        logger.info(f'Tracks added per playlist: {written}')
+        yield progress()
+        yield encode('done', {'done': done, 'total': total, 'errors': errors, 'written': written,
+                              'failed_writes': dict(writer.failed)})
+    finally:
+        stop.set()
+        if not closed:
+            writer.close()
+        pool.shutdown(wait=False)
+
+
+def run_categories_job(job):
+    """Job handler for /jobs/categories: ingests the playlist and asks for categories."""
+    token, playlist_id = job.params['token'], job.params['playlist_id']
+    job.progress(0, 2)
+    sync_playlist(token, playlist_id)
+    job.progress(1)
+    categories = playlist_categories(token, playlist_id, job.params['num_categories'])
+    job.progress(2)
+    return categories
 
-        yield json.dumps(track_info)
 
-    yield '\n]'
\ No newline at end of file
+def run_generate_job(job):
+    """Job handler for /jobs/generate: creates the playlists and categorizes every track into them.
+
+    Each categorized track is checkpointed, and the checkpoint is committed once the track has been
+    added to its playlist. When the job is resumed, the playlists created by the earlier run are
+    reused, committed tracks are skipped and uncommitted ones are only added again, not re-classified.
+    """
+    token, playlist_id = job.params['token'], job.params['playlist_id']
+    categories = job.params['categories']
+    if not all('playlist_id' in category for category in categories):
+        categories = generate_spotify_playlists(token, playlist_id, categories)
+        job.update_params(categories=categories)
+
+    categories_output = format_categories(categories)
+    checkpoints = job.checkpoints()
+    remaining = track_store.playlist(playlist_id, INGEST_CHUNK_SIZE, exclude=checkpoints)
+
+    pending = {}
+    def on_written(target, uris):
+        job.commit_checkpoints([pending.pop((target, uri)) for uri in uris if (target, uri) in pending])
+
+    writer = PlaylistWriter(spotify_client(token), flush_interval=PLAYLIST_WRITE_INTERVAL, on_written=on_written)
+    try:
+        for track_id, (value, committed) in checkpoints.items():
+            if not committed:
+                pending[(value['playlist_id'], value['uri'])] = track_id
+                writer.add(value['playlist_id'], value['uri'])
+
+        done = len(checkpoints)
+        total = done + len(remaining)
+        job.progress(done, total)
+        results = categorize(categories_output, categories, remaining, job.params.get('mode'),
+                             job.params.get('max_workers'), job.params.get('batch_size'))
+        for track, category_number, category_name, reasoning, tier in results:
+            target = categories[category_number - 1]['playlist_id']
+            job.checkpoint(track.name, {'track_info': track_info(track, category_number, category_name, reasoning,
+                                                                 tier),
+                                        'playlist_id': target,
+                                        'uri': track['uri']})
+            pending[(target, track['uri'])] = track.name
+            writer.add(target, track['uri'])
+            done += 1
+            job.progress(done)
+    finally:
+        written = writer.close()
+        logger.info(f'Tracks added per playlist: {written}')
+
+    if done < total or writer.failed:
+        raise RuntimeError(f'{total - done} tracks could not be categorized and '
+                           f'{sum(writer.failed.values())} could not be added to playlists, resume the job to retry')
+    return {'total_tracks': total, 'written': written}
+
+
+job_queue.register('categories', run_categories_job)
+job_queue.register('generate', run_generate_job)
+# Pick up jobs interrupted by the last shutdown, in whichever process sharing the job store gets to them first
+recovered_jobs = job_queue.recover()
+if recovered_jobs:
+    logger.info(f'Resumed jobs: {recovered_jobs}')
+
+
+def stream_job(job_id):
+    """Streams a generate job's categorized tracks as a JSON array, following the job until it finishes."""
+    yield '[\n'
+
+    first = True
+    seq = 0
+    while True:
+        finished = job_queue.store.get(job_id)['status'] in FINISHED
+        for seq, _, value, _ in job_queue.store.checkpoints(job_id, after=seq):
+            if not first:
+                yield ',\n'
+            else:
+                first = False
+
+            yield json.dumps(value['track_info'])
+        if finished:
+            break
+        time.sleep(JOB_POLL_INTERVAL)
+
+    yield '\n]'
@@ -0,0 +1,120 @@
+import logging
+import threading
+from functools import lru_cache
+
+from engine import call_with_backoff
+
+logger = logging.getLogger(__name__)
+
+
+def openai_provider(model_name, callbacks=(), request_timeout=None, max_retries=6):
+    from langchain.chat_models import ChatOpenAI
+    return ChatOpenAI(model_name=model_name, temperature=0, request_timeout=request_timeout,
+                      max_retries=max_retries, callbacks=list(callbacks))
+
+
+# name: factory(model_name, callbacks, **options) returning a langchain LLM
+providers = {'openai': openai_provider}
+
+
+def register_provider(name, factory):
+    """Makes factory available as provider name, e.g. to serve the chains from a local or fake model."""
+    providers[name] = factory
+
+
+@lru_cache(maxsize=None)
+def _callback_class():
+    from langchain.callbacks.base import BaseCallbackHandler
+
+    class LLMEndCallback(BaseCallbackHandler):
+        def __init__(self, on_llm_end):
+            self._on_llm_end = on_llm_end
+
+        def on_llm_end(self, response, **kwargs):
+            self._on_llm_end(response, **kwargs)
+
+    return LLMEndCallback
+
+
+class Prompt:
+    """A prompt template kept as a plain string until a chain is built from it.
+
+    Placeholders are {name} fields and literal braces are doubled, as in langchain's f-string templates.
+    """
+
+    def __init__(self, template):
+        self.template = template
+
+    def format(self, **kwargs):
+        return self.template.format(**kwargs)
+
+
+class LLMRegistry:
+    """Builds LLM clients with the configured provider on first use, one per model name.
+
+    Nothing is imported from langchain and no client is created until a chain is first run, so importing
+    the server stays fast and does not need an API key. on_llm_end, when set, is called with every
+    completion's LLMResult. With governor, every chain run waits for its rate budget and rate limited runs
+    are retried up to rate_limit_retries times.
+    """
+
+    def __init__(self, provider='openai', model_name='gpt-3.5-turbo', on_llm_end=None, governor=None,
+                 rate_limit_retries=5, **options):
+        self.provider = provider
+        self.model_name = model_name
+        self.on_llm_end = on_llm_end
+        self.governor = governor
+        self.rate_limit_retries = rate_limit_retries
+        self.options = options
+        self._llms = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_name=None):
+        model_name = model_name or self.model_name
+        with self._lock:
+            llm = self._llms.get(model_name)
+            if llm is None:
+                try:
+                    factory = providers[self.provider]
+                except KeyError:
+                    raise ValueError(f'Unknown LLM provider: {self.provider}')
+                callbacks = [_callback_class()(self.on_llm_end)] if self.on_llm_end else []
+                logger.info(f'Creating {self.provider} LLM {model_name}')
+                llm = self._llms[model_name] = factory(model_name, callbacks, **self.options)
+            return llm
+
+    def chain(self, prompt, model_name=None):
+        return LazyChain(self, prompt, model_name)
+
+    def clear(self):
+        """Drops the clients built so far, so the next use builds them again, e.g. after switching provider."""
+        with self._lock:
+            self._llms.clear()
+
+
+class LazyChain:
+    """An LLMChain over registry's model that is built the first time it is run."""
+
+    def __init__(self, registry, prompt, model_name=None):
+        self.registry = registry
+        self.prompt = prompt
+        self.model_name = model_name
+        self._chain = None
+        self._lock = threading.Lock()
+
+    @property
+    def chain(self):
+        with self._lock:
+            if self._chain is None:
+                from langchain.chains import LLMChain
+                from langchain.prompts import PromptTemplate
+                self._chain = LLMChain(llm=self.registry.get(self.model_name),
+                                       prompt=PromptTemplate.from_template(self.prompt.template), verbose=True)
+            return self._chain
+
+    def run(self, **kwargs):
+        governor = self.registry.governor
+        if governor is None:
+            return self.chain.run(**kwargs)
+        return call_with_backoff(governor.wrap(self.chain.run), max_retries=self.registry.rate_limit_retries,
+                                 **kwargs)
@@ -0,0 +1,192 @@
+import re
+
+import numpy as np
+
+AUDIO_VECTOR_FEATURES = ['acousticness',
+                         'danceability',
+                         'energy',
+                         'instrumentalness',
+                         'liveness',
+                         'loudness',
+                         'mode',
+                         'speechiness',
+                         'tempo',
+                         'valence']
+
+STOPWORDS = {'a', 'an', 'and', 'or', 'the', 'of', 'with', 'in', 'on', 'for', 'to', 'that', 'this', 'these', 'is',
+             'are', 'by', 'from', 'as', 'its', 'their', 'it', 'music', 'songs', 'song', 'genre', 'genres', 'style',
+             'styles', 'category', 'tracks', 'track', 'elements', 'such', 'other', 'various', 'including'}
+
+
+def audio_matrix(df):
+    """Standardizes the audio features to zero mean and unit variance, filling missing values with the mean."""
+    columns = [c for c in AUDIO_VECTOR_FEATURES if c in df.columns]
+    X = df[columns].astype(float).to_numpy() if columns else np.zeros((len(df), 0))
+    with np.errstate(invalid='ignore'):
+        mean = np.nanmean(X, axis=0) if len(X) else np.zeros(X.shape[1])
+        std = np.nanstd(X, axis=0) if len(X) else np.ones(X.shape[1])
+    mean = np.nan_to_num(mean)
+    std = np.where(np.nan_to_num(std) > 0, np.nan_to_num(std), 1.0)
+    return np.nan_to_num((X - mean) / std).astype(np.float32)
+
+
+def genre_vocabulary(genres, max_genres=256):
+    """Returns the max_genres most frequent genres, most frequent first, ties broken by name."""
+    counts = {}
+    for track_genres in genres:
+        for genre in set(track_genres or ()):
+            counts[genre] = counts.get(genre, 0) + 1
+    return sorted(counts, key=lambda g: (-counts[g], g))[:max_genres]
+
+
+def genre_matrix(genres, vocabulary):
+    """TF-IDF matrix of each track's genres over vocabulary, with L2-normalized rows."""
+    index = {genre: j for j, genre in enumerate(vocabulary)}
+    X = np.zeros((len(genres), len(vocabulary)), dtype=np.float32)
+    for i, track_genres in enumerate(genres):
+        for genre in track_genres or ():
+            j = index.get(genre)
+            if j is not None:
+                X[i, j] = 1.0
+    document_frequency = X.sum(axis=0)
+    X *= (np.log((1 + len(genres)) / (1 + document_frequency)) + 1).astype(np.float32)
+    return normalize_rows(X)
+
+
+def normalize_rows(X):
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    return X / np.where(norms > 0, norms, 1)
+
+
+def track_vectors(df, genre_weight=1.0, audio_weight=0.5, max_genres=256):
+    """Embeds each track as its genre TF-IDF vector next to its standardized audio features,
+    weighted and L2-normalized so dot products are cosine similarities."""
+    genres = df['genres'].tolist()
+    audio = audio_matrix(df)
+    audio = normalize_rows(audio) * audio_weight
+    genre = genre_matrix(genres, genre_vocabulary(genres, max_genres)) * genre_weight
+    return normalize_rows(np.hstack([genre, audio]).astype(np.float32))
+
+
+def kmeans(X, k, iterations=20, random_state=0):
+    """Spherical k-means with k-means++ initialization. Returns (centers, labels)."""
+    rng = np.random.default_rng(random_state)
+    k = min(k, len(X))
+    centers = [X[rng.integers(len(X))]]
+    distances = 1 - X @ centers[0]
+    for _ in range(1, k):
+        weights = np.clip(distances, 0, None).astype(np.float64)
+        total = weights.sum()
+        choice = rng.choice(len(X), p=weights / total) if total > 0 else rng.integers(len(X))
+        centers.append(X[choice])
+        distances = np.minimum(distances, 1 - X @ X[choice])
+    centers = np.array(centers)
+
+    labels = np.zeros(len(X), dtype=int)
+    for iteration in range(iterations):
+        new_labels = np.argmax(X @ centers.T, axis=1)
+        if iteration > 0 and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        for j in range(k):
+            members = X[labels == j]
+            if len(members):
+                centers[j] = members.sum(axis=0)
+        centers = normalize_rows(centers)
+    return centers, labels
+
+
+def select_seeds(X, size, random_state=0):
+    """Picks size representative tracks, the member closest to the center of each k-means cluster."""
+    if len(X) <= size:
+        return list(range(len(X)))
+    centers, labels = kmeans(X, size, random_state=random_state)
+    seeds = []
+    similarities = X @ centers.T
+    for j in range(len(centers)):
+        members = np.flatnonzero(labels == j)
+        if len(members):
+            seeds.append(int(members[np.argmax(similarities[members, j])]))
+    return sorted(set(seeds))
+
+
+def tokens(text):
+    return {token for token in re.findall(r'[a-z0-9]+', text.lower().replace('-', ' ')) if token not in STOPWORDS}
+
+
+def genre_overlap_scores(genres, categories):
+    """Scores each track against each category by the share of its genre words found in the category's
+    name and description. Returns an array of shape (tracks, categories)."""
+    category_tokens = [tokens(f"{c['category_name']} {c['description']}") for c in categories]
+    scores = np.zeros((len(genres), len(categories)), dtype=np.float32)
+    for i, track_genres in enumerate(genres):
+        track_tokens = tokens(' '.join(track_genres or ()))
+        if not track_tokens:
+            continue
+        for j, words in enumerate(category_tokens):
+            scores[i, j] = len(track_tokens & words) / len(track_tokens)
+    return scores
+
+
+def overlap_margins(scores):
+    """Returns (best category indexes, best scores, margins) for genre_overlap_scores, where margin is the
+    gap between the best and second-best score."""
+    if scores.shape[1] == 0:
+        empty = np.zeros(len(scores), dtype=np.float32)
+        return np.zeros(len(scores), dtype=int), empty, empty
+    order = np.argsort(-scores, axis=1, kind='stable')
+    best = order[:, 0]
+    best_scores = scores[np.arange(len(scores)), best]
+    if scores.shape[1] > 1:
+        margins = best_scores - scores[np.arange(len(scores)), order[:, 1]]
+    else:
+        margins = best_scores.copy()
+    return best, best_scores, margins
+
+
+def overlap_seeds(scores, per_category=20):
+    """Labels up to per_category tracks for each category by genre overlap, without any LLM call.
+    Returns {track position: category index}."""
+    labels = {}
+    best = np.argmax(scores, axis=1) if scores.size else np.zeros(0, dtype=int)
+    for j in range(scores.shape[1]):
+        candidates = np.flatnonzero((best == j) & (scores[:, j] > 0))
+        candidates = candidates[np.argsort(-scores[candidates, j], kind='stable')][:per_category]
+        labels.update({int(i): j for i in candidates})
+    return labels
+
+
+class NearestCentroid:
+    """Assigns vectors to the category whose labelled centroid is most similar."""
+
+    def __init__(self, num_categories):
+        self.num_categories = num_categories
+        self.centroids = None
+        self.fitted = None
+
+    def fit(self, X, labels):
+        """labels maps row positions of X to category indexes."""
+        self.centroids = np.zeros((self.num_categories, X.shape[1]), dtype=np.float32)
+        self.fitted = np.zeros(self.num_categories, dtype=bool)
+        for j in range(self.num_categories):
+            members = [i for i, label in labels.items() if label == j]
+            if members:
+                self.centroids[j] = X[members].sum(axis=0)
+                self.fitted[j] = True
+        self.centroids = normalize_rows(self.centroids)
+        return self
+
+    def predict(self, X):
+        """Returns (category indexes, similarities, margins), where margin is the gap between the best
+        and second-best centroid similarity and serves as the confidence of the assignment. With fewer than
+        two centroids fitted there is nothing to tell apart, and every margin is -inf."""
+        similarities = X @ self.centroids.T
+        similarities[:, ~self.fitted] = -np.inf
+        order = np.argsort(-similarities, axis=1)
+        best = order[:, 0]
+        best_similarity = similarities[np.arange(len(X)), best]
+        if self.fitted.sum() > 1:
+            margins = best_similarity - similarities[np.arange(len(X)), order[:, 1]]
+        else:
+            margins = np.full(len(X), -np.inf)
+        return best, best_similarity, margins
@@ -0,0 +1,223 @@
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in key)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(labels), 0.0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+
+class Gauge:
+    """A gauge read from fn() at collection time. With label, fn returns {label value: number}."""
+    type = 'gauge'
+
+    def __init__(self, name, help, fn, label=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label = label
+
+    def samples(self):
+        value = self.fn()
+        if self.label is None:
+            return [(self.name, (), value)]
+        return [(self.name, ((self.label, str(k)),), v) for k, v in sorted(value.items())]
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._counts = {}
+        self._sums = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._sums[key] += value
+
+    def count(self, **labels):
+        with self._lock:
+            return sum(self._counts.get(_label_key(labels), ()))
+
+    def total(self, **labels):
+        with self._lock:
+            return self._sums.get(_label_key(labels), 0.0)
+
+    def label_values(self, name):
+        with self._lock:
+            return sorted({value for key in self._counts for label, value in key if label == name})
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, counts in sorted(self._counts.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    samples.append((f'{self.name}_bucket', key + (('le', _format_value(bound)),), cumulative))
+                samples.append((f'{self.name}_sum', key, self._sums[key]))
+                samples.append((f'{self.name}_count', key, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args)
+            return metric
+
+    def counter(self, name, help):
+        return self._get_or_create(Counter, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help, buckets)
+
+    def gauge(self, name, help, fn, label=None):
+        return self._get_or_create(Gauge, name, help, fn, label)
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logger.error(f'Error collecting {metric.name}: {e}')
+                continue
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(f'{name}{_format_labels(key)} {_format_value(value)}' for name, key, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram('playlistgenius_stage_seconds', 'Time spent in each pipeline stage.')
+stage_errors = registry.counter('playlistgenius_stage_errors_total', 'Pipeline stage calls that raised.')
+request_seconds = registry.histogram('playlistgenius_request_seconds', 'Time spent serving each endpoint.')
+
+
+class Trace:
+    """Collects stage timings for one request or job and logs them as one line when finished."""
+
+    def __init__(self, name):
+        self.name = name
+        self.id = uuid.uuid4().hex[:12]
+        self.start = time.perf_counter()
+        self.stages = defaultdict(lambda: [0, 0.0])
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            entry = self.stages[stage]
+            entry[0] += 1
+            entry[1] += seconds
+
+    def finish(self):
+        elapsed = time.perf_counter() - self.start
+        with self._lock:
+            stages = ', '.join(f'{stage}={total:.3f}s' + (f'/{count}' if count > 1 else '')
+                               for stage, (count, total) in self.stages.items())
+        logger.info(f'Trace {self.id} {self.name} took {elapsed:.3f}s' + (f': {stages}' if stages else ''))
+        return elapsed
+
+
+def start_trace(name):
+    trace = Trace(name)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def trace(name):
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace.finish()
+
+
+@contextmanager
+def timed(stage):
+    """Records the duration of the block in playlistgenius_stage_seconds and the current trace.
+    Usable as a decorator as well."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(stage, elapsed)
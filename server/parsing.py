@@ -0,0 +1,194 @@
+import json
+import re
+
+# How many '{' or '[' find_json tries to decode from, so prose full of braces stays linear to scan
+MAX_JSON_STARTS = 3
+
+_decoder = json.JSONDecoder()
+
+# Anchored per line and free of nested quantifiers, so every line is matched in time linear in its length
+_LABEL_LINE = re.compile(r"[\s>#*_-]*(category number|category name|reasoning|confidence)[\s*_]*[:=]\s*(.*)",
+                         re.IGNORECASE)
+_CATEGORY_LINE = re.compile(r"[\s>#*_-]*(?:category\s*)?(\d{1,3})[.):]\s*(.*)", re.IGNORECASE)
+_INLINE_NUMBER = re.compile(r"category number\W{0,10}(\d+)", re.IGNORECASE)
+_NUMBER = re.compile(r"-?\d+(?:\.\d+)?")
+
+CATEGORY_ANSWER_SCHEMA = {'category_number': int, 'category_name': str, 'reasoning': str, 'confidence': float}
+CATEGORY_SCHEMA = {'category_number': int, 'category_name': str, 'description': str}
+# Other keys models use for the same fields
+ALIASES = {'category': 'category_number', 'number': 'category_number', 'name': 'category_name',
+           'title': 'category_name', 'reason': 'reasoning', 'explanation': 'reasoning'}
+
+
+class ParseError(ValueError):
+    """An LLM answer that could not be read.
+
+    cause names what went wrong, for counting failures, missing lists the fields that could not be read
+    and partial holds the ones that could.
+    """
+
+    def __init__(self, message, cause, missing=(), partial=None):
+        super().__init__(message)
+        self.cause = cause
+        self.missing = tuple(missing)
+        self.partial = partial or {}
+
+
+def find_json(output, opener='{'):
+    """Decodes the first JSON value starting with opener in output, ignoring code fences and text around it.
+
+    Raises ParseError with cause 'no_json' when there is none and 'invalid_json' when it does not decode.
+    """
+    start = output.find(opener)
+    if start < 0:
+        raise ParseError('No JSON in LLM output', 'no_json')
+    for _ in range(MAX_JSON_STARTS):
+        try:
+            return _decoder.raw_decode(output, start)[0]
+        except (ValueError, RecursionError):
+            start = output.find(opener, start + 1)
+            if start < 0:
+                break
+    raise ParseError('Invalid JSON in LLM output', 'invalid_json')
+
+
+def coerce(value, kind):
+    """Returns value as kind, reading numbers out of strings like '**3**' or '3. Rock', or None."""
+    if value is None or isinstance(value, (list, dict)):
+        return None
+    if kind is str:
+        value = str(value).strip().strip('*"\'').strip()
+        return value or None
+    if isinstance(value, bool):
+        return None
+    if not isinstance(value, (int, float)):
+        number = _NUMBER.search(str(value))
+        if number is None:
+            return None
+        value = float(number.group())
+    if kind is int and float(value) != int(float(value)):
+        return None
+    return kind(value)
+
+
+def validate(obj, schema):
+    """Returns {field: value} for the fields of schema found in the JSON object obj, each coerced to its type
+    and None when missing or of the wrong type."""
+    values = dict.fromkeys(schema)
+    if not isinstance(obj, dict):
+        return values
+    for key, value in obj.items():
+        field = key.strip().lower().replace(' ', '_') if isinstance(key, str) else key
+        field = ALIASES.get(field, field)
+        if field in schema and values[field] is None:
+            values[field] = coerce(value, schema[field])
+    return values
+
+
+def parse_labelled(output):
+    """Reads 'Category number:', 'Category name:', 'Reasoning:' and 'Confidence:' lines, tolerating markdown and
+    punctuation. A label's value runs on over the following unlabelled lines."""
+    raw = {}
+    label = None
+    for line in output.splitlines():
+        match = _LABEL_LINE.match(line)
+        if match:
+            label = match.group(1).lower().replace(' ', '_')
+            if label in raw:
+                # The first answer wins, later labels are usually the model repeating itself
+                label = None
+                continue
+            raw[label] = [match.group(2)]
+        elif label is not None:
+            raw[label].append(line)
+
+    values = {field: coerce('\n'.join(raw[field]) if field == 'reasoning' else raw[field][0], kind)
+              if field in raw else None for field, kind in CATEGORY_ANSWER_SCHEMA.items()}
+    if values['category_name'] is not None:
+        values['category_name'] = re.sub(r"^\d+[.)]\s*", '', values['category_name'])
+    if values['category_number'] is None:
+        number = _INLINE_NUMBER.search(output)
+        if number:
+            values['category_number'] = int(number.group(1))
+    return values
+
+
+def parse_answer(output):
+    """Reads a categorization answer, as a JSON object with CATEGORY_ANSWER_SCHEMA's fields or as labelled
+    lines. Returns {field: value} with None for the fields that could not be read.
+
+    Raises ParseError with cause 'empty' for an empty answer and 'missing_number' when the category number
+    could not be read, with whatever else could be as partial.
+    """
+    if not output or not output.strip():
+        raise ParseError('Empty LLM output', 'empty', missing=['category_number'])
+    values = dict.fromkeys(CATEGORY_ANSWER_SCHEMA)
+    if '{' in output:
+        try:
+            values = validate(find_json(output), CATEGORY_ANSWER_SCHEMA)
+        except ParseError:
+            pass
+    if values['category_number'] is None:
+        labelled = parse_labelled(output)
+        values = {field: values[field] if values[field] is not None else labelled[field] for field in values}
+    if values['category_number'] is None:
+        raise ParseError('Failed to extract category information from LLM output', 'missing_number',
+                         missing=['category_number'], partial=values)
+    return values
+
+
+def parse_categories(output):
+    """Reads a list of categories, as a JSON array (or an object holding one) of CATEGORY_SCHEMA objects or as
+    numbered lines like '1. **Name**: description'. Returns the categories in order of appearance, each
+    number once, with None for a name or description that could not be read.
+
+    Raises ParseError with cause 'empty' or 'no_categories' when there are none.
+    """
+    if not output or not output.strip():
+        raise ParseError('Empty LLM output', 'empty')
+
+    categories = []
+    if '[' in output or '{' in output:
+        try:
+            found = find_json(output, '[' if '[' in output else '{')
+            if isinstance(found, dict):
+                found = next((value for value in found.values() if isinstance(value, list)), [])
+            categories = [validate(item, CATEGORY_SCHEMA) for item in found if isinstance(item, dict)]
+            categories = [category for category in categories if category['category_number'] is not None]
+        except (ParseError, TypeError):
+            categories = []
+
+    if not categories:
+        current = None
+        for line in output.splitlines():
+            match = _CATEGORY_LINE.match(line)
+            if match:
+                name, description = split_title(match.group(2))
+                current = {'category_number': int(match.group(1)), 'category_name': name,
+                           'description': [description] if description else []}
+                categories.append(current)
+            elif current is not None and line.strip():
+                current['description'].append(line.strip())
+        for category in categories:
+            category['description'] = coerce(' '.join(category['description']), str)
+
+    seen = set()
+    categories = [category for category in categories
+                  if category['category_number'] not in seen and not seen.add(category['category_number'])]
+    if not categories:
+        raise ParseError('Failed to extract categories from LLM output', 'no_categories')
+    return categories
+
+
+def split_title(text):
+    """Splits '**Name**: description', 'Name: description' or 'Name - description' into (name, description)."""
+    text = text.strip()
+    if text.startswith('**'):
+        end = text.find('**', 2)
+        if end > 2:
+            return coerce(text[2:end], str), coerce(text[end + 2:].lstrip(' :-–—'), str)
+    for separator in (':', ' - ', ' – ', ' — '):
+        name, found, description = text.partition(separator)
+        if found:
+            return coerce(name, str), coerce(description, str)
+    return coerce(text, str), None
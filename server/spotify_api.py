@@ -0,0 +1,170 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+
+import requests
+from urllib3.util.retry import Retry
+
+from engine import call_with_backoff
+from governor import governor
+from metrics import registry, timed
+
+logger = logging.getLogger(__name__)
+
+SPOTIFY_POOL_SIZE = int(os.environ.get('SPOTIFY_POOL_SIZE', 16))
+SPOTIFY_MAX_RETRIES = int(os.environ.get('SPOTIFY_MAX_RETRIES', 5))
+SPOTIFY_MAX_CLIENTS = 64
+SPOTIFY_RATE = float(os.environ.get('SPOTIFY_RATE', 10))
+SPOTIFY_MAX_RATE = float(os.environ.get('SPOTIFY_MAX_RATE', 50))
+
+spotify_calls = registry.counter('playlistgenius_spotify_calls_total', 'Spotify API calls made through call_spotify.')
+spotify_retries = registry.counter('playlistgenius_spotify_retries_total', 'Spotify API calls retried after a 429.')
+spotify_responses = registry.counter('playlistgenius_spotify_responses_total', 'Spotify HTTP responses by status.')
+spotify_response_seconds = registry.histogram('playlistgenius_spotify_response_seconds',
+                                              'Spotify HTTP response times.')
+
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+# Every Spotify call in the process, whichever user it is for, shares one budget, and with RATE_LIMIT_STATE_PATH
+# so do all the worker processes
+spotify_governor = governor('spotify', rate=SPOTIFY_RATE, max_rate=SPOTIFY_MAX_RATE,
+                            path=os.environ.get('RATE_LIMIT_STATE_PATH'))
+
+
+def _build_session():
+    session = requests.Session()
+    # Only connection errors are retried here, 429s are retried by call_spotify so Retry-After is honored
+    adapter = requests.adapters.HTTPAdapter(pool_connections=SPOTIFY_POOL_SIZE,
+                                            pool_maxsize=SPOTIFY_POOL_SIZE,
+                                            max_retries=Retry(total=3, read=False, status=0,
+                                                              respect_retry_after_header=False))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.hooks['response'].append(_record_response)
+    return session
+
+
+def _record_response(response, *args, **kwargs):
+    spotify_responses.inc(status=response.status_code)
+    spotify_response_seconds.observe(response.elapsed.total_seconds())
+
+
+def spotify_client(token):
+    """Returns a Spotify client for token, reusing one pooled HTTP session per token."""
+    with _clients_lock:
+        sp = _clients.get(token)
+        if sp is None:
+            # Imported on first use, keeping it out of the server's startup
+            import spotipy
+            sp = spotipy.Spotify(auth=token, requests_session=_build_session())
+            api_url = os.environ.get('SPOTIFY_API_URL')
+            if api_url:
+                sp.prefix = api_url.rstrip('/') + '/'
+            _clients[token] = sp
+            if len(_clients) > SPOTIFY_MAX_CLIENTS:
+                _clients.popitem(last=False)
+        else:
+            _clients.move_to_end(token)
+        return sp
+
+
+def call_spotify(fn, *args, **kwargs):
+    """Calls a spotipy method within the Spotify rate budget, sleeping for Retry-After and retrying when
+    rate limited."""
+    method = getattr(fn, '__name__', 'call')
+    spotify_calls.inc(method=method)
+    return call_with_backoff(spotify_governor.wrap(fn), *args, max_retries=SPOTIFY_MAX_RETRIES,
+                             on_retry=lambda e, delay: spotify_retries.inc(method=method), **kwargs)
+
+
+class PlaylistWriter:
+    """Buffers track URIs per playlist and adds them with playlist_add_items on a background thread.
+
+    A playlist's buffer is written once it holds batch_size URIs, every flush_interval seconds, and
+    on close(). Failed writes are retried up to max_retries times. written and failed count URIs per
+    playlist. on_written, if given, is called with (playlist_id, uris) from the writer thread after each
+    successful write.
+    """
+
+    def __init__(self, sp, batch_size=100, flush_interval=5.0, max_retries=3, backoff=1.0, on_written=None):
+        self.sp = sp
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.on_written = on_written
+        self.written = Counter()
+        self.failed = Counter()
+        self._buffers = defaultdict(list)
+        self._condition = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, playlist_id, uri):
+        with self._condition:
+            buffer = self._buffers[playlist_id]
+            buffer.append(uri)
+            if len(buffer) >= self.batch_size:
+                self._condition.notify()
+
+    def close(self):
+        """Writes everything still buffered and returns the per-playlist write counts."""
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        self._thread.join()
+        if self.failed:
+            logger.error(f'Failed to add tracks to playlists: {dict(self.failed)}')
+        return dict(self.written)
+
+    def _take_batches(self, everything):
+        batches = []
+        for playlist_id, buffer in self._buffers.items():
+            while len(buffer) >= self.batch_size or (everything and buffer):
+                batches.append((playlist_id, buffer[:self.batch_size]))
+                del buffer[:self.batch_size]
+        return batches
+
+    def _run(self):
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            with self._condition:
+                full = lambda: any(len(buffer) >= self.batch_size for buffer in self._buffers.values())
+                self._condition.wait_for(lambda: self._closing or full(), timeout=max(0, deadline - time.monotonic()))
+                closing = self._closing
+                interval_elapsed = time.monotonic() >= deadline
+                batches = self._take_batches(everything=closing or interval_elapsed)
+            if interval_elapsed:
+                deadline = time.monotonic() + self.flush_interval
+
+            for playlist_id, uris in batches:
+                self._write(playlist_id, uris)
+
+            if closing:
+                return
+
+    def _write(self, playlist_id, uris):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with timed('playlist_add_items'):
+                    call_spotify(self.sp.playlist_add_items, playlist_id=playlist_id, items=uris)
+                break
+            except Exception as e:
+                logger.error(f'Error adding {len(uris)} tracks to playlist {playlist_id} '
+                             f'(attempt {attempt + 1}/{self.max_retries + 1}): {e}')
+                if attempt < self.max_retries:
+                    time.sleep(self.backoff * (2 ** attempt))
+        else:
+            self.failed[playlist_id] += len(uris)
+            return
+
+        self.written[playlist_id] += len(uris)
+        if self.on_written is not None:
+            try:
+                self.on_written(playlist_id, uris)
+            except Exception as e:
+                logger.error(f'Error: {e}')
@@ -0,0 +1,452 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+AUDIO_FEATURES = ['acousticness',
+                  'danceability',
+                  'duration_ms',
+                  'energy',
+                  'instrumentalness',
+                  'key',
+                  'liveness',
+                  'loudness',
+                  'mode',
+                  'speechiness',
+                  'tempo',
+                  'time_signature',
+                  'valence']
+
+TRACK_COLUMNS = ['uri', 'popularity', 'album', 'name', 'release_date', 'thumbnail_url']
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS tracks (
+    id TEXT PRIMARY KEY,
+    uri TEXT,
+    popularity INTEGER,
+    album TEXT,
+    name TEXT,
+    release_date TEXT,
+    thumbnail_url TEXT,
+    artists TEXT,
+    artists_id TEXT,
+    genres TEXT
+);
+CREATE TABLE IF NOT EXISTS track_artists (
+    track_id TEXT NOT NULL,
+    artist_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (track_id, position)
+);
+CREATE INDEX IF NOT EXISTS track_artists_artist ON track_artists (artist_id);
+CREATE TABLE IF NOT EXISTS artists (
+    id TEXT PRIMARY KEY,
+    genres TEXT,
+    popularity INTEGER,
+    fetched_at REAL,
+    last_used REAL
+);
+CREATE TABLE IF NOT EXISTS audio_features (
+    id TEXT PRIMARY KEY,
+    {', '.join(f'{feature} REAL' for feature in AUDIO_FEATURES)}
+);
+CREATE TABLE IF NOT EXISTS playlists (
+    id TEXT PRIMARY KEY,
+    snapshot_id TEXT,
+    updated_at REAL,
+    name TEXT,
+    sources TEXT,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS playlist_tracks (
+    playlist_id TEXT NOT NULL,
+    track_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (playlist_id, track_id)
+);
+CREATE INDEX IF NOT EXISTS playlist_tracks_track ON playlist_tracks (track_id);
+"""
+
+
+class TrackStore:
+    """SQLite store of tracks, artists and audio features shared by all playlists.
+
+    Each thread gets its own connection. The database runs in WAL mode, so readers never block
+    on a writer and concurrent writers are serialized by SQLite instead of clobbering a file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with self._init_lock:
+                if not self._initialized:
+                    conn.executescript(SCHEMA)
+                    self._migrate(conn)
+                    self._initialized = True
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _migrate(conn):
+        # Stores created before artists were evicted by last use lack the column
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(artists)')}
+        if 'last_used' not in columns:
+            conn.execute('ALTER TABLE artists ADD COLUMN last_used REAL')
+        conn.execute('CREATE INDEX IF NOT EXISTS artists_last_used ON artists (last_used)')
+        # and before playlists had names and libraries had sources
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(playlists)')}
+        for column in ('name', 'sources'):
+            if column not in columns:
+                conn.execute(f'ALTER TABLE playlists ADD COLUMN {column} TEXT')
+        # and before playlists had versions
+        if 'version' not in columns:
+            conn.execute('ALTER TABLE playlists ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+
+    @contextmanager
+    def transaction(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    def query(self, sql, params=()):
+        return self._connection().execute(sql, params).fetchall()
+
+    # Tracks
+
+    def upsert_tracks(self, playlist_id, tracks, start_position=0):
+        """Inserts or refreshes tracks and links them to playlist_id, at each track's 'position' when
+        present and at consecutive positions from start_position otherwise."""
+        with self.transaction() as conn:
+            conn.executemany(
+                'INSERT INTO tracks (id, uri, popularity, album, name, release_date, thumbnail_url, artists, artists_id) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (id) DO UPDATE SET uri = excluded.uri, popularity = excluded.popularity, '
+                'album = excluded.album, name = excluded.name, release_date = excluded.release_date, '
+                'thumbnail_url = excluded.thumbnail_url, artists = excluded.artists, artists_id = excluded.artists_id',
+                [(t['id'], t['uri'], t['popularity'], t['album'], t['name'], t['release_date'], t['thumbnail_url'],
+                  json.dumps(t['artists']), json.dumps(t['artists_id'])) for t in tracks])
+            conn.executemany('DELETE FROM track_artists WHERE track_id = ?', [(t['id'],) for t in tracks])
+            conn.executemany('INSERT OR REPLACE INTO track_artists (track_id, artist_id, position) VALUES (?, ?, ?)',
+                             [(t['id'], artist_id, i) for t in tracks for i, artist_id in enumerate(t['artists_id'])])
+            conn.executemany('INSERT OR REPLACE INTO playlist_tracks (playlist_id, track_id, position) VALUES (?, ?, ?)',
+                             [(playlist_id, t['id'], t.get('position', start_position + i))
+                              for i, t in enumerate(tracks)])
+            conn.execute('INSERT INTO playlists (id, updated_at, version) VALUES (?, ?, ?) '
+                         'ON CONFLICT (id) DO UPDATE SET updated_at = excluded.updated_at, '
+                         'version = MAX(playlists.version + 1, excluded.version)',
+                         (playlist_id, time.time(), time.time_ns()))
+
+    def track_ids(self, playlist_id):
+        rows = self.query('SELECT track_id FROM playlist_tracks WHERE playlist_id = ? ORDER BY position',
+                          (playlist_id,))
+        return [row[0] for row in rows]
+
+    def count_tracks(self, playlist_id):
+        return self.query('SELECT COUNT(*) FROM playlist_tracks WHERE playlist_id = ?', (playlist_id,))[0][0]
+
+    def prune_playlist(self, playlist_id, track_ids):
+        """Removes every track not in track_ids from playlist_id and returns how many were removed."""
+        removed = [track_id for track_id in self.track_ids(playlist_id) if track_id not in track_ids]
+        with self.transaction() as conn:
+            conn.executemany('DELETE FROM playlist_tracks WHERE playlist_id = ? AND track_id = ?',
+                             [(playlist_id, track_id) for track_id in removed])
+            if removed:
+                self._bump_versions(conn, 'id = ?', [playlist_id])
+        return len(removed)
+
+    def snapshot_id(self, playlist_id):
+        rows = self.query('SELECT snapshot_id FROM playlists WHERE id = ?', (playlist_id,))
+        return rows[0][0] if rows else None
+
+    def set_snapshot_id(self, playlist_id, snapshot_id):
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO playlists (id, snapshot_id, updated_at) VALUES (?, ?, ?) '
+                         'ON CONFLICT (id) DO UPDATE SET snapshot_id = excluded.snapshot_id, '
+                         'updated_at = excluded.updated_at', (playlist_id, snapshot_id, time.time()))
+
+    def playlist_name(self, playlist_id):
+        rows = self.query('SELECT name FROM playlists WHERE id = ?', (playlist_id,))
+        return rows[0][0] if rows else None
+
+    def set_playlist_name(self, playlist_id, name):
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO playlists (id, name, updated_at) VALUES (?, ?, ?) '
+                         'ON CONFLICT (id) DO UPDATE SET name = excluded.name', (playlist_id, name, time.time()))
+
+    # Libraries
+
+    def set_library(self, library_id, sources, name):
+        """Records library_id as the union of the playlists in sources, filled in by merge_playlists."""
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO playlists (id, name, sources, updated_at) VALUES (?, ?, ?, ?) '
+                         'ON CONFLICT (id) DO UPDATE SET name = excluded.name, sources = excluded.sources',
+                         (library_id, name, json.dumps(list(sources)), time.time()))
+
+    def library_sources(self, playlist_id):
+        """Returns the source playlist ids of a library, None for a plain playlist."""
+        rows = self.query('SELECT sources FROM playlists WHERE id = ?', (playlist_id,))
+        return json.loads(rows[0][0]) if rows and rows[0][0] is not None else None
+
+    def merge_playlists(self, library_id, sources):
+        """Replaces library_id's tracks with the tracks of the playlists in sources, each track once at its
+        first appearance. Returns (unique tracks, tracks in all sources)."""
+        track_ids = [track_id for source in sources for track_id in self.track_ids(source)]
+        unique = list(dict.fromkeys(track_ids))
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM playlist_tracks WHERE playlist_id = ?', (library_id,))
+            conn.executemany('INSERT INTO playlist_tracks (playlist_id, track_id, position) VALUES (?, ?, ?)',
+                             [(library_id, track_id, position) for position, track_id in enumerate(unique)])
+            conn.execute('UPDATE playlists SET updated_at = ? WHERE id = ?', (time.time(), library_id))
+            self._bump_versions(conn, 'id = ?', [library_id])
+        return len(unique), len(track_ids)
+
+    def tracks_missing_genres(self, playlist_id):
+        rows = self.query('SELECT t.id FROM playlist_tracks p JOIN tracks t ON t.id = p.track_id '
+                          'WHERE p.playlist_id = ? AND t.genres IS NULL ORDER BY p.position', (playlist_id,))
+        return [row[0] for row in rows]
+
+    def playlist_genres(self, playlist_id):
+        """Returns the genre tuple of each track in playlist_id, None for tracks without genres yet."""
+        rows = self.query('SELECT t.genres FROM playlist_tracks p JOIN tracks t ON t.id = p.track_id '
+                          'WHERE p.playlist_id = ? ORDER BY p.position', (playlist_id,))
+        return [tuple(json.loads(row[0])) if row[0] is not None else None for row in rows]
+
+    @staticmethod
+    def _bump_versions(conn, where, params):
+        """Bumps the version of the playlists matching where. Versions start from the clock so they never repeat,
+        even in a recreated database."""
+        conn.execute(f'UPDATE playlists SET version = MAX(version + 1, ?) WHERE {where}', [time.time_ns(), *params])
+
+    def _bump_track_versions(self, conn, track_ids):
+        """Bumps the version of every playlist holding one of track_ids."""
+        track_ids = list(track_ids)
+        for offset in range(0, len(track_ids), 500):
+            chunk = track_ids[offset:offset + 500]
+            self._bump_versions(conn, 'id IN (SELECT playlist_id FROM playlist_tracks '
+                                f'WHERE track_id IN ({", ".join("?" for _ in chunk)}))', chunk)
+
+    def playlist_version(self, playlist_id):
+        """Returns a number that changes whenever playlist_id's tracks, their genres or their audio features do,
+        to tell whether something derived from them is stale."""
+        rows = self.query('SELECT version FROM playlists WHERE id = ?', (playlist_id,))
+        return rows[0][0] if rows else 0
+
+    def playlist_feature_rows(self, playlist_id):
+        """Returns (track ids, genre tuples, audio feature rows) of playlist_id's tracks in playlist order, with
+        None for genres and features not fetched yet."""
+        rows = self.query(f'SELECT p.track_id, t.genres, {", ".join(f"f.{feature}" for feature in AUDIO_FEATURES)} '
+                          'FROM playlist_tracks p JOIN tracks t ON t.id = p.track_id '
+                          'LEFT JOIN audio_features f ON f.id = p.track_id '
+                          'WHERE p.playlist_id = ? ORDER BY p.position', (playlist_id,))
+        return ([row[0] for row in rows],
+                [tuple(json.loads(row[1])) if row[1] is not None else None for row in rows],
+                [row[2:] for row in rows])
+
+    def set_track_genres(self, genres):
+        """genres maps track id to a tuple of genre names."""
+        with self.transaction() as conn:
+            conn.executemany('UPDATE tracks SET genres = ? WHERE id = ?',
+                             [(json.dumps(list(g)), track_id) for track_id, g in genres.items()])
+            self._bump_track_versions(conn, genres)
+
+    def load_playlist(self, playlist_id):
+        """Returns the playlist's tracks with genres and audio features, indexed by track id."""
+        return self._playlist_frame('WHERE p.playlist_id = ? ORDER BY p.position', (playlist_id,))
+
+    def iter_playlist(self, playlist_id, chunk_size=1000):
+        """Yields the frame load_playlist returns in chunks of chunk_size tracks, each from its own query,
+        so only one chunk is in memory at a time."""
+        position, track_id = -1, ''
+        while True:
+            df = self._playlist_frame('WHERE p.playlist_id = ? AND (p.position, p.track_id) > (?, ?) '
+                                      'ORDER BY p.position, p.track_id LIMIT ?',
+                                      (playlist_id, position, track_id, chunk_size), with_position=True)
+            if df.empty:
+                return
+            position, track_id = int(df['position'].iloc[-1]), df.index[-1]
+            yield df.drop(columns='position')
+            if len(df) < chunk_size:
+                return
+
+    def playlist(self, playlist_id, chunk_size=1000, exclude=()):
+        """Returns a LazyPlaylist over playlist_id's tracks, leaving out the track ids in exclude."""
+        return LazyPlaylist(self, playlist_id, chunk_size, exclude)
+
+    def _playlist_frame(self, where, params, with_position=False):
+        import pandas as pd
+        columns = ', '.join([f't.{c}' for c in TRACK_COLUMNS + ['artists', 'artists_id', 'genres']] +
+                            [f'f.{feature}' for feature in AUDIO_FEATURES] + ['p.position'])
+        df = pd.read_sql_query(f'SELECT t.id, {columns} FROM playlist_tracks p '
+                               'JOIN tracks t ON t.id = p.track_id '
+                               f'LEFT JOIN audio_features f ON f.id = p.track_id {where}',
+                               self._connection(), params=params, index_col='id')
+        df['artists'] = df['artists'].map(json.loads)
+        df['artists_id'] = df['artists_id'].map(json.loads)
+        df['genres'] = df['genres'].map(lambda g: tuple(json.loads(g)) if isinstance(g, str) else None)
+        return df[TRACK_COLUMNS[:3] + ['artists', 'artists_id'] + TRACK_COLUMNS[3:] + ['genres'] + AUDIO_FEATURES +
+                  (['position'] if with_position else [])]
+
+    def load_track_artists(self, track_ids):
+        """Returns the artists_id list of each of track_ids, indexed by track id."""
+        df = self._read_ids('SELECT id, artists_id FROM tracks', track_ids, ['artists_id'])
+        df['artists_id'] = df['artists_id'].map(json.loads)
+        return df
+
+    def _read_ids(self, select, ids, columns):
+        """Reads select restricted to rows whose id is in ids into a frame indexed by id, querying in
+        chunks that stay below SQLite's bound-variable limit."""
+        import pandas as pd
+        ids = list(ids)
+        frames = [pd.read_sql_query(f'{select} WHERE id IN ({", ".join("?" for _ in chunk)})',
+                                    self._connection(), params=chunk, index_col='id')
+                  for chunk in (ids[i:i + 500] for i in range(0, len(ids), 500))]
+        if not frames:
+            return pd.DataFrame({column: [] for column in columns}, index=pd.Index([], name='id'), dtype=object)
+        return pd.concat(frames)
+
+    # Artists
+
+    def missing_artist_ids(self, playlist_id):
+        rows = self.query('SELECT DISTINCT a.artist_id FROM playlist_tracks p '
+                          'JOIN track_artists a ON a.track_id = p.track_id '
+                          'LEFT JOIN artists ar ON ar.id = a.artist_id '
+                          'WHERE p.playlist_id = ? AND ar.id IS NULL', (playlist_id,))
+        return [row[0] for row in rows]
+
+    def upsert_artists(self, artists, fetched_at=None):
+        now = time.time() if fetched_at is None else fetched_at
+        with self.transaction() as conn:
+            conn.executemany('INSERT OR REPLACE INTO artists (id, genres, popularity, fetched_at, last_used) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             [(a['id'], json.dumps(list(a['genres'])), a['popularity'], now, now) for a in artists])
+
+    def artists_by_id(self, artist_ids):
+        """Returns {artist id: {'genres', 'popularity', 'fetched_at'}} for the stored ones of artist_ids."""
+        import pandas as pd
+        df = self._read_ids('SELECT id, genres, popularity, fetched_at FROM artists', artist_ids,
+                            ['genres', 'popularity', 'fetched_at'])
+        return {artist_id: {'genres': tuple(json.loads(genres)), 'popularity': popularity,
+                            'fetched_at': fetched_at if pd.notna(fetched_at) else None}
+                for artist_id, genres, popularity, fetched_at in df.itertuples(name=None)}
+
+    def touch_artists(self, last_used):
+        """last_used maps artist id to when it was last used. Later uses already recorded are kept."""
+        with self.transaction() as conn:
+            conn.executemany('UPDATE artists SET last_used = MAX(COALESCE(last_used, 0), ?) WHERE id = ?',
+                             [(used, artist_id) for artist_id, used in last_used.items()])
+
+    def evict_artists(self, max_entries):
+        """Deletes the least recently used artists beyond max_entries and returns how many were deleted."""
+        excess = self.query('SELECT COUNT(*) FROM artists')[0][0] - max_entries
+        if excess <= 0:
+            return 0
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM artists WHERE id IN '
+                         '(SELECT id FROM artists ORDER BY last_used IS NOT NULL, last_used LIMIT ?)', (excess,))
+        return excess
+
+    def reset_track_genres(self, artist_ids):
+        """Clears the genres of every track by artist_ids so they are recomputed."""
+        artist_ids = list(artist_ids)
+        with self.transaction() as conn:
+            for offset in range(0, len(artist_ids), 500):
+                chunk = artist_ids[offset:offset + 500]
+                tracks = f'SELECT track_id FROM track_artists WHERE artist_id IN ({", ".join("?" for _ in chunk)})'
+                conn.execute(f'UPDATE tracks SET genres = NULL WHERE id IN ({tracks})', chunk)
+                self._bump_versions(conn, 'id IN (SELECT playlist_id FROM playlist_tracks '
+                                    f'WHERE track_id IN ({tracks}))', chunk)
+
+    def artist_ids(self, playlist_id):
+        rows = self.query('SELECT DISTINCT a.artist_id FROM playlist_tracks p '
+                          'JOIN track_artists a ON a.track_id = p.track_id WHERE p.playlist_id = ?', (playlist_id,))
+        return [row[0] for row in rows]
+
+    def _existing_ids(self, table, ids):
+        found = set()
+        ids = list(ids)
+        # Stay below SQLite's bound-variable limit
+        for offset in range(0, len(ids), 500):
+            chunk = ids[offset:offset + 500]
+            rows = self.query(f'SELECT id FROM {table} WHERE id IN ({", ".join("?" for _ in chunk)})', chunk)
+            found.update(row[0] for row in rows)
+        return found
+
+    # Audio features
+
+    def existing_audio_feature_ids(self, track_ids):
+        return self._existing_ids('audio_features', track_ids)
+
+    def tracks_missing_audio_features(self, playlist_id):
+        rows = self.query('SELECT p.track_id FROM playlist_tracks p '
+                          'LEFT JOIN audio_features f ON f.id = p.track_id '
+                          'WHERE p.playlist_id = ? AND f.id IS NULL ORDER BY p.position', (playlist_id,))
+        return [row[0] for row in rows]
+
+    def upsert_audio_features(self, df_features):
+        """df_features holds one row of AUDIO_FEATURES per track, indexed by track id."""
+        rows = df_features[AUDIO_FEATURES].astype(object).where(df_features[AUDIO_FEATURES].notna(), None)
+        with self.transaction() as conn:
+            conn.executemany(f'INSERT OR REPLACE INTO audio_features (id, {", ".join(AUDIO_FEATURES)}) '
+                             f'VALUES (?, {", ".join("?" for _ in AUDIO_FEATURES)})',
+                             rows.itertuples(name=None))
+            self._bump_track_versions(conn, rows.index)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class LazyPlaylist:
+    """A playlist read from a TrackStore chunk by chunk.
+
+    Supports len() and iterrows() like the frame load_playlist returns, so tracks can be consumed one
+    at a time without ever holding the whole playlist in memory. load() reads it whole.
+    """
+
+    def __init__(self, store, playlist_id, chunk_size=1000, exclude=()):
+        self.store = store
+        self.playlist_id = playlist_id
+        self.chunk_size = chunk_size
+        self.exclude = set(exclude)
+
+    def __len__(self):
+        total = self.store.count_tracks(self.playlist_id)
+        if self.exclude:
+            total -= len(self.exclude.intersection(self.store.track_ids(self.playlist_id)))
+        return total
+
+    def chunks(self):
+        for df in self.store.iter_playlist(self.playlist_id, self.chunk_size):
+            if self.exclude:
+                df = df[~df.index.isin(self.exclude)]
+            if len(df):
+                yield df
+
+    def iterrows(self):
+        for df in self.chunks():
+            yield from df.iterrows()
+
+    def load(self):
+        df = self.store.load_playlist(self.playlist_id)
+        return df[~df.index.isin(self.exclude)] if self.exclude else df
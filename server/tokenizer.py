@@ -0,0 +1,37 @@
+import logging
+import math
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Used when tiktoken or its encoding files are unavailable; English text averages about 4 characters per token
+CHARS_PER_TOKEN = 3.5
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model(model)
+    except Exception as e:
+        logger.warning(f'Falling back to estimated token counts for {model}: {e}')
+        return None
+
+
+def count_tokens(text, model='gpt-3.5-turbo'):
+    encoding = _encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+
+def truncate_to_tokens(text, max_tokens, model='gpt-3.5-turbo'):
+    """Cuts text to at most max_tokens tokens, on a line boundary when there is one."""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    encoding = _encoding(model)
+    if encoding is None:
+        text = text[:int(max_tokens * CHARS_PER_TOKEN)]
+    else:
+        text = encoding.decode(encoding.encode(text)[:max_tokens])
+    return text.rsplit('\n', 1)[0] if '\n' in text else text
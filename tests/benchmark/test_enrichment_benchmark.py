@@ -0,0 +1,88 @@
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, '../../server')
+sys.path.insert(0, '../../')
+from server.enrich import track_genres, audio_features_frame
+from server.store import AUDIO_FEATURES
+
+NUM_TRACKS = int(os.environ.get('BENCHMARK_TRACKS', 50000))
+NUM_ARTISTS = int(os.environ.get('BENCHMARK_ARTISTS', 20000))
+
+
+def legacy_add_genre_information(df, df_artists):
+    # add_genre_information_to_tracks before vectorization, minus the pickle I/O
+    items = []
+    for i, x in df.iterrows():
+        genres = set()
+        for artist_id in x['artists_id']:
+            artist = df_artists.loc[artist_id]
+            for genre in artist['genres']:
+                if genre not in genres:
+                    genres.add(genre)
+        items.append({'id': i, 'genres': tuple(genres)})
+    return pd.DataFrame(items).set_index('id')['genres']
+
+
+def legacy_add_audio_features(df, results):
+    # The per-track audio-feature merge before vectorization, minus the Spotify and pickle I/O
+    df = df.copy()
+    for audio_features in results:
+        for feature in AUDIO_FEATURES:
+            df.loc[audio_features['id'], feature] = audio_features[feature]
+    return df
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    rng = random.Random(0)
+    genres = [f'genre {i}' for i in range(2000)]
+    df_artists = pd.DataFrame({'id': [f'artist{i}' for i in range(NUM_ARTISTS)],
+                               'genres': [rng.sample(genres, rng.randint(0, 5)) for _ in range(NUM_ARTISTS)],
+                               'popularity': [rng.randint(0, 100) for _ in range(NUM_ARTISTS)]}).set_index('id')
+    df = pd.DataFrame({'id': [f'track{i}' for i in range(NUM_TRACKS)],
+                       'name': [f'Song {i}' for i in range(NUM_TRACKS)],
+                       'artists_id': [[f'artist{rng.randrange(NUM_ARTISTS)}' for _ in range(rng.randint(1, 3))]
+                                      for _ in range(NUM_TRACKS)]}).set_index('id')
+    np_rng = np.random.default_rng(0)
+    results = [{'id': track_id, **{f: float(v) for f, v in zip(AUDIO_FEATURES, np_rng.random(len(AUDIO_FEATURES)))}}
+               for track_id in df.index]
+    return df, df_artists, results
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def test_track_genres_matches_legacy(dataset):
+    df, df_artists, _ = dataset
+
+    expected, legacy_time = timed(legacy_add_genre_information, df, df_artists)
+    actual, vectorized_time = timed(track_genres, df, df_artists)
+
+    print(f'\ngenres: legacy {legacy_time:.2f}s, vectorized {vectorized_time:.2f}s '
+          f'({legacy_time / vectorized_time:.0f}x) over {NUM_TRACKS} tracks, {NUM_ARTISTS} artists')
+    assert actual.index.tolist() == expected.index.tolist()
+    # The legacy tuples come from a set, so only their contents are comparable
+    assert actual.map(frozenset).equals(expected.map(frozenset))
+    assert vectorized_time < legacy_time
+
+
+def test_audio_features_match_legacy(dataset):
+    df, _, results = dataset
+
+    expected, legacy_time = timed(legacy_add_audio_features, df, results)
+    actual, vectorized_time = timed(lambda: df.join(audio_features_frame(results)))
+
+    print(f'\naudio features: legacy {legacy_time:.2f}s, vectorized {vectorized_time:.2f}s '
+          f'({legacy_time / vectorized_time:.0f}x) over {NUM_TRACKS} tracks')
+    pd.testing.assert_frame_equal(actual, expected)
+    assert vectorized_time < legacy_time
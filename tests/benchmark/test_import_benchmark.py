@@ -0,0 +1,70 @@
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+
+import pytest
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+NUM_RUNS = int(os.environ.get('BENCHMARK_IMPORT_RUNS', 5))
+# A git revision whose server to time as well, e.g. the one before the LLM clients were built on first use
+BASELINE = os.environ.get('BENCHMARK_IMPORT_BASELINE')
+
+IMPORT_APP = """
+import json, sys, time
+sys.path.insert(0, {server!r})
+start = time.perf_counter()
+import app
+imported = time.perf_counter() - start
+if {build_chains}:
+    from llms import LazyChain
+    for value in vars(sys.modules['lib']).values():
+        if isinstance(value, LazyChain):
+            value.chain
+print(json.dumps({{'imported': imported, 'seconds': time.perf_counter() - start,
+                  'modules': len({{m.split('.')[0] for m in sys.modules}})}}))
+"""
+
+
+def cold_import(server, cwd, build_chains=False, api_key=None):
+    """Median of NUM_RUNS imports of server's app, each in a fresh interpreter."""
+    env = {k: v for k, v in os.environ.items() if k != 'OPENAI_API_KEY'}
+    if api_key:
+        env['OPENAI_API_KEY'] = api_key
+    runs = []
+    for _ in range(NUM_RUNS):
+        output = subprocess.run([sys.executable, '-c', IMPORT_APP.format(server=server, build_chains=build_chains)],
+                                cwd=cwd, env=env, capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+    return {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+
+def test_cold_import_time(tmp_path):
+    (tmp_path / 'logs').mkdir()
+    lazy = cold_import(os.path.join(REPO, 'server'), tmp_path)
+    # Building every chain needs a key, though nothing is sent
+    used = cold_import(os.path.join(REPO, 'server'), tmp_path, build_chains=True, api_key='sk-fake')
+
+    print(f"\ncold import of app: {lazy['seconds']:.2f}s, {lazy['modules']} top-level modules; "
+          f"{used['seconds']:.2f}s once every LLM chain is built")
+    assert lazy['seconds'] < used['seconds']
+
+
+@pytest.mark.skipif(not BASELINE, reason='set BENCHMARK_IMPORT_BASELINE to a git revision to compare with')
+def test_cold_import_time_against_baseline(tmp_path):
+    archive = subprocess.run(['git', 'archive', BASELINE, 'server'], cwd=REPO, capture_output=True,
+                             check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(tmp_path / 'baseline')
+    (tmp_path / 'logs').mkdir()
+
+    current = cold_import(os.path.join(REPO, 'server'), tmp_path)
+    # Servers that built their LLM clients on import need a key
+    baseline = cold_import(str(tmp_path / 'baseline' / 'server'), tmp_path, api_key='sk-fake')
+
+    print(f"\ncold import of app: {current['seconds']:.2f}s, {current['modules']} top-level modules; "
+          f"{baseline['seconds']:.2f}s, {baseline['modules']} at {BASELINE}")
+    assert current['seconds'] < baseline['seconds']
@@ -0,0 +1,152 @@
+import os
+import random
+import re
+import string
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, '../../server')
+sys.path.insert(0, '../../')
+from server.parsing import ParseError, parse_answer, parse_categories
+
+NUM_FUZZ = int(os.environ.get('BENCHMARK_PARSE_FUZZ', 2000))
+ADVERSARIAL_SIZE = int(os.environ.get('BENCHMARK_PARSE_SIZE', 20000))
+
+
+def legacy_parse_categories(output):
+    # get_categories before the parsing layer
+    matches = re.findall(r"(\d+)\.\s*([^:]+):\s*((?:.(?!\n\s*\d+\.))+.)", output, re.DOTALL)
+    return {int(num): (name.strip(), desc.strip()) for num, name, desc in matches}
+
+
+def legacy_parse_answer(output):
+    # categorize_track before the parsing layer
+    match = re.search(r"Category number: (\d+)\s+Category name: ([\w\s]+)\s+Reasoning: (.+)", output, re.DOTALL)
+    return int(match.group(1)) if match else None
+
+
+# Answers a person reads without trouble, with the category number each gives
+READABLE_ANSWERS = [
+    ('Category number: 2\nCategory name: Late-Night Jazz!\nReasoning: Bebop.', 2),
+    ('Category number: 1\nCategory name: Rock & Roll (Classic)\nReasoning: Guitars.', 1),
+    ('**Category number:** 3\n**Category name:** Pop\n**Reasoning:** Hooks.', 3),
+    ('Category Number: 4\nCategory Name: Hip-Hop/Rap\n\nReasoning: Beats.', 4),
+    ('{"category_number": 2, "category_name": "Jazz", "reasoning": "Bebop."}', 2),
+    ('```json\n{"category_number": "5", "category_name": "Folk"}\n```', 5),
+    ('Sure! {"category": 1, "reason": "rock"} Hope that helps.', 1),
+    ('Category number: 3\nReasoning: No name line.', 3),
+    ('Category number: 2 - Category name: Jazz - Reasoning: All on one line.', 2),
+    ('- Category number: **6**\n- Category name: Electronic\n- Reasoning: Synths.', 6),
+]
+
+READABLE_CATEGORIES = [
+    '1. **Rock & Roll**: Guitars.\n\n2. **Late-Night Jazz!**: Bebop.',
+    '1. Rock: Guitars.\n2. Jazz: Bebop.',
+    '1) Rock - Guitars.\n2) Jazz - Bebop.',
+    '**1. Rock:** Guitars.\n**2. Jazz:** Bebop.',
+    '### 1. Rock\nGuitars and drums.\n### 2. Jazz\nBebop.',
+    '[{"category_number": 1, "category_name": "Rock", "description": "Guitars."},'
+    ' {"category_number": 2, "category_name": "Jazz", "description": "Bebop."}]',
+    '{"categories": [{"number": 1, "name": "Rock", "description": "Guitars."},'
+    ' {"number": 2, "name": "Jazz", "description": "Bebop."}]}',
+    'Category 1: Rock: Guitars.\nCategory 2: Jazz: Bebop.',
+]
+
+
+def adversarial_outputs(rng, size):
+    """Outputs built to make backtracking parsers slow or lenient parsers crash."""
+    yield '1.' + 'a' * size
+    yield '1. a' + '\n ' * size
+    yield ('1. ' + 'x' * 10 + ':' + ' ' * 10) * (size // 24)
+    yield '[' * size + ']' * size
+    yield '{' * size
+    yield '{"category_number": ' * (size // 20)
+    yield 'Category number:' * (size // 16)
+    yield 'Category name: ' + 'a ' * (size // 2)
+    yield '\n'.join(f'{i}. ' for i in range(size // 4))
+    yield ''.join(rng.choice('{}[]":,.0123456789\n *#') for _ in range(size))
+
+
+def random_output(rng):
+    alphabet = string.printable + 'éü—–•“”'
+    pieces = ['Category number:', 'Category name:', 'Reasoning:', 'Confidence:', '{', '}', '[', ']', '"category": ',
+              '1. ', '2) ', '**', '```json', '\n', ': ', ' - ', str(rng.randint(-5, 200)), 'null', 'true']
+    parts = []
+    for _ in range(rng.randint(0, 30)):
+        if rng.random() < 0.5:
+            parts.append(rng.choice(pieces))
+        else:
+            parts.append(''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 20))))
+    return ''.join(parts)
+
+
+def test_parsers_only_raise_parse_errors_on_random_outputs():
+    rng = random.Random(0)
+    read = 0
+    for _ in range(NUM_FUZZ):
+        output = random_output(rng)
+        for parse in (parse_answer, parse_categories):
+            try:
+                result = parse(output)
+            except ParseError as e:
+                assert e.cause in ('empty', 'missing_number', 'no_categories')
+                continue
+            read += 1
+            if parse is parse_answer:
+                assert isinstance(result['category_number'], int)
+            else:
+                assert all(isinstance(category['category_number'], int) for category in result)
+                assert len({category['category_number'] for category in result}) == len(result)
+    print(f'\n\n{NUM_FUZZ} random outputs: {read} of {2 * NUM_FUZZ} parses read something')
+
+
+@pytest.mark.parametrize('parse', [parse_answer, parse_categories])
+def test_parsers_run_in_linear_time_on_adversarial_outputs(parse):
+    rng = random.Random(0)
+
+    def seconds(size):
+        times = []
+        for output in adversarial_outputs(rng, size):
+            start = time.perf_counter()
+            try:
+                parse(output)
+            except ParseError:
+                pass
+            times.append(time.perf_counter() - start)
+        return times
+
+    small, large = seconds(ADVERSARIAL_SIZE // 10), seconds(ADVERSARIAL_SIZE)
+    print(f'\n\n{parse.__name__}: {sum(small) * 1000:.1f}ms at {ADVERSARIAL_SIZE // 10} characters, '
+          f'{sum(large) * 1000:.1f}ms at {ADVERSARIAL_SIZE}')
+    # 10x the input may cost about 10x the time, quadratic parsing would cost 100x
+    for t_small, t_large in zip(small, large):
+        assert t_large < max(30 * t_small, 0.05)
+
+
+def test_legacy_category_regex_backtracks():
+    output = '1. a' * (ADVERSARIAL_SIZE // 40)
+    start = time.perf_counter()
+    legacy_parse_categories(output)
+    legacy = time.perf_counter() - start
+    start = time.perf_counter()
+    parse_categories(output)
+    current = time.perf_counter() - start
+    print(f'\n\n{len(output)} characters of numbers without a colon: legacy regex {legacy * 1000:.1f}ms, '
+          f'parse_categories {current * 1000:.2f}ms')
+    assert current < legacy
+
+
+def test_readable_answers_are_read():
+    legacy = sum(legacy_parse_answer(output) == number for output, number in READABLE_ANSWERS)
+    current = sum(parse_answer(output)['category_number'] == number for output, number in READABLE_ANSWERS)
+    legacy_lists = sum(len(legacy_parse_categories(output)) == 2 for output in READABLE_CATEGORIES)
+    current_lists = sum([category['category_name'] for category in parse_categories(output)] in
+                        (['Rock & Roll', 'Late-Night Jazz!'], ['Rock', 'Jazz']) for output in READABLE_CATEGORIES)
+    print(f'\n\nanswers read: legacy {legacy}/{len(READABLE_ANSWERS)}, now {current}/{len(READABLE_ANSWERS)}')
+    print(f'category lists read: legacy {legacy_lists}/{len(READABLE_CATEGORIES)}, '
+          f'now {current_lists}/{len(READABLE_CATEGORIES)}')
+
+    assert current == len(READABLE_ANSWERS)
+    assert current_lists == len(READABLE_CATEGORIES)
@@ -0,0 +1,126 @@
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import Counter
+from unittest.mock import patch
+
+import pytest
+
+sys.path.insert(0, '../../server')
+sys.path.insert(0, '../../')
+# The server recovers jobs from its default job store on import, kept out of the working directory here
+os.environ.setdefault('JOB_STORE_PATH', os.path.join(tempfile.mkdtemp(), 'jobs.sqlite'))
+# app imports lib as a top-level module, so the benchmark patches that same module
+import lib
+import metrics
+from app import app
+from artists import ArtistCache
+from cache import CategorizationCache
+from engine import SingleFlight
+from features import FeatureCache
+from store import TrackStore
+from tests.fake_spotify import FakeSpotifyServer
+from tests.fake_llm import FakeLLM
+
+SIZES = [int(size) for size in os.environ.get('BENCHMARK_PIPELINE_SIZES', '100,1000,10000,50000').split(',')]
+NUM_CATEGORIES = int(os.environ.get('BENCHMARK_CATEGORIES', 6))
+SPOTIFY_LATENCY = float(os.environ.get('BENCHMARK_SPOTIFY_LATENCY', 0.0))
+LLM_LATENCY = float(os.environ.get('BENCHMARK_LLM_LATENCY', 0.0))
+RATE_LIMIT_EVERY = int(os.environ.get('BENCHMARK_RATE_LIMIT_EVERY', 0))
+BATCH_SIZE = int(os.environ.get('BENCHMARK_BATCH_SIZE', 1))
+# Each run's results are appended here as one JSON line, so regressions can be tracked over time
+REPORT_PATH = os.environ.get('BENCHMARK_REPORT')
+
+results = []
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def stage_totals():
+    return {stage: (metrics.stage_seconds.count(stage=stage), metrics.stage_seconds.total(stage=stage))
+            for stage in metrics.stage_seconds.label_values('stage')}
+
+
+@pytest.fixture(scope='module', autouse=True)
+def report():
+    yield
+    if not results:
+        return
+    print('\n\nsize      endpoint     wall(s)  peak RSS(MB)  spotify calls  llm calls')
+    for result in results:
+        for endpoint in ('categories', 'generate'):
+            print(f"{result['tracks']:<9} {endpoint:<12} {result[endpoint]['seconds']:>7.2f}  "
+                  f"{result[endpoint]['peak_rss_mb']:>12.0f}  {sum(result[endpoint]['spotify_calls'].values()):>13}  "
+                  f"{sum(result[endpoint]['llm_calls'].values()):>9}")
+        for stage, (count, seconds) in sorted(result['stages'].items(), key=lambda item: -item[1][1]):
+            print(f'    {stage:<36} {seconds:>8.2f}s over {count} calls')
+    if REPORT_PATH:
+        with open(REPORT_PATH, 'a') as f:
+            f.write(json.dumps({'time': time.time(), 'results': results}) + '\n')
+
+
+def run_endpoint(fn, spotify, llm):
+    spotify_calls, llm_calls = Counter(spotify.calls), Counter(llm.calls)
+    start = time.perf_counter()
+    value = fn()
+    seconds = time.perf_counter() - start
+    return value, {'seconds': seconds,
+                   'peak_rss_mb': peak_rss_mb(),
+                   'spotify_calls': dict(Counter(spotify.calls) - spotify_calls),
+                   'llm_calls': dict(Counter(llm.calls) - llm_calls)}
+
+
+# Sizes run in increasing order, so the process-wide peak RSS after a run is that size's peak
+@pytest.mark.parametrize('num_tracks', sorted(SIZES))
+def test_pipeline_end_to_end(num_tracks, tmp_path):
+    client = app.test_client()
+    llm = FakeLLM(latency=LLM_LATENCY)
+    token = f'benchmark-{num_tracks}'
+    store = TrackStore(str(tmp_path / 'tracks.sqlite'))
+    cache = CategorizationCache(str(tmp_path / 'categorizations.sqlite'))
+
+    with FakeSpotifyServer(num_tracks=num_tracks, num_artists=max(10, min(num_tracks // 2, 20000)),
+                           latency=SPOTIFY_LATENCY, rate_limit_every=RATE_LIMIT_EVERY) as spotify, \
+            patch.dict(os.environ, {'SPOTIFY_API_URL': spotify.url}), \
+            patch.object(lib, 'track_store', store), \
+            patch.object(lib, 'artist_cache', ArtistCache(store)), \
+            patch.object(lib, 'feature_cache', FeatureCache(store)), \
+            patch.object(lib, 'categorization_cache', cache), \
+            patch.object(lib, 'single_flight', SingleFlight(ttl=lib.COALESCE_TTL)), \
+            llm.patch(lib):
+        stages = stage_totals()
+
+        response, categories_result = run_endpoint(
+            lambda: client.get(f'/categories?token={token}&playlist_id=playlist&num_categories={NUM_CATEGORIES}'),
+            spotify, llm)
+        assert response.status_code == 200
+        categories = response.json
+        assert len(categories) == NUM_CATEGORIES
+        assert 'genre 1 (' in llm.genres_text
+
+        def generate():
+            response = client.post(f'/generate?token={token}&playlist_id=playlist&batch_size={BATCH_SIZE}',
+                                   json={'categories': categories})
+            return json.loads(response.get_data(as_text=True))
+
+        tracks, generate_result = run_endpoint(generate, spotify, llm)
+
+        after = stage_totals()
+        stages = {stage: (count - stages.get(stage, (0, 0.0))[0], seconds - stages.get(stage, (0, 0.0))[1])
+                  for stage, (count, seconds) in after.items() if count > stages.get(stage, (0, 0.0))[0]}
+
+    store.close()
+    cache.close()
+
+    assert len(tracks) == num_tracks
+    assert sum(len(uris) for uris in spotify.added.values()) == num_tracks
+    assert categories_result['spotify_calls']['playlist_tracks'] == -(-num_tracks // 100)
+    results.append({'tracks': num_tracks, 'categories': categories_result, 'generate': generate_result,
+                    'stages': stages})
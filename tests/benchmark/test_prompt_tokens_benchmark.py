@@ -0,0 +1,79 @@
+import os
+import random
+import sys
+import tempfile
+
+import pandas as pd
+
+sys.path.insert(0, '../../server')
+sys.path.insert(0, '../../')
+# The server recovers jobs from its default job store on import, kept out of the working directory here
+os.environ.setdefault('JOB_STORE_PATH', os.path.join(tempfile.mkdtemp(), 'jobs.sqlite'))
+import lib
+from tokenizer import count_tokens
+
+NUM_TRACKS = int(os.environ.get('BENCHMARK_PROMPT_TRACKS', 500))
+
+CATEGORIES = [
+    {'category_number': 1, 'category_name': 'Rock Anthems',
+     'description': 'Classic rock, hard rock and album rock with big guitar riffs and stadium-sized choruses.'},
+    {'category_number': 2, 'category_name': 'Late Night Jazz',
+     'description': 'Bebop, cool jazz and contemporary jazz with improvised solos and relaxed grooves.'},
+    {'category_number': 3, 'category_name': 'Dance Floor Pop',
+     'description': 'Dance pop, electropop and house-leaning pop with upbeat tempos and catchy hooks.'},
+    {'category_number': 4, 'category_name': 'Hip Hop Beats',
+     'description': 'Rap, trap and boom bap built on heavy beats and rhythmic vocal delivery.'},
+    {'category_number': 5, 'category_name': 'Acoustic Folk',
+     'description': 'Indie folk, singer-songwriter and americana centred on acoustic instruments and storytelling.'},
+    {'category_number': 6, 'category_name': 'Electronic Textures',
+     'description': 'Ambient, techno and downtempo electronica with synthesized soundscapes.'},
+]
+
+GENRES = ['classic rock', 'hard rock', 'album rock', 'bebop', 'cool jazz', 'contemporary jazz', 'dance pop',
+          'electropop', 'pop house', 'rap', 'trap', 'boom bap', 'indie folk', 'singer-songwriter', 'americana',
+          'ambient', 'techno', 'downtempo']
+
+# Typical answers, so completion tokens are compared as well
+FULL_ANSWER = ('Category number: 3\nCategory name: Dance Floor Pop\nReasoning: The song is tagged dance pop and '
+               'electropop, and its high energy and danceability match the upbeat, catchy sound of the category.')
+COMPACT_ANSWER = '{"category": 3}'
+
+
+def make_tracks(n):
+    rng = random.Random(0)
+    return pd.DataFrame([{'id': f'track{i}', 'name': f'Song Title Number {i}',
+                          'artists': [f'Artist {rng.randrange(1000)}' for _ in range(rng.randint(1, 2))],
+                          'album': f'Album {rng.randrange(500)}', 'release_date': f'{rng.randint(1960, 2023)}-01-01',
+                          'genres': tuple(rng.sample(GENRES, rng.randint(1, 4))), 'popularity': rng.randint(0, 100),
+                          'danceability': rng.random(), 'energy': rng.random(), 'key': rng.randrange(12),
+                          'loudness': -rng.uniform(2, 20), 'mode': rng.randrange(2), 'speechiness': rng.random() / 3,
+                          'acousticness': rng.random(), 'instrumentalness': rng.random() / 2,
+                          'liveness': rng.random() / 2, 'valence': rng.random(), 'tempo': rng.uniform(60, 180),
+                          'duration_ms': rng.randint(120000, 360000), 'time_signature': 4}
+                         for i in range(n)]).set_index('id')
+
+
+def test_compact_prompt_uses_fewer_tokens():
+    df = make_tracks(NUM_TRACKS)
+    categories_output = lib.format_categories(CATEGORIES)
+    model = lib.LLM_MODEL
+    header = lib.compact_header(categories_output)
+
+    full = sum(count_tokens(lib.prompt_categorize.format(categories_output=categories_output,
+                                                         **lib.track_prompt_values(track)), model)
+               for _, track in df.iterrows()) / len(df)
+    compact = sum(count_tokens(lib.prompt_categorize_compact.format(header=header,
+                                                                    song=lib.format_track_compact(track)), model)
+                  for _, track in df.iterrows()) / len(df)
+    # The shared header is what a prompt cache can serve, the rest is paid for on every track
+    header_tokens = count_tokens(header, model)
+    full_completion, compact_completion = count_tokens(FULL_ANSWER, model), count_tokens(COMPACT_ANSWER, model)
+
+    print(f'\n\nprompt    prompt tokens/track  shared header  uncached/track  completion tokens/track')
+    print(f'full      {full:>19.0f}  {"-":>13}  {full:>14.0f}  {full_completion:>23}')
+    print(f'compact   {compact:>19.0f}  {header_tokens:>13}  {compact - header_tokens:>14.0f}  '
+          f'{compact_completion:>23}')
+    print(f'compact/full: {(compact + compact_completion) / (full + full_completion):.0%} of the tokens per track')
+
+    assert compact < full
+    assert compact_completion < full_completion
@@ -0,0 +1,77 @@
+import json
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from contextlib import ExitStack
+from unittest.mock import patch
+
+
+class FakeLLM:
+    """Local stand-in for the LLM chains in server/lib.py that returns well-formed answers.
+
+    Categories are numbered placeholders, and each song is assigned a category by a stable hash of its
+    name, so runs are reproducible. latency is added to every call and calls counts calls per chain.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        # The genre summary the last categories prompt was given
+        self.genres_text = None
+        self._lock = threading.Lock()
+
+    def patch(self, lib):
+        """Returns a context manager replacing lib's chains with this fake."""
+        stack = ExitStack()
+        stack.enter_context(patch.object(lib, 'chain_categories', FakeChain(self.categories)))
+        stack.enter_context(patch.object(lib, 'chain_categorize', FakeChain(self.categorize)))
+        stack.enter_context(patch.object(lib, 'chain_categorize_batch', FakeChain(self.categorize_batch)))
+        stack.enter_context(patch.object(lib, 'chain_categorize_compact', FakeChain(self.categorize_compact)))
+        return stack
+
+    def _called(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def categories(self, num_categories, genres_text):
+        self._called('categories')
+        self.genres_text = genres_text
+        return '\n\n'.join(f'{n}. **Category {n}**: Songs sharing the genres of group {n}.'
+                           for n in range(1, int(num_categories) + 1))
+
+    @staticmethod
+    def choose(categories_output, name):
+        count = max(1, len(re.findall(r'^\d+\.', categories_output, re.MULTILINE)))
+        return zlib.crc32(name.encode('utf-8')) % count + 1
+
+    def categorize(self, categories_output, name, **kwargs):
+        self._called('categorize')
+        number = self.choose(categories_output, name)
+        return (f'Category number: {number}\nCategory name: Category {number}\n'
+                f'Reasoning: {name} shares the genres of group {number}.')
+
+    def categorize_compact(self, header, song):
+        self._called('categorize_compact')
+        return json.dumps({'category': self.choose(header, song.split(' by ')[0])})
+
+    def categorize_batch(self, categories_output, songs):
+        self._called('categorize_batch')
+        names = re.findall(r'^\s*Name: (.*)$', songs, re.MULTILINE)
+        answers = []
+        for n, name in enumerate(names, start=1):
+            number = self.choose(categories_output, name)
+            answers.append({'song': n, 'category_number': number, 'category_name': f'Category {number}',
+                            'reasoning': f'{name} shares the genres of group {number}.'})
+        return json.dumps(answers)
+
+
+class FakeChain:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def run(self, **kwargs):
+        return self.fn(**kwargs)
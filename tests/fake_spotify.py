@@ -0,0 +1,180 @@
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+AUDIO_FEATURES = ['acousticness', 'danceability', 'duration_ms', 'energy', 'instrumentalness', 'key', 'liveness',
+                  'loudness', 'mode', 'speechiness', 'tempo', 'time_signature', 'valence']
+
+
+class FakeSpotifyServer:
+    """Local stand-in for the parts of the Spotify Web API the server uses.
+
+    Serves one synthetic playlist per playlist id, and the saved tracks as playlist 'saved', with num_tracks
+    tracks drawn from num_artists artists.
+    latency is added to every response, and every rate_limit_every-th request is answered with a 429
+    and a Retry-After of retry_after seconds. Request counts per endpoint are kept in calls. Playlists in
+    private are answered with a 404, as Spotify does for a private playlist of another user.
+    """
+
+    def __init__(self, num_tracks=250, num_artists=100, latency=0.0, rate_limit_every=0, retry_after=0):
+        self.num_tracks = num_tracks
+        self.num_artists = num_artists
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.rate_limited = 0
+        self.snapshots = {}
+        self.removed = {}
+        self.added = {}
+        self.private = set()
+        self._requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_port}/v1/'
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # Synthetic data
+
+    def playlist_track_indices(self, playlist_id):
+        removed = self.removed.get(playlist_id)
+        if not removed:
+            return range(self.num_tracks)
+        return [i for i in range(self.num_tracks) if i not in removed]
+
+    def track(self, i):
+        artist_ids = sorted({f'artist{i % self.num_artists}', f'artist{(i * 7 + 3) % self.num_artists}'})
+        return {'id': f'track{i}', 'uri': f'spotify:track:track{i}', 'name': f'Song {i}', 'popularity': i % 100,
+                'album': {'name': f'Album {i // 10}', 'release_date': '2020-01-01',
+                          'images': [{'url': f'https://images.example/{i}.jpg'}]},
+                'artists': [{'id': artist_id, 'name': artist_id.title()} for artist_id in artist_ids]}
+
+    def artist(self, artist_id):
+        j = int(artist_id[len('artist'):])
+        return {'id': artist_id, 'name': artist_id.title(), 'popularity': j % 100,
+                'genres': [f'genre {j % 40}', f'genre {(j * 3) % 40}'] if j % 10 else []}
+
+    def audio_features(self, track_id):
+        i = int(track_id[len('track'):])
+        features = {feature: ((i * (n + 1)) % 100) / 100 for n, feature in enumerate(AUDIO_FEATURES)}
+        return {'id': track_id, **features}
+
+    # HTTP
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, headers=None):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+            def _throttle(self):
+                with fake._lock:
+                    fake._requests += 1
+                    limited = fake.rate_limit_every and fake._requests % fake.rate_limit_every == 0
+                    if limited:
+                        fake.rate_limited += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if limited:
+                    self._send(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                               {'Retry-After': str(fake.retry_after)})
+                return limited
+
+            def do_GET(self):
+                if self._throttle():
+                    return
+                url = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                path = url.path.rstrip('/')
+
+                match = re.fullmatch(r'/v1/playlists/([^/]+)(?:/.*)?', path)
+                if match and match.group(1) in fake.private:
+                    return self._send(404, {'error': {'status': 404, 'message': 'Resource not found'}})
+                if match := re.fullmatch(r'/v1/playlists/([^/]+)/(?:tracks|items)', path):
+                    fake.calls['playlist_tracks'] += 1
+                    indices = fake.playlist_track_indices(match.group(1))
+                    offset, limit = int(query.get('offset', 0)), int(query.get('limit', 100))
+                    items = [{'track': fake.track(i)} for i in indices[offset:offset + limit]]
+                    return self._send(200, {'total': len(indices), 'offset': offset, 'limit': limit, 'items': items})
+                if match := re.fullmatch(r'/v1/playlists/([^/]+)', path):
+                    fake.calls['playlist'] += 1
+                    playlist_id = match.group(1)
+                    return self._send(200, {'id': playlist_id, 'name': f'Playlist {playlist_id}',
+                                            'snapshot_id': fake.snapshots.get(playlist_id, 'snapshot-0'),
+                                            'tracks': {'total': len(fake.playlist_track_indices(playlist_id))}})
+                if path == '/v1/artists':
+                    fake.calls['artists'] += 1
+                    return self._send(200, {'artists': [fake.artist(a) for a in query['ids'].split(',')]})
+                if path == '/v1/audio-features':
+                    fake.calls['audio_features'] += 1
+                    return self._send(200, {'audio_features': [fake.audio_features(t)
+                                                               for t in query['ids'].split(',')]})
+                if path == '/v1/me/tracks':
+                    fake.calls['saved_tracks'] += 1
+                    indices = fake.playlist_track_indices('saved')
+                    offset, limit = int(query.get('offset', 0)), int(query.get('limit', 20))
+                    items = [{'added_at': '2020-01-01T00:00:00Z', 'track': fake.track(i)}
+                             for i in indices[offset:offset + limit]]
+                    return self._send(200, {'total': len(indices), 'offset': offset, 'limit': limit, 'items': items})
+                if path == '/v1/me':
+                    fake.calls['me'] += 1
+                    return self._send(200, {'id': 'user'})
+                self._send(404, {'error': {'status': 404, 'message': 'Not found'}})
+
+            def do_POST(self):
+                if self._throttle():
+                    return
+                path = urlparse(self.path).path.rstrip('/')
+                body = self._body()
+
+                if re.fullmatch(r'/v1/users/([^/]+)/playlists', path):
+                    with fake._lock:
+                        fake.calls['playlist_create'] += 1
+                        playlist_id = f'created{fake.calls["playlist_create"]}'
+                    return self._send(201, {'id': playlist_id, 'name': body.get('name')})
+                if match := re.fullmatch(r'/v1/playlists/([^/]+)/(?:tracks|items)', path):
+                    with fake._lock:
+                        fake.calls['playlist_add_items'] += 1
+                        uris = body if isinstance(body, list) else body.get('uris', [])
+                        fake.added.setdefault(match.group(1), []).extend(uris)
+                    return self._send(201, {'snapshot_id': 'added'})
+                self._send(404, {'error': {'status': 404, 'message': 'Not found'}})
+
+        return Handler
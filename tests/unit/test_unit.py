@@ -2,17 +2,36 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 import os
 import pytest
 import sys
 from unittest.mock import patch
+import tempfile
 sys.path.insert(0, '../../server')
 sys.path.insert(0, '../../')
+# The server recovers jobs from its default job store on import, kept out of the working directory here
+os.environ.setdefault('JOB_STORE_PATH', os.path.join(tempfile.mkdtemp(), 'jobs.sqlite'))
 from server import lib
 from server.app import app as flask_app
+from server.cache import CategorizationCache
+from server.store import TrackStore, AUDIO_FEATURES
+from server.artists import ArtistCache
+from server.features import FeatureCache, PlaylistFeatures
+from server.genres import genre_summary
+from server.tokenizer import count_tokens
+from server.jobs import JobQueue, JobStore
+from server.engine import SingleFlight, CallTimeout, run_concurrently
+from tests.fake_spotify import FakeSpotifyServer
+from tests.fake_llm import FakeLLM
 import pandas as pd
+import numpy as np
 import random
+import re
+import json
+import threading
+import time
+from collections import Counter
 
 @pytest.fixture
 def app():
@@ -26,15 +45,22 @@ def client(app):
     return app.test_client()
 
 
-@pytest.fixture
-def mock_read_pickle():
-    with patch('pandas.read_pickle') as mock:
-        genres_data = {
-            'genres': pd.Series([['rock', 'pop'], ['jazz'], ['blues', 'classical']])
-        }
-        df = pd.DataFrame(genres_data)
-        mock.return_value = df
-        yield mock
+@pytest.fixture(autouse=True)
+def categorization_cache(tmp_path):
+    cache = CategorizationCache(str(tmp_path / 'categorizations.sqlite'))
+    with patch.object(lib, 'categorization_cache', cache):
+        yield cache
+    cache.close()
+
+
+@pytest.fixture(autouse=True)
+def track_store(tmp_path):
+    store = TrackStore(str(tmp_path / 'tracks.sqlite'))
+    with patch.object(lib, 'track_store', store), patch.object(lib, 'artist_cache', ArtistCache(store)), \
+            patch.object(lib, 'feature_cache', FeatureCache(store)), \
+            patch.object(lib, 'single_flight', SingleFlight(ttl=lib.COALESCE_TTL)):
+        yield store
+    store.close()
 
 
 def test_exchange_code(client):
@@ -57,15 +83,17 @@ def test_exchange_code(client):
 
 
 
-def test_create_shuffled_list_of_genres(mock_read_pickle):
-    playlist_id = '123'
-    expected_genres = "rock, pop\nblues, classical\njazz"  
+def test_summarize_genres_reads_the_store(track_store):
+    track_store.upsert_tracks('123', [{'id': f'track{i}', 'uri': '', 'popularity': 0, 'album': '', 'name': '',
+                                       'release_date': '', 'thumbnail_url': None, 'artists': [],
+                                       'artists_id': []} for i in range(4)])
+    track_store.set_track_genres({'track0': ('rock', 'pop'), 'track1': ('jazz',), 'track2': ('blues', 'classical')})
 
-    random.seed(42)  
-    genre_list = lib.create_shuffled_list_of_genres(playlist_id)
+    summary = lib.summarize_genres('123')
 
-    # Check the output
-    assert genre_list == expected_genres
+    assert summary.startswith('3 songs with genres (1 without), 5 distinct genres.')
+    for genre in ('rock', 'pop', 'jazz', 'blues', 'classical'):
+        assert f'{genre} (1)' in summary
 
 
 @pytest.fixture
@@ -80,11 +108,1087 @@ def test_get_categories_format():
     num_categories = 2
     genres_text = "Rock, Pop"
 
-    categories = lib.get_categories(num_categories, genres_text)
+    llm = FakeLLM()
+
+    with llm.patch(lib):
+        categories = lib.get_categories(num_categories, genres_text)
 
+    assert llm.calls['categories'] == 1 and llm.genres_text == genres_text
+    assert len(categories) == num_categories
     for category in categories:
         assert isinstance(category, dict), "Each category should be a dictionary."
         assert 'category_number' in category, "Each category should have a 'category_number'."
         assert 'category_name' in category, "Each category should have a 'category_name'."
         assert 'description' in category, "Each category should have a 'description'."
-    
\ No newline at end of file
+    
+
+class FakeLLMChain:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def run(self, **kwargs):
+        time.sleep(self.latency)
+        return f"Category number: 1\nCategory name: Rock Genres\nReasoning: {kwargs['name']} is a rock song."
+
+
+def make_tracks(n):
+    audio_features = dict.fromkeys(['danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness',
+                                    'acousticness', 'instrumentalness', 'liveness', 'valence', 'tempo',
+                                    'duration_ms', 'time_signature'], 0.5)
+    rows = [{'id': f'track{i}', 'uri': f'spotify:track:track{i}', 'name': f'Song {i}', 'artists': ['Artist'],
+             'artists_id': ['artist0'], 'album': 'Album', 'release_date': '2020-01-01', 'popularity': 50,
+             'thumbnail_url': None, 'genres': ('rock',), **audio_features} for i in range(n)]
+    return pd.DataFrame(rows).set_index('id')
+
+
+def test_stream_categorization_scales_with_concurrency():
+    categories = [{'category_number': 1, 'category_name': 'Rock Genres', 'description': 'Rock.', 'playlist_id': 'p1'}]
+    df = make_tracks(16)
+
+    def run(concurrency):
+        with patch.object(lib, 'chain_categorize', FakeLLMChain(latency=0.05)), \
+                patch.object(lib.track_store, 'playlist', return_value=df), \
+                patch.object(lib, 'spotify_client'):
+            start = time.perf_counter()
+            output = ''.join(lib.stream_categorization('token', '123', categories, max_workers=concurrency))
+            return time.perf_counter() - start, json.loads(output)
+
+    serial_time, serial_tracks = run(1)
+    parallel_time, parallel_tracks = run(8)
+
+    assert len(serial_tracks) == len(parallel_tracks) == 16
+    assert {t['track_name'] for t in parallel_tracks} == {t['track_name'] for t in serial_tracks}
+    assert serial_time >= 16 * 0.05
+    assert parallel_time < serial_time / 3
+
+
+
+def test_timeouts_count_from_when_a_call_starts():
+    ran = []
+
+    def call(item):
+        time.sleep(0.6 if item == 'stuck' else 0.05)
+        ran.append(item)
+        return item
+
+    results = {item: (result, error) for item, result, error in
+               run_concurrently(call, ['stuck', 'queued', 'last'], max_workers=1, timeout=0.2)}
+
+    assert isinstance(results['stuck'][1], CallTimeout)
+    # The others waited for the stuck call's worker instead of timing out in the queue
+    assert results['queued'] == ('queued', None) and results['last'] == ('last', None)
+    assert ran == ['stuck', 'queued', 'last']
+
+class FakeBatchLLMChain:
+    def __init__(self, skip=(), numbers=None):
+        self.skip = skip
+        self.numbers = numbers or {}
+        self.calls = 0
+
+    def run(self, categories_output, songs):
+        self.calls += 1
+        count = songs.count('Song ')
+        answers = [{'song': i, 'category_number': self.numbers.get(i, 2), 'category_name': 'Pop, Dance & More',
+                    'reasoning': 'Catchy.'} for i in range(1, count + 1) if i not in self.skip]
+        return f"Here you go:\n```json\n{json.dumps(answers)}\n```"
+
+
+def test_batched_categorization_reasks_missing_tracks():
+    categories_output = "1. Rock Genres: Rock.\n\n2. Pop, Dance & More: Pop."
+    df = make_tracks(25)
+    batch_chain = FakeBatchLLMChain(skip=(3,))
+    single_chain = FakeLLMChain()
+
+    with patch.object(lib, 'chain_categorize_batch', batch_chain), patch.object(lib, 'chain_categorize', single_chain):
+        results = list(lib.categorize_dataframe(categories_output, df, max_workers=2, batch_size=10))
+
+    assert len(results) == 25
+    assert batch_chain.calls == 3
+    by_name = {track['name']: (number, name) for track, number, name, _, _ in results}
+    assert by_name['Song 0'] == (2, 'Pop, Dance & More')
+    # Song 3 of each batch was missing from the answer and fell back to the single-track prompt
+    assert by_name['Song 2'] == (1, 'Rock Genres')
+    assert by_name['Song 12'] == (1, 'Rock Genres')
+
+
+def test_batched_categorization_reasks_unknown_category_numbers(categorization_cache):
+    categories_output = "1. Rock Genres: Rock.\n\n2. Pop, Dance & More: Pop."
+    df = make_tracks(4)
+    batch_chain = FakeBatchLLMChain(numbers={1: 9, 2: 0})
+
+    with patch.object(lib, 'chain_categorize_batch', batch_chain), patch.object(lib, 'chain_categorize', FakeLLMChain()):
+        results = list(lib.categorize_dataframe(categories_output, df, max_workers=1, batch_size=4))
+
+    by_name = {track['name']: number for track, number, _, _, _ in results}
+    assert by_name == {'Song 0': 1, 'Song 1': 1, 'Song 2': 2, 'Song 3': 2}
+    # Only the checked answers were cached
+    cached = [categorization_cache.get(lib.track_cache_key(categories_output, track)) for _, track in df.iterrows()]
+    assert [answer[0] for answer in cached] == [1, 1, 2, 2]
+
+
+class CountingLLMChain(FakeLLMChain):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def run(self, **kwargs):
+        with self.lock:
+            self.calls += 1
+        return super().run(**kwargs)
+
+
+def test_categorization_cache_skips_repeat_calls(categorization_cache):
+    df = make_tracks(10)
+    chain = CountingLLMChain()
+
+    with patch.object(lib, 'chain_categorize', chain):
+        list(lib.categorize_dataframe("1. Rock Genres: Rock.", df, max_workers=4))
+        list(lib.categorize_dataframe("1. **Rock Genres**:  Rock.", df, max_workers=4))
+        assert chain.calls == 10
+
+        df.loc['track0', 'energy'] = 0.9
+        list(lib.categorize_dataframe("1. Rock Genres: Rock.", df, max_workers=4))
+        assert chain.calls == 11
+
+    assert categorization_cache.stats()['hits'] == 19
+
+
+def test_categorization_cache_evicts_least_recently_used(tmp_path):
+    cache = CategorizationCache(str(tmp_path / 'lru.sqlite'), max_entries=2)
+    cache.put('a', (1, 'A', ''))
+    time.sleep(0.01)
+    cache.put('b', (2, 'B', ''))
+    time.sleep(0.01)
+    assert cache.get('a') == (1, 'A', '')
+    cache.put('c', (3, 'C', ''))
+
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('c') == (3, 'C', '')
+    assert cache.stats()['misses'] == 1
+    cache.close()
+
+
+class ListedLLMChain(CountingLLMChain):
+    # Answers with the listed category named after the track's genre, or rock, as numbered in the categories
+    def run(self, **kwargs):
+        with self.lock:
+            self.calls += 1
+        listed = {name: number for number, name in
+                  re.findall(r"^(\d+)\. ([^:]+):", kwargs['categories_output'], re.MULTILINE)}
+        name = next((name for name in ('Punk', 'Jazz', 'Pop')
+                     if name in listed and name.lower() in str(kwargs['genres'])), 'Rock Genres')
+        return f"Category number: {listed[name]}\nCategory name: {name}\nReasoning: Genres."
+
+
+def test_categorization_cache_re_asks_every_track_when_categories_change(categorization_cache):
+    df = make_clustered_tracks(9)
+    df.at['track0', 'genres'] = ('punk rock',)
+    chain = ListedLLMChain()
+    rock, jazz, pop = CLUSTERED_CATEGORIES
+    punk = {'category_number': 4, 'category_name': 'Punk', 'description': 'Punk rock.'}
+
+    with patch.object(lib, 'chain_categorize', chain):
+        before = list(lib.categorize_dataframe(lib.format_categories([rock, jazz, pop]), df, max_workers=2))
+        assert chain.calls == 9
+
+        # Splitting punk out of rock can move tracks that already have an answer
+        results = list(lib.categorize_dataframe(lib.format_categories([rock, jazz, pop, punk]), df, max_workers=2))
+        assert chain.calls == 18
+
+        list(lib.categorize_dataframe(lib.format_categories([rock, jazz, pop, punk]), df, max_workers=2))
+        assert chain.calls == 18
+
+    assert {track['name']: name for track, _, name, _, _ in before}['Song 0'] == 'Rock Genres'
+    assert {track['name']: (number, name) for track, number, name, _, _ in results}['Song 0'] == (4, 'Punk')
+
+
+def make_spotify_track(i, artist_ids):
+    return {'id': f'track{i}', 'uri': f'spotify:track:track{i}', 'popularity': 50, 'name': f'Song {i}',
+            'album': {'name': 'Album', 'release_date': '2020-01-01', 'images': []},
+            'artists': [{'id': artist_id, 'name': artist_id.title()} for artist_id in artist_ids]}
+
+
+def test_track_store_shares_tracks_across_playlists(track_store):
+    sp = MagicMock()
+    sp.playlist.side_effect = lambda playlist_id, fields=None: {'name': playlist_id, 'snapshot_id': 'snapshot'}
+    sp.playlist_tracks.side_effect = lambda playlist_id, offset=0, limit=100, fields=None: {
+        'total': 3, 'items': [{'track': make_spotify_track(i, ['artist0', f'artist{i}'])}
+                              for i in ({'a': [0, 1, 2], 'b': [1, 2, 3]}[playlist_id])]}
+    sp.artists.side_effect = lambda ids: {'artists': [{'id': a, 'genres': [f'{a}-genre'], 'popularity': 1}
+                                                      for a in ids]}
+    sp.audio_features.side_effect = lambda ids: [{'id': track_id, 'energy': 0.5} for track_id in ids]
+
+    with patch.object(lib, 'spotify_client', return_value=sp):
+        for playlist_id in ('a', 'b'):
+            lib.sync_playlist('token', playlist_id)
+
+    assert lib.get_total_tracks('a') == lib.get_total_tracks('b') == 3
+    assert track_store.query('SELECT COUNT(*) FROM tracks')[0][0] == 4
+    # Artists and audio features already stored for playlist a are not fetched again for playlist b
+    assert sorted(a for call in sp.artists.call_args_list for a in call.args[0]) == \
+        ['artist0', 'artist1', 'artist2', 'artist3']
+    assert sp.audio_features.call_args_list[-1].args[0] == ['track3']
+
+    df = track_store.load_playlist('b')
+    assert df.index.tolist() == ['track1', 'track2', 'track3']
+    assert set(df.loc['track3', 'genres']) == {'artist0-genre', 'artist3-genre'}
+    assert df.loc['track3', 'energy'] == 0.5
+
+
+def test_track_store_concurrent_writers(track_store):
+    def write(n):
+        tracks = [{'id': f'track{i}', 'uri': '', 'popularity': 0, 'album': '', 'name': '', 'release_date': '',
+                   'thumbnail_url': None, 'artists': [], 'artists_id': [f'artist{i}']} for i in range(n, n + 50)]
+        track_store.upsert_tracks('shared', tracks, start_position=n)
+        track_store.close()
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(0, 500, 50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert track_store.count_tracks('shared') == 500
+    assert len(track_store.missing_artist_ids('shared')) == 500
+
+
+def test_ingest_playlist_against_fake_spotify(track_store):
+    with FakeSpotifyServer(num_tracks=950, num_artists=300, latency=0.02, rate_limit_every=7) as spotify, \
+            patch.dict(os.environ, {'SPOTIFY_API_URL': spotify.url}):
+        counts = lib.ingest_playlist('ingest-token', 'playlist', max_workers=8)
+        lib.add_genre_information_to_tracks('ingest-token', 'playlist')
+
+    assert counts == {'tracks': 950, 'artists': 300, 'audio_features': 950, 'removed': 0}
+    assert spotify.rate_limited > 0
+    assert spotify.calls['playlist_tracks'] == 10
+    assert spotify.calls['audio_features'] == 10
+    assert track_store.count_tracks('playlist') == 950
+
+    df = track_store.load_playlist('playlist')
+    assert df.index.tolist() == [f'track{i}' for i in range(950)]
+    assert df['genres'].notna().all()
+    assert df['energy'].notna().all()
+
+
+def test_ingest_playlist_syncs_incrementally(track_store):
+    with FakeSpotifyServer(num_tracks=250, num_artists=100) as spotify, \
+            patch.dict(os.environ, {'SPOTIFY_API_URL': spotify.url}):
+        lib.ingest_playlist('sync-token', 'playlist')
+        calls = dict(spotify.calls)
+
+        with patch.object(lib.artist_cache, 'refresh') as refresh:
+            counts = lib.ingest_playlist('sync-token', 'playlist')
+        assert counts == {'tracks': 0, 'artists': 0, 'audio_features': 0, 'removed': 0}
+        assert not refresh.called
+        assert spotify.calls['playlist'] == calls['playlist'] + 1
+        assert spotify.calls['playlist_tracks'] == calls['playlist_tracks']
+
+        spotify.removed['playlist'] = {0, 1, 120}
+        spotify.snapshots['playlist'] = 'snapshot-1'
+        counts = lib.ingest_playlist('sync-token', 'playlist')
+
+    assert counts['removed'] == 3
+    assert counts['artists'] == counts['audio_features'] == 0
+    assert track_store.count_tracks('playlist') == 247
+    assert 'track120' not in track_store.track_ids('playlist')
+    assert track_store.snapshot_id('playlist') == 'snapshot-1'
+
+
+def test_stream_categorization_batches_playlist_writes():
+    categories = [{'category_number': 1, 'category_name': 'Rock Genres', 'description': 'Rock.', 'playlist_id': 'p1'}]
+    sp = MagicMock()
+    writes = []
+
+    def playlist_add_items(playlist_id, items):
+        if not writes:
+            writes.append(None)
+            raise ConnectionError('flaky network')
+        time.sleep(0.5)
+        writes.append((playlist_id, len(items)))
+
+    sp.playlist_add_items.side_effect = playlist_add_items
+
+    with patch.object(lib, 'chain_categorize', FakeLLMChain()), \
+            patch.object(lib.track_store, 'playlist', return_value=make_tracks(250)), \
+            patch.object(lib, 'spotify_client', return_value=sp):
+        stream = lib.stream_categorization('token', '123', categories, max_workers=4)
+        start = time.perf_counter()
+        chunks = [next(stream) for _ in range(2 * 250)]
+        streamed_time = time.perf_counter() - start
+        output = ''.join(chunks + list(stream))
+
+    assert len(json.loads(output)) == 250
+    # The 1.5s of writes happen on the writer thread, not between streamed tracks, where the two full
+    # batches alone would hold the stream up for 1s
+    assert streamed_time < 1.0
+    assert writes[1:] == [('p1', 100), ('p1', 100), ('p1', 50)]
+
+
+def make_clustered_tracks(n):
+    df = make_tracks(n)
+    styles = [(('hard rock', 'classic rock'), 0.9, 0.1), (('jazz', 'bebop'), 0.3, 0.8), (('dance pop', 'pop'), 0.7, 0.2)]
+    rng = random.Random(0)
+    for i, track_id in enumerate(df.index):
+        genres, energy, acousticness = styles[i % 3]
+        df.at[track_id, 'genres'] = genres
+        df.loc[track_id, ['energy', 'acousticness']] = [energy + rng.uniform(-0.05, 0.05), acousticness]
+    return df
+
+
+class GenreLLMChain(CountingLLMChain):
+    def run(self, **kwargs):
+        self.calls += 1
+        number, name = {'rock': (1, 'Rock Genres'), 'jazz': (2, 'Jazz'), 'pop': (3, 'Pop')}[
+            next(g for g in ('rock', 'jazz', 'pop') if g in str(kwargs['genres']))]
+        return f"Category number: {number}\nCategory name: {name}\nReasoning: Genres."
+
+
+CLUSTERED_CATEGORIES = [{'category_number': 1, 'category_name': 'Rock Genres', 'description': 'Classic and hard rock.'},
+                        {'category_number': 2, 'category_name': 'Jazz', 'description': 'Bebop and jazz.'},
+                        {'category_number': 3, 'category_name': 'Pop', 'description': 'Dance pop.'}]
+
+
+@pytest.mark.parametrize('mode', ['local', 'offline'])
+def test_local_categorization_matches_genres(mode):
+    df = make_clustered_tracks(300)
+    chain = GenreLLMChain()
+    categories_output = lib.format_categories(CLUSTERED_CATEGORIES)
+
+    with patch.object(lib, 'chain_categorize', chain):
+        results = list(lib.categorize(categories_output, CLUSTERED_CATEGORIES, df, mode=mode, max_workers=4))
+
+    assert len(results) == 300
+    expected = {'hard rock': 1, 'jazz': 2, 'dance pop': 3}
+    assert all(number == expected[track['genres'][0]] for track, number, _, _, _ in results)
+    if mode == 'local':
+        assert 0 < chain.calls <= 30
+    else:
+        assert chain.calls == 0
+    assert {tier for *_, tier in results} == ({'llm', 'centroid'} if mode == 'local' else {'centroid'})
+
+
+class SmallLLMChain(CountingLLMChain):
+    def run(self, **kwargs):
+        with self.lock:
+            self.calls += 1
+        if 'ambient' in str(kwargs['genres']):
+            return "Category number: 2\nCategory name: Jazz\nReasoning: Calm.\nConfidence: 0.9"
+        return "Category number: 3\nCategory name: Pop\nReasoning: Not sure.\nConfidence: 0.4"
+
+
+def test_offline_categorization_reports_tracks_it_cannot_place():
+    df = make_clustered_tracks(6)
+    categories = [{'category_number': 1, 'category_name': 'Focus', 'description': 'Music to study to.'},
+                  {'category_number': 2, 'category_name': 'Workout', 'description': 'Music for the gym.'}]
+    failed = []
+
+    results = list(lib.categorize(lib.format_categories(categories), categories, df, mode='offline',
+                                  on_error=lambda track, error: failed.append((track['name'], str(error)))))
+
+    assert results == []
+    assert len(failed) == 6 and 'No category could be placed' in failed[0][1]
+
+
+@pytest.mark.parametrize('mode', ['local', 'offline'])
+def test_local_categorization_does_not_assign_everything_to_a_lone_category(mode):
+    df = make_clustered_tracks(30)
+    categories = [CLUSTERED_CATEGORIES[0],
+                  {'category_number': 2, 'category_name': 'Focus', 'description': 'Music to study to.'}]
+    # Every seed comes back as rock, so only the rock centroid is placed
+    chain = CountingLLMChain()
+    failed = []
+
+    with patch.object(lib, 'chain_categorize', chain):
+        results = list(lib.categorize(lib.format_categories(categories), categories, df, mode=mode, max_workers=2,
+                                      on_error=lambda track, error: failed.append((track['name'], str(error)))))
+
+    if mode == 'local':
+        assert chain.calls == 30 and len(results) == 30
+        assert {tier for *_, tier in results} == {'llm'}
+    else:
+        # Only the rock tracks, whose genres match the description, are placed
+        assert chain.calls == 0
+        assert sorted(track['genres'][0] for track, *_ in results) == ['hard rock'] * 10
+        assert len(failed) == 20 and 'Only one category could be placed' in failed[0][1]
+
+
+def test_tiered_categorization_escalates_only_low_margin_tracks():
+    df = make_clustered_tracks(30)
+    df.loc[df.index[:4], 'genres'] = pd.Series([('rock', 'jazz')] * 2 + [('ambient',)] * 2, index=df.index[:4])
+    categories = [dict(category, playlist_id=f'p{category["category_number"]}') for category in CLUSTERED_CATEGORIES]
+    small, full = SmallLLMChain(), GenreLLMChain()
+
+    with patch.object(lib, 'chain_categorize_small', small), patch.object(lib, 'chain_categorize', full), \
+            patch.object(lib.track_store, 'playlist', return_value=df), patch.object(lib, 'spotify_client'):
+        tracks = json.loads(''.join(lib.stream_categorization('token', '123', categories, mode='tiered')))
+
+    tiers = {track['track_name']: track['tier'] for track in tracks}
+    assert len(tracks) == 30
+    assert [tiers[f'Song {i}'] for i in range(4)] == ['llm', 'llm', 'small', 'small']
+    assert list(tiers.values()).count('overlap') == 26
+    assert small.calls == 4 and full.calls == 2
+    expected = {'hard rock': 1, 'jazz': 2, 'dance pop': 3, 'rock': 1, 'ambient': 2}
+    assert all(track['category_number'] == expected[df.loc[df['name'] == track['track_name'], 'genres'].iloc[0][0]]
+               for track in tracks)
+
+
+def test_genre_summary_is_deterministic_and_budgeted():
+    rng = random.Random(0)
+    genre_names = [f'genre {i}' for i in range(400)]
+
+    def playlist(n):
+        return [tuple(rng.sample(genre_names[:rng.choice([20, 400])], rng.randint(0, 4))) for _ in range(n)]
+
+    small, large = playlist(100), playlist(20000)
+    shuffled = list(large)
+    rng.shuffle(shuffled)
+
+    assert genre_summary(large, token_budget=500) == genre_summary(shuffled, token_budget=500)
+    for genres in (small, large):
+        assert count_tokens(genre_summary(genres, token_budget=500)) <= 500
+    assert count_tokens(genre_summary(large, token_budget=500)) > 400
+    assert genre_summary(large, token_budget=500).startswith(f'{sum(1 for g in large if g)} songs with genres')
+
+
+class FlakyLLMChain(FakeLLMChain):
+    def __init__(self, fail_after):
+        super().__init__()
+        self.fail_after = fail_after
+
+    def run(self, **kwargs):
+        if int(kwargs['name'].split()[-1]) >= self.fail_after:
+            raise ConnectionError('LLM unavailable')
+        return super().run(**kwargs)
+
+
+def test_generate_job_resumes_from_checkpoints(tmp_path, client):
+    categories = [{'category_number': 1, 'category_name': 'Rock Genres', 'description': 'Rock.'}]
+    queue = JobQueue(JobStore(str(tmp_path / 'jobs.sqlite')), max_workers=1)
+    queue.register('generate', lib.run_generate_job)
+
+    with FakeSpotifyServer(num_tracks=120, num_artists=40) as spotify, \
+            patch.dict(os.environ, {'SPOTIFY_API_URL': spotify.url}), \
+            patch.object(lib, 'job_queue', queue), \
+            patch('server.app.job_queue', queue):
+        lib.ingest_playlist('job-token', 'playlist')
+
+        with patch.object(lib, 'chain_categorize', FlakyLLMChain(fail_after=70)):
+            response = client.post('/jobs/generate?token=job-token&playlist_id=playlist',
+                                   json={'categories': categories})
+            assert response.status_code == 202
+            job_id = response.json['job_id']
+            job = queue.wait(job_id, timeout=30)
+
+        assert job['status'] == 'failed'
+        assert job['done'] == 70 and job['total'] == 120
+        assert len(spotify.added['created1']) == 70
+        assert 'params' not in client.get(f'/jobs/{job_id}').json
+
+        calls = CountingLLMChain()
+        with patch.object(lib, 'chain_categorize', calls):
+            assert client.post(f'/jobs/{job_id}/resume').status_code == 202
+            job = queue.wait(job_id, timeout=30)
+            streamed = json.loads(''.join(lib.stream_job(job_id)))
+
+    assert job['status'] == 'done', job['error']
+    assert calls.calls == 50
+    assert spotify.calls['playlist_create'] == 1
+    assert sorted(spotify.added['created1']) == sorted(f'spotify:track:track{i}' for i in range(120))
+    assert len(streamed) == 120
+
+
+def test_jobs_resume_only_failed_jobs_and_drop_tokens(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.sqlite'))
+    queue = JobQueue(store, max_workers=2, secret_ttl=0)
+    release, runs = threading.Event(), []
+
+    def handler(job):
+        runs.append(job.params['token'])
+        release.wait(5)
+        if job.params.get('fail'):
+            raise RuntimeError('boom')
+        return 'ok'
+
+    queue.register('work', handler)
+    job_id = queue.submit('work', token='first', fail=True)
+    while store.get(job_id)['status'] != 'running':
+        time.sleep(0.01)
+    # Already running, resuming would run it twice
+    assert not queue.resume(job_id)
+    release.set()
+    assert queue.wait(job_id, timeout=5)['status'] == 'failed'
+    assert runs == ['first']
+
+    # A failed job keeps its token until it is secret_ttl old, when the next submission drops it
+    done_id = queue.submit('work', token='second')
+    assert queue.wait(done_id, timeout=5)['status'] == 'done'
+    assert 'token' not in store.get(done_id)['params'] and 'token' not in store.get(job_id)['params']
+    assert not queue.resume(done_id)
+    with pytest.raises(ValueError):
+        queue.resume(job_id)
+
+    store.update(job_id, params={'fail': False})
+    assert queue.resume(job_id, token='fresh')
+    assert queue.wait(job_id, timeout=5)['status'] == 'done'
+    assert runs == ['first', 'second', 'fresh']
+
+
+def test_jobs_of_a_stopped_process_are_recovered_once(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.sqlite'))
+    release = threading.Event()
+
+    def handler(job):
+        release.wait(5)
+        return job.params['n']
+
+    live = JobQueue(store, max_workers=1)
+    live.register('work', handler)
+    running_id = live.submit('work', n=1)
+    # A job left running by a process whose heartbeat stopped
+    store.heartbeat('stopped')
+    store.execute("UPDATE job_workers SET heartbeat = 0 WHERE id = 'stopped'")
+    orphan_id = store.create('work', {'n': 2}, owner='stopped')
+    store.update(orphan_id, status='running')
+
+    queues = [JobQueue(store, max_workers=1) for _ in range(2)]
+    for queue in queues:
+        queue.register('work', handler)
+    recovered = [queue.recover() for queue in queues]
+
+    assert sorted(recovered) == [[], [orphan_id]]
+    release.set()
+    assert live.wait(running_id, timeout=5)['result'] == 1
+    assert queues[0].wait(orphan_id, timeout=5)['result'] == 2
+
+
+def parse_metrics(text):
+    samples = {}
+    for line in text.splitlines():
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+def test_metrics_endpoint_reports_stages_calls_and_tokens(client, caplog):
+    from langchain.schema import LLMResult
+
+    before = parse_metrics(client.get('/metrics').get_data(as_text=True))
+    with FakeSpotifyServer(num_tracks=150, num_artists=50, rate_limit_every=5) as spotify, \
+            patch.dict(os.environ, {'SPOTIFY_API_URL': spotify.url}), \
+            patch.object(lib, 'chain_categorize', FakeLLMChain()), \
+            patch('server.app.get_total_tracks', lib.get_total_tracks), \
+            caplog.at_level('INFO'):
+        lib.ingest_playlist('metrics-token', 'playlist')
+        lib.add_genre_information_to_tracks('metrics-token', 'playlist')
+        list(lib.categorize_dataframe('1. Rock: Rock.', lib.track_store.load_playlist('playlist')))
+        lib.TokenUsageHandler().on_llm_end(LLMResult(generations=[], llm_output={
+            'model_name': 'gpt-3.5-turbo', 'token_usage': {'prompt_tokens': 120, 'completion_tokens': 30}}))
+        client.get('/total-tracks?playlist_id=playlist')
+
+        response = client.get('/metrics')
+
+    assert response.status_code == 200
+    after = parse_metrics(response.get_data(as_text=True))
+    delta = lambda name: after.get(name, 0) - before.get(name, 0)
+    retries = sum(delta(name) for name in after if name.startswith('playlistgenius_spotify_retries_total'))
+
+    assert delta('playlistgenius_stage_seconds_count{stage="ingest_playlist"}') == 1
+    assert delta('playlistgenius_stage_seconds_count{stage="categorize_track"}') == 150
+    assert delta('playlistgenius_stage_seconds_bucket{stage="categorize_track",le="+Inf"}') == 150
+    assert delta('playlistgenius_spotify_calls_total{method="playlist_tracks"}') == 2
+    assert delta('playlistgenius_spotify_responses_total{status="429"}') == spotify.rate_limited == retries
+    assert delta('playlistgenius_llm_tokens_total{kind="prompt"}') == 120
+    assert delta('playlistgenius_llm_tokens_total{kind="completion"}') == 30
+    assert 0 <= after['playlistgenius_categorization_cache_hit_ratio'] <= 1
+    assert delta('playlistgenius_request_seconds_count{endpoint="/total-tracks"}') == 1
+    assert any('Trace' in r.getMessage() and 'GET /total-tracks' in r.getMessage() for r in caplog.records)
+
+
+class NullPlaylistWriter:
+    # A MagicMock would keep every add() call and grow with the playlist
+    def __init__(self, *args, **kwargs):
+        self.failed = {}
+
+    def add(self, playlist_id, uri):
+        pass
+
+    def close(self):
+        return {}
+
+
+def test_ingest_and_categorization_memory_stays_flat(track_store):
+    import tracemalloc
+    categories = [{'category_number': 1, 'category_name': 'Rock Genres', 'description': 'Rock.', 'playlist_id': 'p1'}]
+
+    def peak_memory(num_tracks):
+        with FakeSpotifyServer(num_tracks=num_tracks, num_artists=200) as spotify, \
+                patch.dict(os.environ, {'SPOTIFY_API_URL': spotify.url}), \
+                patch.object(lib, 'INGEST_CHUNK_SIZE', 250), \
+                patch.object(lib, 'chain_categorize', FakeLLMChain()), \
+                patch.object(lib, 'PlaylistWriter', NullPlaylistWriter):
+            tracemalloc.start()
+            lib.ingest_playlist(f'memory-{num_tracks}', f'playlist{num_tracks}', max_workers=2)
+            lib.add_genre_information_to_tracks(f'memory-{num_tracks}', f'playlist{num_tracks}')
+            streamed = sum(1 for chunk in lib.stream_categorization(f'memory-{num_tracks}', f'playlist{num_tracks}',
+                                                                    categories, max_workers=4)
+                           if chunk.startswith('{'))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        assert streamed == num_tracks
+        return peak
+
+    small, large = peak_memory(1000), peak_memory(4000)
+    assert large < 1.5 * small, \
+        f'peak memory: {small / 1e6:.1f}MB for 1000 tracks, {large / 1e6:.1f}MB for 4000 tracks'
+
+
+def test_artist_cache_refreshes_stale_artists_and_evicts(track_store):
+    cache = ArtistCache(track_store, ttl=3600, max_entries=3, hot_size=2)
+    track_store.upsert_tracks('p', [lib.track_from_item({'track': make_spotify_track(0, ['a1', 'a2'])})])
+    cache.put_many([{'id': 'a1', 'genres': ['rock'], 'popularity': 1},
+                    {'id': 'a2', 'genres': ['jazz'], 'popularity': 2}])
+    track_store.set_track_genres({'track0': ('rock', 'jazz')})
+    fetched = []
+
+    def fetch(batch):
+        fetched.append(sorted(batch))
+        return [{'id': artist_id, 'genres': ['punk'] if artist_id == 'a1' else ['jazz'], 'popularity': 3}
+                for artist_id in batch]
+
+    assert cache.missing(['a1', 'a2', 'a3']) == {'a3'}
+    assert cache.refresh(['a1', 'a2'], fetch) is None
+
+    # a1 went stale on disk, and a new process starts with an empty hot tier
+    track_store.query("UPDATE artists SET fetched_at = 0 WHERE id = 'a1'")
+    cache.clear()
+    assert cache.get_many(['a1'])['a1']['genres'] == ('rock',)
+    cache.refresh(['a1', 'a2'], fetch).result()
+
+    assert fetched == [['a1']]
+    assert cache.get_many(['a1'])['a1']['genres'] == ('punk',)
+    assert track_store.tracks_missing_genres('p') == ['track0']
+
+    cache.put_many([{'id': 'a3', 'genres': [], 'popularity': 0}])
+    track_store.query("UPDATE artists SET last_used = 0 WHERE id = 'a2'")
+    cache.put_many([{'id': 'a4', 'genres': [], 'popularity': 0}])
+    assert sorted(row[0] for row in track_store.query('SELECT id FROM artists')) == ['a1', 'a3', 'a4']
+    assert len(cache._hot) == 2
+
+
+def test_artist_cache_lookups_write_recency_in_batches(track_store):
+    cache = ArtistCache(track_store, max_entries=10)
+    cache.put_many([{'id': f'a{i}', 'genres': ['rock'], 'popularity': 1} for i in range(10)])
+    track_store.query('UPDATE artists SET last_used = 0')
+
+    with patch.object(track_store, 'touch_artists', wraps=track_store.touch_artists) as touch, \
+            patch('server.artists.TOUCH_BATCH', 5):
+        # Every page of an ingest looks its artists up several times, all from the hot tier
+        for _ in range(20):
+            cache.missing(['a0', 'a1']), cache.stale(['a0', 'a1']), cache.frame(['a0', 'a1'])
+        assert not touch.called
+        cache.get_many(['a2', 'a3', 'a4'])
+        assert touch.call_count == 1
+
+    # The artists used are the ones kept when others are evicted
+    cache.put_many([{'id': f'b{i}', 'genres': [], 'popularity': 0} for i in range(5)])
+    assert sorted(row[0] for row in track_store.query('SELECT id FROM artists')) == \
+        [f'a{i}' for i in range(5)] + [f'b{i}' for i in range(5)]
+
+
+def test_concurrent_category_requests_share_one_run():
+    from tests.fake_llm import FakeLLM
+    llm = FakeLLM(latency=0.2)
+    barrier = threading.Barrier(4)
+    results = []
+
+    def request(num_categories):
+        barrier.wait()
+        results.append(lib.playlist_categories('tab-token', 'playlist', num_categories))
+
+    with FakeSpotifyServer(num_tracks=250, num_artists=60) as spotify, \
+            patch.dict(os.environ, {'SPOTIFY_API_URL': spotify.url}), llm.patch(lib):
+        threads = [threading.Thread(target=request, args=(n,)) for n in (3, 3, 3, 4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert lib.get_total_tracks('playlist') == 250
+        lib.track_store.upsert_tracks('playlist', [lib.track_from_item({'track': make_spotify_track(999, ['a'])})])
+        # Memoized for COALESCE_TTL seconds, until the playlist is synced again
+        assert lib.get_total_tracks('playlist') == 250
+        three = next(r for r in results if len(r) == 3)
+        assert lib.playlist_categories('tab-token', 'playlist', 3) == three
+
+    assert spotify.calls['playlist'] == 1
+    assert spotify.calls['playlist_tracks'] == 3
+    assert llm.calls['categories'] == 2
+    assert sorted(len(categories) for categories in results) == [3, 3, 3, 4]
+    assert results.count(three) == 3
+
+
+class CompactLLMChain:
+    def __init__(self):
+        self.prompts = []
+        self.lock = threading.Lock()
+
+    def run(self, header, song):
+        with self.lock:
+            self.prompts.append((header, song))
+        return '```json\n{"category": 2}\n```' if 'jazz' in song else 'Category number: 1'
+
+
+def test_compact_prompt_mode_sends_bucketed_features_and_parses_json():
+    df = make_clustered_tracks(6)
+    categories_output = lib.format_categories(CLUSTERED_CATEGORIES)
+    chain = CompactLLMChain()
+
+    with patch.object(lib, 'CATEGORIZE_PROMPT', 'compact'), patch.object(lib, 'chain_categorize_compact', chain), \
+            patch.object(lib, 'chain_categorize', None):
+        results = list(lib.categorize_dataframe(categories_output, df, max_workers=2))
+
+    assert {track['name']: (number, name) for track, number, name, _, _ in results} == {
+        f'Song {i}': (2, 'Jazz') if i % 3 == 1 else (1, 'Rock Genres') for i in range(6)}
+    assert len({header for header, _ in chain.prompts}) == 1
+    song = chain.prompts[0][1]
+    assert 'energy ' in song and 'genres: ' in song and 'Loudness' not in song and 'loudness' not in song
+    assert lib.format_track_compact(df.iloc[1]) == \
+        'Song 1 by Artist (2020) | genres: jazz, bebop | energy low, danceability mid, valence mid, ' \
+        'acousticness high, instrumentalness mid, speechiness mid, tempo slow'
+    with pytest.raises(ValueError):
+        lib.parse_compact_answer('I am not sure.', categories_output)
+
+
+IMPORT_APP = """
+import json, sys
+sys.path.insert(0, {server!r})
+import app
+from llms import LazyChain
+lib = sys.modules['lib']
+chains = [value for value in vars(lib).values() if isinstance(value, LazyChain)]
+print(json.dumps({{'modules': sorted({{m.split('.')[0] for m in sys.modules}}), 'chains': len(chains),
+                  'built': sum(chain._chain is not None for chain in chains), 'clients': len(lib.llms._llms)}}))
+"""
+
+
+def test_cold_import_skips_llm_clients(tmp_path):
+    import subprocess
+    server = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../server'))
+    (tmp_path / 'logs').mkdir()
+    env = {k: v for k, v in os.environ.items() if k != 'OPENAI_API_KEY'}
+
+    output = subprocess.run([sys.executable, '-c', IMPORT_APP.format(server=server)],
+                            cwd=tmp_path, env=env, capture_output=True, text=True, check=True).stdout
+    imported = json.loads(output.splitlines()[-1])
+
+    for module in ('langchain', 'openai', 'pandas', 'numpy', 'tqdm'):
+        assert module not in imported['modules']
+    assert imported['chains'] > 0 and imported['built'] == 0 and imported['clients'] == 0
+
+
+def test_generate_stream_sends_events_before_playlists_exist(client):
+    categories = [{'category_number': 1, 'category_name': 'Rock Genres', 'description': 'Rock.'},
+                  {'category_number': 2, 'category_name': 'Pop', 'description': 'Pop.'}]
+    chain = FlakyLLMChain(fail_after=55)
+    chain.latency = 0.03
+
+    with FakeSpotifyServer(num_tracks=60, num_artists=20) as spotify, \
+            patch.dict(os.environ, {'SPOTIFY_API_URL': spotify.url}), \
+            patch.object(lib, 'chain_categorize', chain), \
+            patch.object(lib, 'STREAM_HEARTBEAT_INTERVAL', 0.005), \
+            patch.object(lib, 'STREAM_PROGRESS_INTERVAL', 0):
+        lib.ingest_playlist('stream-token', 'playlist')
+        stream = lib.stream_generation('stream-token', 'playlist', categories, max_workers=2)
+        first = json.loads(next(stream))
+        assert spotify.calls['playlist_create'] == 0
+        events = [first] + [json.loads(line) for line in stream]
+
+    kinds = [event['event'] for event in events]
+    assert first == {'event': 'start', 'total_tracks': 60,
+                     'categories': [{'category_number': 1, 'category_name': 'Rock Genres'},
+                                    {'category_number': 2, 'category_name': 'Pop'}]}
+    assert kinds.count('track') == 55 and kinds.count('error') == 5 and kinds.count('playlists') == 1
+    assert 'heartbeat' in kinds and 'progress' in kinds and kinds[-1] == 'done'
+    assert {key: events[-1][key] for key in ('done', 'total', 'errors')} == {'done': 55, 'total': 60, 'errors': 5}
+    assert spotify.calls['playlist_create'] == 2 and 'playlist_id' not in categories[0]
+    # The playlists are created concurrently, so either may be the first
+    rock = next(event for event in events if event['event'] == 'playlists')['playlists'][0]['playlist_id']
+    assert sorted(spotify.added[rock]) == sorted(f'spotify:track:track{i}' for i in range(55))
+
+    assert lib.sse_event('track', {'track_name': 'Song 1'}) == 'event: track\ndata: {"track_name": "Song 1"}\n\n'
+    assert client.post('/generate?format=xml', json={'categories': categories}).status_code == 400
+
+
+def test_library_categorizes_each_track_once_across_playlists(track_store):
+    categories = [{'category_number': 1, 'category_name': 'Rock Genres', 'description': 'Rock.'}]
+    chain = CountingLLMChain()
+
+    with FakeSpotifyServer(num_tracks=250, num_artists=100) as spotify, \
+            patch.dict(os.environ, {'SPOTIFY_API_URL': spotify.url}), patch.object(lib, 'chain_categorize', chain):
+        # a holds tracks 0-149, b 100-249 and the saved tracks 0-49 and 200-249
+        spotify.removed.update(a=set(range(150, 250)), b=set(range(100)), saved=set(range(50, 200)))
+        library_id = lib.create_library('library-token', ['a', 'b', 'saved', 'a'])
+        assert lib.create_library('library-token', ['saved', 'b', 'a']) == library_id
+        assert lib.create_library('library-token', ['a']) == 'a'
+
+        counts = lib.sync_playlist('library-token', library_id)
+        assert counts == {'tracks': 250, 'duplicates': 150, 'playlists': 3}
+        assert spotify.calls['saved_tracks'] == 2
+        assert track_store.track_ids(library_id) == [f'track{i}' for i in range(250)]
+        assert track_store.playlist_name(library_id) == 'Playlist a + Playlist b + 1 more'
+        assert track_store.playlist_name('saved:user') == 'Saved tracks'
+
+        categories = lib.generate_spotify_playlists('library-token', library_id, categories)
+        assert spotify.calls['playlist'] == 2
+        list(lib.stream_categorization('library-token', library_id, categories, max_workers=4))
+
+    # 400 tracks across the three sources, each classified and added once
+    assert chain.calls == 250
+    assert sorted(spotify.added[categories[0]['playlist_id']]) == sorted(f'spotify:track:track{i}' for i in range(250))
+
+
+class RepairLLMChain:
+    def __init__(self, answer):
+        self.answer = answer
+        self.requests = []
+
+    def run(self, output, request, schema):
+        self.requests.append(request)
+        return self.answer
+
+
+def test_unreadable_answers_are_repaired_with_targeted_prompts():
+    categories_output = "1. Rock & Roll (Classic): Rock.\n\n2. Late-Night Jazz!: Jazz."
+    failures = lambda cause: lib.parse_failures.value(prompt='categorize', cause=cause)
+    before = failures('missing_number'), failures('unknown_category')
+
+    assert lib.parse_category_answer('**Category number:** 2\n**Category name:** Late-Night Jazz!\nReasoning: Calm.\n'
+                                     'Its bebop genres.') == (2, 'Late-Night Jazz!', 'Calm.\nIts bebop genres.')
+    assert lib.parse_category_answer('```json\n{"category_number": "1", "category_name": "Rock & Roll (Classic)"}\n```'
+                                     ) == (1, 'Rock & Roll (Classic)', '')
+
+    repair = RepairLLMChain('{"category_number": 2}')
+    with patch.object(lib, 'chain_repair', repair):
+        assert lib.read_category_answer('categorize', 'It is clearly jazz.\nReasoning: Bebop.', categories_output) == \
+            (2, 'Late-Night Jazz!', 'Bebop.')
+        assert lib.read_category_answer('categorize', 'Category number: 7', categories_output) == \
+            (2, 'Late-Night Jazz!', '')
+        # Only the category number is asked for, with the categories to choose from
+        assert repair.requests[0] == ('Which category number does it choose? The categories are: '
+                                      '1. Rock & Roll (Classic), 2. Late-Night Jazz!.')
+    assert (failures('missing_number'), failures('unknown_category')) == (before[0] + 1, before[1] + 1)
+
+    with patch.object(lib, 'chain_repair', RepairLLMChain('Still not sure.')), pytest.raises(ValueError):
+        lib.read_category_answer('categorize', 'Not sure.', categories_output)
+
+
+def test_get_categories_completes_missing_descriptions():
+    output = ("Here you go:\n\n1. **Rock & Roll: Classic**\n2) **Late-Night Jazz!** - Bebop and cool jazz,\n"
+              "played late.\n\n3. Pop")
+    repair = RepairLLMChain('[{"category_number": 1, "category_name": "Rock", "description": "Guitars."},'
+                            ' {"category_number": 3, "description": "Hooks."}]')
+
+    with patch.object(lib, 'chain_categories', MagicMock(run=MagicMock(return_value=output))), \
+            patch.object(lib, 'chain_repair', repair):
+        categories = lib.get_categories(3, 'rock, jazz, pop')
+
+    assert categories == [
+        {'category_number': 1, 'category_name': 'Rock & Roll: Classic', 'description': 'Guitars.'},
+        {'category_number': 2, 'category_name': 'Late-Night Jazz!', 'description': 'Bebop and cool jazz, played late.'},
+        {'category_number': 3, 'category_name': 'Pop', 'description': 'Hooks.'}]
+    assert repair.requests == ['Give the name and a one-sentence description of categories 1, 3.']
+
+
+class FakeRateLimitError(Exception):
+    http_status = 429
+
+    def __init__(self, retry_after):
+        super().__init__('429')
+        self.headers = {'Retry-After': str(retry_after)}
+
+
+def test_rate_governor_settles_at_the_upstream_limit():
+    from server.governor import RateGovernor
+    limit, seconds = 40, 3.0
+    sent, lock, counts = [], threading.Lock(), {'ok': 0, 'rate_limited': 0}
+
+    def upstream():
+        # Allows limit requests in any second
+        with lock:
+            now = time.monotonic()
+            recent = [t for t in sent if t > now - 1]
+            sent[:] = recent
+            if len(recent) >= limit:
+                counts['rate_limited'] += 1
+                raise FakeRateLimitError(0.2)
+            sent.append(now)
+            counts['ok'] += 1
+
+    governor = RateGovernor('test-upstream', rate=10, max_rate=500)
+    call = governor.wrap(upstream)
+    deadline = time.monotonic() + seconds
+
+    def caller():
+        while time.monotonic() < deadline:
+            try:
+                call()
+            except FakeRateLimitError:
+                pass
+
+    threads = [threading.Thread(target=caller) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = governor.stats()
+    report = (f"{counts['ok'] / seconds:.1f} requests/s against a limit of {limit}, "
+              f"{counts['rate_limited']} rate limited, budget {stats['rate']:.1f}/s")
+    assert counts['ok'] >= 0.6 * limit * seconds, report
+    assert counts['rate_limited'] <= 0.1 * counts['ok'], report
+    assert 0 < governor.throttles <= counts['rate_limited']
+    assert stats['queue_depth'] == 0
+
+
+def test_rate_governor_honors_retry_after_across_processes(tmp_path):
+    from server.governor import RateGovernor
+    path = str(tmp_path / 'governors.sqlite')
+    # Two governors on one file stand in for two worker processes
+    first = RateGovernor('shared', rate=5, burst=2, path=path)
+    second = RateGovernor('shared', rate=5, burst=2, path=path)
+
+    assert first.acquire() < 0.05 and first.acquire() < 0.05
+    # The burst is spent, so the other process waits for the next token
+    assert second.acquire() >= 0.1
+
+    with pytest.raises(FakeRateLimitError), first.request():
+        raise FakeRateLimitError(0.3)
+    assert second.stats()['rate'] == 2.5
+    assert second.acquire() >= 0.25
+
+
+def test_feature_matrix_is_rebuilt_after_same_length_edits(track_store):
+    def track(track_id):
+        return {'id': track_id, 'uri': f'spotify:track:{track_id}', 'popularity': 50, 'album': 'Album',
+                'name': track_id, 'release_date': '2020', 'thumbnail_url': None, 'artists': ['Artist'],
+                'artists_id': ['artist0']}
+
+    track_store.upsert_tracks('playlist', [track('trackA'), track('trackB')])
+    track_store.set_track_genres({'trackA': ('rock',), 'trackB': ('jazz',)})
+    assert lib.feature_cache.get('playlist').genre_lists() == [('rock',), ('jazz',)]
+
+    # Edits that keep every genre and track id the same length still bump the playlist's version
+    track_store.set_track_genres({'trackA': ('punk',)})
+    assert lib.feature_cache.get('playlist').genre_lists() == [('punk',), ('jazz',)]
+
+    track_store.prune_playlist('playlist', {'trackB'})
+    track_store.upsert_tracks('playlist', [dict(track('trackC'), position=0)])
+    track_store.set_track_genres({'trackC': ('punk',)})
+    assert lib.feature_cache.get('playlist').track_ids == ['trackC', 'trackB']
+
+    track_store.upsert_tracks('playlist', [dict(track('trackB'), position=0), dict(track('trackC'), position=1)])
+    assert lib.feature_cache.get('playlist').track_ids == ['trackB', 'trackC']
+    assert lib.feature_cache.builds == 4
+
+    features = pd.DataFrame([dict.fromkeys(AUDIO_FEATURES, 0.5)], index=['trackB'])
+    track_store.upsert_audio_features(features)
+    assert lib.feature_cache.get('playlist').audio[0].tolist() == [0.5] * len(AUDIO_FEATURES)
+
+    track_store.reset_track_genres(['artist0'])
+    assert lib.feature_cache.get('playlist').genre_lists() == [None, None]
+
+    # Tracks of other playlists leave this one's version alone
+    track_store.upsert_tracks('other', [track('trackD')])
+    track_store.set_track_genres({'trackD': ('rock',)})
+    assert lib.feature_cache.get('playlist') is lib.feature_cache.get('playlist')
+    assert lib.feature_cache.builds == 6
+
+
+def test_feature_cache_builds_once_and_forgets_its_build_locks(track_store):
+    cache = FeatureCache(track_store, max_entries=4)
+    for n in range(20):
+        track_store.upsert_tracks(f'playlist{n}', [{'id': f'track{n}', 'uri': f'spotify:track:track{n}',
+                                                    'popularity': 50, 'album': 'Album', 'name': 'Track',
+                                                    'release_date': '2020', 'thumbnail_url': None,
+                                                    'artists': ['Artist'], 'artists_id': ['artist0']}])
+    rows = track_store.playlist_feature_rows
+
+    def slow_rows(playlist_id):
+        time.sleep(0.05)
+        return rows(playlist_id)
+
+    with patch.object(track_store, 'playlist_feature_rows', slow_rows):
+        threads = [threading.Thread(target=cache.get, args=('playlist0',)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert cache.builds == 1
+
+    for n in range(20):
+        cache.get(f'playlist{n}')
+    assert cache.builds == 20
+    assert len(cache._entries) == 4 and not cache._building
+
+
+def test_preview_checks_the_token_and_the_snapshot(client, track_store):
+    with FakeSpotifyServer(num_tracks=60, num_artists=20) as spotify, \
+            patch.dict(os.environ, {'SPOTIFY_API_URL': spotify.url}), \
+            patch.object(lib, 'single_flight', SingleFlight(ttl=0)), \
+            patch('server.app.playlist_preview', lib.playlist_preview):
+        assert client.get('/preview?playlist_id=playlist').status_code == 400
+        assert client.get('/preview?token=snapshot-token&playlist_id=playlist').get_json()['total_tracks'] == 60
+
+        # A changed snapshot is synced again
+        spotify.removed['playlist'] = set(range(10))
+        spotify.snapshots['playlist'] = 'snapshot-1'
+        assert client.get('/preview?token=snapshot-token&playlist_id=playlist').get_json()['total_tracks'] == 50
+
+        # Stored tracks are not served to a token that cannot read them anymore
+        spotify.private.add('playlist')
+        response = client.get('/preview?token=snapshot-token&playlist_id=playlist')
+        assert response.status_code == 403 and 'total_tracks' not in response.get_json()
+
+        # The saved tracks of another user neither
+        lib.sync_playlist('snapshot-token', 'saved:user')
+        assert client.get('/preview?token=snapshot-token&playlist_id=saved:user').status_code == 200
+        assert client.get('/preview?token=snapshot-token&playlist_id=saved:someone-else').status_code == 403
+        assert track_store.count_tracks('saved:someone-else') == 0
+
+
+def test_preview_reads_a_cached_feature_matrix(client, track_store, tmp_path):
+    with FakeSpotifyServer(num_tracks=120, num_artists=30) as spotify, \
+            patch.dict(os.environ, {'SPOTIFY_API_URL': spotify.url}), patch.object(lib, 'chain_categories', None), \
+            patch('server.app.playlist_preview', lib.playlist_preview):
+        preview = client.get('/preview?token=preview-token&playlist_id=playlist').get_json()
+        calls = Counter(spotify.calls)
+        assert client.get('/preview?token=preview-token&playlist_id=playlist').get_json() == preview
+        lib.summarize_genres('playlist')
+        # Only the snapshot_id is checked again
+        assert spotify.calls - calls == Counter(playlist=1)
+
+    assert lib.feature_cache.builds == 1
+    assert preview['total_tracks'] == 120 and preview['tracks_pending_genres'] == 0
+    genres = preview['genres']
+    assert sum(entry['tracks'] for entry in genres) >= preview['tracks_with_genres'] == 120
+    assert [entry['tracks'] for entry in genres] == sorted((entry['tracks'] for entry in genres), reverse=True)
+    energy = preview['audio_features']['energy']
+    assert energy['count'] == 120 and sum(energy['histogram']['counts']) == 120
+    assert energy['min'] <= energy['p25'] <= energy['median'] <= energy['p75'] <= energy['max']
+    categories = preview['categories']
+    assert 1 <= categories['min'] <= categories['suggested'] <= categories['max'] <= 12
+
+    # A changed playlist gets a new matrix
+    track_store.set_track_genres({'track0': ('brand new genre',)})
+    assert 'brand new genre' in lib.feature_cache.get('playlist').genres
+    assert lib.feature_cache.builds == 2
+
+    features = lib.feature_cache.get('playlist')
+    assert features.audio.dtype == np.float32 and features.indices.dtype == np.int32
+    features.save(str(tmp_path / 'features.npz'))
+    loaded = PlaylistFeatures.load(str(tmp_path / 'features.npz'))
+    assert loaded.genre_lists() == features.genre_lists() == track_store.playlist_genres('playlist')
+    assert loaded.version == features.version == track_store.playlist_version('playlist')